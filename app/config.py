@@ -11,15 +11,47 @@ DEFAULT_CONFIG = {
     'JWT_ALGORITHM': 'HS256',
     'JWT_EXPIRATION': '180',  # days
     'DOWNLOAD_TIMEOUT': 15,
+    'DOWNLOAD_LOCK_TIMEOUT': 60,  # seconds
+    'DOWNLOAD_RETRIES': 2,  # resumed attempts of an interrupted download
+    'PARTIAL_DOWNLOAD_TTL': 86400,  # seconds
     'CHUNK_SIZE': 1024 * 1024,
+    'FS_THREADS': 16,  # threads of blocking filesystem operations
+    'SENDFILE': '1',  # serve cached files by the kernel (zero-copy)
+    'CACHE_MAX_AGE': 3600,  # seconds (Cache-Control of cached files)
+    'METRICS_TOKEN': '',  # token of /_metrics (empty - disabled)
+    'COLLECTION_LIST_CACHE_TTL': 2,  # seconds (0 - disabled)
     'DATA_DIR': 'data',
+    'STORAGE': 'local',  # local, s3
+    'S3_ENDPOINT': '',  # e.g. http://minio:9000
+    'S3_BUCKET': '',
+    'S3_REGION': 'us-east-1',
+    'S3_ACCESS_KEY': '',
+    'S3_SECRET_KEY': '',
+    'S3_PART_SIZE': 8 * 1024 * 1024,  # multipart upload (min. 5 MiB)
+    'HTTP_POOL_SIZE': 100,  # outbound connections
+    'HTTP_POOL_SIZE_PER_HOST': 10,
+    'HTTP_DNS_CACHE_TTL': 300,  # seconds
+    'HTTP_KEEPALIVE_TIMEOUT': 30,  # seconds
     'REDIS_URI': 'redis://localhost:6379/0',
     'LOGGING_DEFINITIONS': f'{BASE_DIR}logging.yml',
+    'ANN_WORDS': 256,  # visual words of the similarity index
+    'ANN_MIN_IMAGES': 200,  # analyzed images to train the vocabulary
+    'ANN_SHORTLIST': 20,  # candidates verified by SIFT matching
+    'DESCRIPTOR_CACHE_SIZE': 512,  # MiB per worker (split by processes)
+    'WORKER_PROCESSES': 0,  # processes of actions (auto - cores, 0 - inline)
+    'TASK_CLAIM_TIMEOUT': 300,  # seconds (the tasks of a crashed worker)
+    'TASK_MAX_DELIVERIES': 3,  # deliveries of a failing task
+    'TASK_WEIGHTS': 'thumb:8,resize:4,dedup:2,collection:1',  # fair shares
+    'WORKER_LIMITS': 'video:1,image.find_same_images:2',  # kind:running
     'THUMB_WIDTH': 290,
     'THUMB_HEIGHT': 435
 }
 
 
+def as_bool(value) -> bool:
+    return str(value).lower() in ('1', 'true', 'yes', 'on')
+
+
 def get_config(name: str, default=None, wrapper: Callable = None):
     if not wrapper:
         wrapper = lambda x: x  # NOQA
@@ -0,0 +1,197 @@
+import asyncio
+import hashlib
+
+from aiofile import async_open
+from loggate import get_logger
+
+from libs.file_system import FileSystem
+from libs.storage import Storage
+
+logger = get_logger('DownloadStream')
+
+
+class DownloadStreamException(Exception): pass     # noqa
+
+
+class DownloadStream:
+    """
+    The file which is being downloaded. The downloader writes the chunks
+    to the temporary file and the readers (clients waiting for the same
+    file) read them from the disk as soon as they are written.
+    The temporary file is promoted to the final path when it is complete.
+    The late readers read the file from the storage (storage_key) when
+    the local file was already uploaded and removed (e.g. S3).
+    SHA-256 of the content is computed while the chunks are written.
+    """
+    streams: dict[str, 'DownloadStream'] = {}
+    announcements: dict[str, list[asyncio.Future]] = {}
+
+    @classmethod
+    async def open(cls, key: str, path: str, total: int = None,
+                   owner=None, offset: int = 0,
+                   storage_key: str = None) -> 'DownloadStream':
+        """
+        Start writing of the file and announce it to the waiting readers.
+        :param key: str - key of the download (e.g. uuid of the image)
+        :param path: str - final path of the file
+        :param total: int - expected size of the file (if it is known)
+        :param owner: the object which is downloaded (e.g. Image)
+        :param offset: int - continue the partial download from this offset
+        :param storage_key: str - key of the file in the storage
+        :return: DownloadStream
+        """
+        stream = cls(key, path, total, owner, storage_key)
+        if offset:
+            stream._fd = await async_open(stream.path, 'r+b')
+            await stream._fd.file.truncate(offset)
+            stream._fd.seek(offset)
+            stream.size = offset
+            await FileSystem.run(stream.__hash_file, offset)
+        else:
+            stream._fd = await async_open(stream.path, 'wb')
+        cls.streams[key] = stream
+        for announcement in cls.announcements.pop(key, []):
+            if not announcement.done():
+                announcement.set_result(stream)
+        return stream
+
+    @classmethod
+    async def wait(cls, key: str,
+                   flight: asyncio.Future) -> 'DownloadStream | None':
+        """
+        Wait until the download of the key starts.
+        :param key: str
+        :param flight: the future of the download
+        :return: DownloadStream or None if the download finished without
+                 the stream (e.g. the file was downloaded by another process)
+        """
+        if stream := cls.streams.get(key):
+            return stream
+        announcement = asyncio.get_running_loop().create_future()
+        cls.announcements.setdefault(key, []).append(announcement)
+        try:
+            await asyncio.wait([announcement, flight],
+                               return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            waiting = cls.announcements.get(key, [])
+            if announcement in waiting:
+                waiting.remove(announcement)
+                if not waiting:
+                    cls.announcements.pop(key)
+        if announcement.done():
+            return announcement.result()
+        announcement.cancel()
+        return None
+
+    def __init__(self, key: str, path: str, total: int = None, owner=None,
+                 storage_key: str = None):
+        self.key = key
+        self.storage_key = storage_key
+        self.final_path = path
+        self.path = f'{path}.part'
+        self.total = total
+        self.owner = owner
+        self.size = 0
+        self.done = False
+        self.error: BaseException = None
+        self._fd = None
+        self._changed = asyncio.Event()
+        self._sha256 = hashlib.sha256()
+
+    @property
+    def digest(self) -> str:
+        return self._sha256.hexdigest()
+
+    def __hash_file(self, size: int):
+        with open(self.path, 'rb') as fd:
+            while size > 0 and (data := fd.read(min(size, 1024 * 1024))):
+                self._sha256.update(data)
+                size -= len(data)
+
+    def __notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def write(self, data: bytes):
+        await self._fd.write(data)
+        self._sha256.update(data)
+        self.size += len(data)
+        self.__notify()
+
+    async def finish(self):
+        """
+        The file is complete, it is flushed to the disk and moved
+        to the final path (atomic rename).
+        """
+        await self._fd.flush(sync_metadata=True)
+        await self._fd.close()
+        await FileSystem.replace(self.path, self.final_path)
+        self.path = self.final_path
+        self.done = True
+        self.streams.pop(self.key, None)
+        self.__notify()
+
+    async def fail(self, ex: BaseException, keep: bool = False):
+        """
+        The download failed, the temporary file is removed.
+        :param ex: the reason
+        :param keep: bool - keep the temporary file for resuming
+        """
+        self.error = ex
+        self.streams.pop(self.key, None)
+        self.__notify()
+        try:
+            await self._fd.close()
+            if not keep:
+                await FileSystem.unlink(self.path, missing_ok=False)
+        except OSError:
+            pass
+
+    async def __open_reader(self):
+        """
+        :return: the opened file or None if it was moved to the storage
+        """
+        while True:
+            try:
+                return await async_open(self.path, 'rb')
+            except FileNotFoundError:
+                if self.error or self.done:
+                    # The temporary file was just promoted or removed
+                    if self.error:
+                        raise DownloadStreamException(str(self.error))
+                    try:
+                        return await async_open(self.path, 'rb')
+                    except FileNotFoundError:
+                        if not self.storage_key:
+                            raise
+                        return None
+                await self._changed.wait()
+
+    async def iter_chunks(self, chunk: int):
+        """
+        Read the file from the beginning, the reader waits for new data
+        until the download is done.
+        :param chunk: int - max size of chunk
+        """
+        if not (fd := await self.__open_reader()):
+            async for data in Storage.get().stream(self.storage_key,
+                                                   chunk=chunk):
+                yield data
+            return
+        offset = 0
+        try:
+            while True:
+                changed = self._changed
+                if self.error:
+                    raise DownloadStreamException(str(self.error))
+                if offset < self.size:
+                    data = await fd.read(min(chunk, self.size - offset))
+                    if data:
+                        offset += len(data)
+                        yield data
+                        continue
+                if self.done:
+                    return
+                await changed.wait()
+        finally:
+            await fd.close()
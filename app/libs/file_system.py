@@ -0,0 +1,85 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable
+
+from config import get_config
+from libs.metrics import Metrics
+
+FS_THREADS = get_config('FS_THREADS', wrapper=int)
+
+
+class FileSystem:
+    """
+    Async access to the filesystem. The blocking calls run in the bounded
+    thread pool, so a slow disk (e.g. NFS) does not stall the event loop.
+    Metrics:
+        fs.queue - time of waiting for a free thread
+        fs.wait - time of waiting for the result (queue + the call)
+    """
+    executor = ThreadPoolExecutor(max_workers=FS_THREADS,
+                                  thread_name_prefix='fs')
+
+    @classmethod
+    async def run(cls, fce: Callable, *args, **kwargs):
+        queued = time.perf_counter()
+        started = None
+
+        def call():
+            nonlocal started
+            started = time.perf_counter()
+            return fce(*args, **kwargs)
+
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                cls.executor, call)
+        finally:
+            # Metrics are not thread-safe, they are updated on the loop
+            if started is not None:
+                Metrics.observe('fs.queue', started - queued)
+            Metrics.observe('fs.wait', time.perf_counter() - queued)
+
+    @classmethod
+    async def exists(cls, path: str) -> bool:
+        return await cls.run(os.path.exists, path)
+
+    @classmethod
+    async def stat(cls, path: str) -> os.stat_result | None:
+        try:
+            return await cls.run(os.stat, path)
+        except OSError:
+            return None
+
+    @classmethod
+    async def getsize(cls, path: str) -> int:
+        return await cls.run(os.path.getsize, path)
+
+    @classmethod
+    async def rename(cls, src: str, dst: str):
+        await cls.run(os.rename, src, dst)
+
+    @classmethod
+    async def replace(cls, src: str, dst: str):
+        await cls.run(os.replace, src, dst)
+
+    @classmethod
+    async def unlink(cls, path: str, missing_ok: bool = True):
+        await cls.run(Path(path).unlink, missing_ok=missing_ok)
+
+    @classmethod
+    async def listdir(cls, path: str) -> list[str]:
+        return await cls.run(os.listdir, path)
+
+    @classmethod
+    async def mkdir(cls, path: str):
+        await cls.run(Path(path).mkdir, parents=True, exist_ok=True)
+
+    @classmethod
+    async def rmdir(cls, path: str):
+        await cls.run(os.rmdir, path)
+
+    @classmethod
+    async def link(cls, src: str, dst: str):
+        await cls.run(os.link, src, dst)
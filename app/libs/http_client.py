@@ -0,0 +1,63 @@
+import aiohttp
+from loggate import get_logger
+
+from config import get_config
+
+HTTP_POOL_SIZE = get_config('HTTP_POOL_SIZE', wrapper=int)
+HTTP_POOL_SIZE_PER_HOST = get_config('HTTP_POOL_SIZE_PER_HOST', wrapper=int)
+HTTP_DNS_CACHE_TTL = get_config('HTTP_DNS_CACHE_TTL', wrapper=int)
+HTTP_KEEPALIVE_TIMEOUT = get_config('HTTP_KEEPALIVE_TIMEOUT', wrapper=int)
+
+
+class HttpClientException(Exception): pass     # noqa
+
+
+class HttpClient:
+    """
+    The application-lifetime client for all outbound requests.
+    The connections are pooled (keep-alive) and the DNS responses are cached.
+    """
+    instance = None
+
+    @classmethod
+    def get(cls) -> 'HttpClient':
+        return cls.instance
+
+    @classmethod
+    def get_session(cls) -> aiohttp.ClientSession:
+        if not cls.instance:
+            raise HttpClientException('HttpClient is not initialized.')
+        return cls.instance.session
+
+    def __init__(self):
+        if self.__class__.instance:
+            raise HttpClientException('Multiple instances of HttpClient')
+        self._session: aiohttp.ClientSession = None
+        self.logger = get_logger(self.__class__.__name__)
+        self.__class__.instance = self
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if not self._session or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=HTTP_POOL_SIZE,
+                    limit_per_host=HTTP_POOL_SIZE_PER_HOST,
+                    ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+                    keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT
+                ),
+                # The requests are independent, cookies are not shared.
+                cookie_jar=aiohttp.DummyCookieJar()
+            )
+        return self._session
+
+    async def connection(self):
+        self.logger.info(
+            f'Outbound HTTP pool: {HTTP_POOL_SIZE} connections '
+            f'({HTTP_POOL_SIZE_PER_HOST} per host).')
+        return self.session
+
+    async def disconnect(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
@@ -0,0 +1,322 @@
+import hashlib
+import os
+import re
+import stat
+import uuid as uuid_lib
+
+from aiofile import async_open
+from aiohttp import web, hdrs
+from aiohttp.abc import Request
+from aiohttp.web_response import StreamResponse
+from loggate import get_logger
+
+from config import get_config, as_bool
+from libs.download_stream import DownloadStream
+from libs.file_system import FileSystem
+from libs.storage import Storage, StorageException
+
+CHUNK_SIZE = get_config('CHUNK_SIZE', wrapper=int)
+SENDFILE = get_config('SENDFILE', wrapper=as_bool)
+CACHE_MAX_AGE = get_config('CACHE_MAX_AGE', wrapper=int)
+MAX_RANGES = 16
+
+logger = get_logger('media')
+
+
+class RangeNotSatisfiable(Exception): pass     # noqa
+
+
+class MediaFileResponse(web.FileResponse):
+    """
+    FileResponse which keeps the ETag given in the headers and which is
+    prepared with the request headers already evaluated by media_response.
+    """
+
+    def __init__(self, path, request_headers=None, **kwargs):
+        super().__init__(path, **kwargs)
+        self._request_headers = request_headers
+
+    @web.FileResponse.etag.setter
+    def etag(self, value):
+        pass
+
+    async def prepare(self, request: Request):
+        if self.prepared:
+            return None
+        if self._request_headers is not None:
+            request = request.clone(headers=self._request_headers)
+        return await super().prepare(request)
+
+
+async def file_stat(path: str) -> os.stat_result | None:
+    """
+    Stat the file outside of the event loop.
+    :param path: str
+    :return: os.stat_result or None if the file does not exist
+    """
+    st = await FileSystem.stat(path)
+    return st if st and stat.S_ISREG(st.st_mode) else None
+
+
+def make_etag(key: str, st: os.stat_result) -> str:
+    """
+    Strong ETag of the file. It is derived from the image uuid (or path),
+    the size and the modification time of the file.
+    """
+    key = hashlib.md5(key.encode()).hexdigest()[:16]
+    return f'"{key}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+
+def etag_matches(header: str, etag: str) -> bool:
+    if header.strip() == '*':
+        return True
+    for it in header.split(','):
+        it = it.strip()
+        if it.startswith('W/'):
+            it = it[2:]
+        if it == etag:
+            return True
+    return False
+
+
+def parse_ranges(header: str, size: int) -> list[tuple[int, int]] | None:
+    """
+    Parse the Range header.
+        'bytes=0-499, -500' -> [(0, 500), (size - 500, size)]
+    :param header: str
+    :param size: int - size of the file
+    :raise RangeNotSatisfiable - no range overlaps the file
+    :return: list of (start, stop) or None if the header has to be ignored
+    """
+    unit, _, ranges = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not ranges:
+        return None
+    res = []
+    for it in ranges.split(','):
+        match = re.match(r'^\s*(\d*)\s*-\s*(\d*)\s*$', it)
+        if not match or not any(match.groups()):
+            return None
+        start, end = match.groups()
+        if not start:
+            # suffix range (last N bytes)
+            start, end = max(size - int(end), 0), size - 1
+        else:
+            start = int(start)
+            end = min(int(end), size - 1) if end else size - 1
+        if end < start:
+            if start < size:
+                return None
+            continue
+        if start < size:
+            res.append((start, end + 1))
+    if not res:
+        raise RangeNotSatisfiable()
+    if len(res) > MAX_RANGES:
+        return None
+    return res
+
+
+def _not_modified(request: Request, st: os.stat_result, etag: str) -> bool:
+    if_none_match = request.headers.get(hdrs.IF_NONE_MATCH)
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag)
+    modified_since = request.if_modified_since
+    return modified_since is not None \
+        and int(st.st_mtime) <= modified_since.timestamp()
+
+
+def _range_allowed(request: Request, st: os.stat_result, etag: str) -> bool:
+    if_range = request.headers.get(hdrs.IF_RANGE)
+    if not if_range:
+        return True
+    if if_range.strip().startswith(('"', 'W/')):
+        # Weak validators are never allowed for If-Range
+        return if_range.strip() == etag
+    return request.if_range is not None \
+        and int(st.st_mtime) <= request.if_range.timestamp()
+
+
+async def _write_ranges(response: StreamResponse, path: str,
+                        ranges: list[tuple[int, int]],
+                        parts: list[bytes] = None, storage: Storage = None):
+    if storage:
+        for ix, (start, stop) in enumerate(ranges):
+            if parts:
+                await response.write(parts[ix])
+            async for data in storage.stream(path, start, stop):
+                await response.write(data)
+            if parts:
+                await response.write(b'\r\n')
+        return
+    async with async_open(path, 'rb') as fd:
+        for ix, (start, stop) in enumerate(ranges):
+            if parts:
+                await response.write(parts[ix])
+            fd.seek(start)
+            while start < stop:
+                data = await fd.read(min(CHUNK_SIZE, stop - start))
+                if not data:
+                    break
+                start += len(data)
+                await response.write(data)
+            if parts:
+                await response.write(b'\r\n')
+
+
+async def media_response(request: Request, path: str,
+                         content_type: str = None,
+                         filename: str = None,
+                         etag_key: str = None,
+                         immutable: bool = False,
+                         storage: Storage = None) -> StreamResponse:
+    """
+    Make the response for a cached file.
+    The file is handed to the kernel (sendfile) by default, so the bytes
+    are never copied through the userspace. If SENDFILE is disabled,
+    the file is streamed by chunks (CHUNK_SIZE).
+    The response supports conditional requests (If-None-Match,
+    If-Modified-Since, If-Range) and byte ranges (206, multipart/byteranges).
+    :param request: Request
+    :param path: str - full path of the file
+    :param content_type: str - (default: guessed by the file extension)
+    :param filename: str - the filename for Content-Disposition header
+    :param etag_key: str - the key of ETag (default: path)
+    :param immutable: bool - the url is content-addressed (e.g. /_blobs/,
+                      the file of an image uuid can be changed)
+    :param storage: Storage - the path is the key of the file in the storage
+                    (the file is streamed from the storage)
+    :return: StreamResponse
+    """
+    st = await (storage.stat(path) if storage else file_stat(path))
+    if not st:
+        return web.Response(text="The file was not found.", status=404)
+    etag = make_etag(etag_key or path, st)
+    headers = {
+        hdrs.ETAG: etag,
+        hdrs.ACCEPT_RANGES: 'bytes',
+        hdrs.CACHE_CONTROL: 'public, max-age=31536000, immutable'
+        if immutable else f'public, max-age={CACHE_MAX_AGE}'
+    }
+    if _not_modified(request, st, etag):
+        response = web.Response(status=304, headers=headers)
+        response.last_modified = st.st_mtime
+        return response
+
+    if content_type:
+        headers[hdrs.CONTENT_TYPE] = content_type
+    if filename:
+        headers[hdrs.CONTENT_DISPOSITION] = f'inline; filename="{filename}"'
+    ranges = None
+    if hdrs.RANGE in request.headers and \
+            _range_allowed(request, st, etag):
+        try:
+            ranges = parse_ranges(request.headers[hdrs.RANGE], st.st_size)
+        except RangeNotSatisfiable:
+            headers[hdrs.CONTENT_RANGE] = f'bytes */{st.st_size}'
+            return web.Response(status=416, headers=headers)
+
+    if SENDFILE and not storage and (not ranges or len(ranges) == 1):
+        # The conditions were evaluated above, FileResponse gets only
+        # the range which has to be sent.
+        clean_headers = request.headers.copy()
+        for key in (hdrs.IF_MATCH, hdrs.IF_NONE_MATCH, hdrs.IF_MODIFIED_SINCE,
+                    hdrs.IF_UNMODIFIED_SINCE, hdrs.IF_RANGE, hdrs.RANGE):
+            clean_headers.popall(key, None)
+        if ranges:
+            start, stop = ranges[0]
+            clean_headers[hdrs.RANGE] = f'bytes={start}-{stop - 1}'
+        return MediaFileResponse(path, request_headers=clean_headers,
+                                 chunk_size=CHUNK_SIZE, headers=headers)
+
+    response = StreamResponse(headers=headers)
+    response.last_modified = st.st_mtime
+    parts = None
+    if not ranges:
+        ranges = [(0, st.st_size)]
+        response.content_length = st.st_size
+    elif len(ranges) == 1:
+        start, stop = ranges[0]
+        response.set_status(206)
+        response.headers[hdrs.CONTENT_RANGE] = \
+            f'bytes {start}-{stop - 1}/{st.st_size}'
+        response.content_length = stop - start
+    else:
+        boundary = uuid_lib.uuid4().hex
+        part_type = content_type or 'application/octet-stream'
+        parts = [(f'--{boundary}\r\n'
+                  f'Content-Type: {part_type}\r\n'
+                  f'Content-Range: bytes {start}-{stop - 1}/{st.st_size}'
+                  f'\r\n\r\n').encode() for start, stop in ranges]
+        closing = f'--{boundary}--\r\n'.encode()
+        response.set_status(206)
+        response.headers[hdrs.CONTENT_TYPE] = \
+            f'multipart/byteranges; boundary={boundary}'
+        response.content_length = sum(
+            len(part) + stop - start + 2
+            for part, (start, stop) in zip(parts, ranges)) + len(closing)
+    await response.prepare(request)
+    if request.method == hdrs.METH_HEAD:
+        return response
+    try:
+        await _write_ranges(response, path, ranges, parts, storage)
+        if parts:
+            await response.write(closing)
+        await response.write_eof()
+    except ConnectionResetError:
+        logger.warning('The client closed the connection (%s).', path)
+    except StorageException as ex:
+        logger.error(f'Reading of {path} failed: {ex}')
+        response.force_close()
+    return response
+
+
+async def storage_response(request: Request, key: str,
+                           **kwargs) -> StreamResponse:
+    """
+    Make the response for the file in the storage (see media_response).
+    The file of the local storage is sent directly from the disk.
+    :param request: Request
+    :param key: str - key of the file in the storage
+    :return: StreamResponse
+    """
+    storage = Storage.get()
+    if path := storage.local_path(key):
+        return await media_response(request, path, **kwargs)
+    kwargs.setdefault('etag_key', key)
+    return await media_response(request, key, storage=storage, **kwargs)
+
+
+async def stream_response(request: Request, stream: DownloadStream,
+                          content_type: str = None,
+                          filename: str = None) -> StreamResponse:
+    """
+    Send the file which is being downloaded. The chunks are sent as soon
+    as they are written to the disk.
+    :param request: Request
+    :param stream: DownloadStream
+    :param content_type: str
+    :param filename: str - the filename for Content-Disposition header
+    :return: StreamResponse
+    """
+    response = StreamResponse(headers={hdrs.CACHE_CONTROL: 'no-cache'})
+    if content_type:
+        response.content_type = content_type
+    if filename:
+        response.headers[hdrs.CONTENT_DISPOSITION] = \
+            f'inline; filename="{filename}"'
+    if stream.total:
+        response.content_length = stream.total
+    await response.prepare(request)
+    if request.method == hdrs.METH_HEAD:
+        return response
+    try:
+        async for data in stream.iter_chunks(CHUNK_SIZE):
+            await response.write(data)
+        await response.write_eof()
+    except ConnectionResetError:
+        logger.warning('The client closed the connection (%s).',
+                       stream.final_path)
+    except Exception as ex:
+        logger.error(f'Streaming of {stream.final_path} failed: {ex}')
+        response.force_close()
+    return response
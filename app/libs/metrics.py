@@ -0,0 +1,58 @@
+import json
+import os
+import socket
+import time
+
+from libs.redis_manager import RedisManager
+
+METRICS_TTL = 300  # seconds
+
+
+class Metrics:
+    """
+    In-process counters and timers.
+        Metrics.inc('descriptors.hit')
+        Metrics.observe('fs.wait', 0.002)
+    The snapshot of other processes (e.g. workers) is published to Redis.
+    """
+    counters: dict[str, float] = {}
+    timers: dict[str, list] = {}  # name -> [count, total, max]
+
+    @classmethod
+    def inc(cls, name: str, value: float = 1):
+        cls.counters[name] = cls.counters.get(name, 0) + value
+
+    @classmethod
+    def observe(cls, name: str, seconds: float):
+        if not (timer := cls.timers.get(name)):
+            timer = cls.timers[name] = [0, 0.0, 0.0]
+        timer[0] += 1
+        timer[1] += seconds
+        timer[2] = max(timer[2], seconds)
+
+    @classmethod
+    def snapshot(cls) -> dict:
+        res = dict(cls.counters)
+        for name, (count, total, max_time) in cls.timers.items():
+            res[f'{name}.count'] = count
+            res[f'{name}.seconds'] = round(total, 6)
+            res[f'{name}.max_seconds'] = round(max_time, 6)
+        res['timestamp'] = time.time()
+        return res
+
+    @classmethod
+    async def publish(cls, db: RedisManager, name: str = None):
+        """
+        Publish the snapshot of this process to Redis.
+        """
+        name = name or f'{socket.gethostname()}-{os.getpid()}'
+        await db.r.set(f'metrics:{name}', json.dumps(cls.snapshot()),
+                       ex=METRICS_TTL)
+
+    @classmethod
+    async def get_published(cls, db: RedisManager) -> dict:
+        res = {}
+        async for key in db.r.scan_iter(match='metrics:*', count=100):
+            if data := await db.r.get(key):
+                res[key.split(':', 1)[1]] = json.loads(data)
+        return res
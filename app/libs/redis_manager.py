@@ -33,8 +33,8 @@ class RedisManager:
         return cls.instance
 
     @classmethod
-    def get_lock(cls, name, timeout=None):
-        return Lock(cls.instance, name, timeout=timeout)
+    def get_lock(cls, name, timeout=None, **kwargs):
+        return Lock(cls.instance, name, timeout=timeout, **kwargs)
 
     @classmethod
     def register_handlers(cls, name: str, fce: Callable):
@@ -50,7 +50,6 @@ class RedisManager:
         self.r = None
         self.pubsub = None
         self.ix_images: AsyncSearch = None
-        self.ix_tasks: AsyncSearch = None
         self.logger = get_logger(self.__class__.__name__)
         self.__class__.instance = self
 
@@ -73,12 +72,11 @@ class RedisManager:
                     TextField('filename', sortable=True),
                     TagField('collection', sortable=True),
                     NumericField('created', sortable=True),
-                    TextField('original_uuid')
+                    TextField('original_uuid'),
+                    NumericField('alternates_count', sortable=True)
                 )
-                task_schema = (TagField('status', sortable=True))
                 matrix_schema = (TextField('similar_images_uuids'))
                 self.ix_images = self.r.ft('ix:images')
-                self.ix_tasks = self.r.ft('ix:tasks')
                 self.ix_matrix = self.r.ft('ix:matrix')
 
                 try:
@@ -90,11 +88,17 @@ class RedisManager:
                         matrix_schema,
                         definition=IndexDefinition(prefix=["matrix:"],
                                                    index_type=IndexType.HASH))
-                    await self.ix_tasks.create_index(
-                        task_schema,
-                        definition=IndexDefinition(prefix=["tasks:"],
-                                                   index_type=IndexType.HASH))
-
+                except Exception:
+                    pass
+                try:
+                    # The tasks are queued by streams, not by the index
+                    await self.r.ft('ix:tasks').dropindex()
+                except Exception:
+                    pass
+                try:
+                    # The index was created before the field existed
+                    await self.ix_images.alter_schema_add(
+                        [NumericField('alternates_count', sortable=True)])
                 except Exception:
                     pass
                 return None
@@ -0,0 +1,73 @@
+import asyncio
+from typing import Awaitable, Callable
+
+from loggate import get_logger
+from redis.exceptions import LockError
+
+from libs.redis_manager import RedisManager
+
+logger = get_logger('SingleFlight')
+
+
+class SingleFlightException(Exception): pass    # noqa
+
+
+class SingleFlight:
+    """
+    Only one call of the same key runs at the same time in the whole cluster.
+    The callers in this process wait for the result of the running call,
+    the callers of the other processes wait for the Redis lock and then
+    they get the result by the lookup function.
+    """
+
+    def __init__(self, name: str, timeout: int):
+        self.name = name
+        self.timeout = timeout
+        self.flights: dict[str, asyncio.Task] = {}
+
+    def is_running(self, key: str) -> bool:
+        return key in self.flights
+
+    async def run(self, key: str, fce: Callable[[], Awaitable],
+                  lookup: Callable[[], Awaitable] = None):
+        """
+        The call runs in own task, so it is not cancelled
+        when the first caller is gone (e.g. the client closed connection).
+        :param key: str - key of the call (e.g. uuid of the image)
+        :param fce: the call which is run only once
+        :param lookup: the call which returns the result of the call finished
+                       by another process (None = the result does not exist)
+        :return: result of fce or lookup
+        """
+        if not (flight := self.flights.get(key)):
+            flight = asyncio.create_task(self.__run(key, fce, lookup),
+                                         name=f'{self.name}:{key}')
+            self.flights[key] = flight
+            flight.add_done_callback(lambda _: self.__done(key))
+        else:
+            logger.debug(f'Waiting for {self.name}:{key}.')
+        return await asyncio.shield(flight)
+
+    def __done(self, key: str):
+        flight = self.flights.pop(key)
+        if not flight.cancelled() and flight.exception():
+            logger.debug(f'{self.name}:{key} failed: {flight.exception()}')
+
+    async def __run(self, key: str, fce: Callable[[], Awaitable],
+                    lookup: Callable[[], Awaitable] = None):
+        lock = RedisManager.get_lock(f'{self.name}:{key}',
+                                     timeout=self.timeout,
+                                     blocking_timeout=self.timeout)
+        if not await lock.acquire():
+            raise SingleFlightException(
+                f'I can not get the lock {self.name}:{key}.')
+        try:
+            res = await lookup() if lookup else None
+            if res is None:
+                res = await fce()
+            return res
+        finally:
+            try:
+                await lock.release()
+            except LockError:
+                logger.warning(f'The lock {self.name}:{key} expired.')
@@ -0,0 +1,3 @@
+from .base import Storage, StorageStat, StorageException     # noqa
+from .local import LocalStorage     # noqa
+from .s3 import S3Storage       # noqa
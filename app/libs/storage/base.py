@@ -0,0 +1,134 @@
+import abc
+from typing import AsyncIterator, NamedTuple
+
+from config import get_config
+
+STORAGE = get_config('STORAGE')
+CHUNK_SIZE = get_config('CHUNK_SIZE', wrapper=int)
+
+
+class StorageException(Exception): pass     # noqa
+
+
+class StorageStat(NamedTuple):
+    """
+    Attributes of the stored file (compatible with os.stat_result).
+    """
+    st_size: int
+    st_mtime: float
+    st_mtime_ns: int
+
+
+class Storage:
+    """
+    The storage of cached files. The files are addressed by keys - paths
+    relative to the root of the storage (e.g. 'collection/.thumb/a.png').
+        storage = Storage.get()
+        async for data in storage.stream('collection/a.png', 0, 1024):
+            ...
+    The driver is selected by the config STORAGE (local, s3).
+    The libraries which need a file on the disk (PIL, OpenCV, moviepy)
+    use local_copy() and local_output().
+    """
+    DRIVERS: dict[str, type['Storage']] = {}
+    NAME = None
+    # link() shares the stored bytes (the content is stored once)
+    SHARED_LINKS = False
+    instance = None
+
+    @classmethod
+    def __init_subclass__(cls, **kwargs):
+        if cls.NAME:
+            Storage.DRIVERS[cls.NAME] = cls
+
+    @classmethod
+    def get(cls) -> 'Storage':
+        if not Storage.instance:
+            if STORAGE not in Storage.DRIVERS:
+                raise StorageException(f'Unknown storage {STORAGE}.')
+            Storage.instance = Storage.DRIVERS[STORAGE]()
+        return Storage.instance
+
+    def local_path(self, key: str) -> str | None:
+        """
+        The path of the stored file on the local disk.
+        :return: str or None if the storage is not local
+        """
+        return None
+
+    @abc.abstractmethod
+    async def stat(self, key: str) -> StorageStat | None:
+        """
+        :return: StorageStat or None if the file does not exist
+        """
+
+    async def exists(self, key: str) -> bool:
+        return await self.stat(key) is not None
+
+    @abc.abstractmethod
+    def stream(self, key: str, start: int = 0, stop: int = None,
+               chunk: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+        """
+        Read the file (or its range) by chunks.
+        :param key: str
+        :param start: int - the first byte
+        :param stop: int - the byte after the last one (default: end of file)
+        :param chunk: int - max size of chunk
+        """
+
+    async def read(self, key: str) -> bytes:
+        return b''.join([data async for data in self.stream(key)])
+
+    @abc.abstractmethod
+    async def upload(self, key: str, path: str, move: bool = True):
+        """
+        Store the local file.
+        :param key: str
+        :param path: str - the local file
+        :param move: bool - the local file is removed
+        """
+
+    @abc.abstractmethod
+    async def rename(self, src: str, dst: str):
+        pass
+
+    @abc.abstractmethod
+    async def link(self, src: str, dst: str):
+        """
+        The file dst gets the content of src (a hard link on the disk,
+        a server-side copy on the object storage).
+        """
+
+    @abc.abstractmethod
+    async def delete(self, key: str):
+        """
+        Delete the file, the missing file is ignored.
+        """
+
+    @abc.abstractmethod
+    def list(self, prefix: str = '') -> AsyncIterator[str]:
+        """
+        Keys of all files which start with the prefix.
+        """
+
+    async def prune(self, folder: str):
+        """
+        Remove the folder if it is empty (only the storage with folders).
+        """
+
+    @abc.abstractmethod
+    def local_copy(self, key: str):
+        """
+        Async context manager, it provides the stored file as a local file.
+            async with storage.local_copy(key) as path:
+                PilImage.open(path)
+        """
+
+    @abc.abstractmethod
+    def local_output(self, key: str):
+        """
+        Async context manager, it provides the local path where the file
+        has to be written. The file is stored when the context is closed.
+            async with storage.local_output(key) as path:
+                img.save(path)
+        """
@@ -0,0 +1,122 @@
+import contextlib
+import os
+import shutil
+import stat
+
+from aiofile import async_open
+from loggate import get_logger
+
+from config import get_config
+from libs.file_system import FileSystem
+from libs.storage.base import Storage, StorageStat, StorageException, \
+    CHUNK_SIZE
+
+DATA_DIR = get_config('DATA_DIR')
+
+logger = get_logger('LocalStorage')
+
+
+class LocalStorage(Storage):
+    """
+    The files are stored in DATA_DIR. The blocking calls run in
+    the FileSystem thread pool.
+    """
+    NAME = 'local'
+    SHARED_LINKS = True
+
+    def __init__(self, root: str = DATA_DIR):
+        self.root = root
+
+    def local_path(self, key: str) -> str:
+        return f'{self.root}/{key}'
+
+    async def stat(self, key: str) -> StorageStat | None:
+        st = await FileSystem.stat(self.local_path(key))
+        return st if st and stat.S_ISREG(st.st_mode) else None
+
+    async def stream(self, key: str, start: int = 0, stop: int = None,
+                     chunk: int = CHUNK_SIZE):
+        try:
+            fd = await async_open(self.local_path(key), 'rb')
+        except FileNotFoundError:
+            raise StorageException(f'The file {key} does not exist.')
+        try:
+            fd.seek(start)
+            while stop is None or start < stop:
+                data = await fd.read(
+                    chunk if stop is None else min(chunk, stop - start))
+                if not data:
+                    break
+                start += len(data)
+                yield data
+        finally:
+            await fd.close()
+
+    async def upload(self, key: str, path: str, move: bool = True):
+        dst = self.local_path(key)
+        if os.path.abspath(path) == os.path.abspath(dst):
+            return
+        await FileSystem.mkdir(os.path.dirname(dst))
+        if move:
+            await FileSystem.replace(path, dst)
+        else:
+            await FileSystem.run(shutil.copyfile, path, dst)
+
+    async def rename(self, src: str, dst: str):
+        dst = self.local_path(dst)
+        await FileSystem.mkdir(os.path.dirname(dst))
+        await FileSystem.rename(self.local_path(src), dst)
+
+    async def link(self, src: str, dst: str):
+        await FileSystem.run(self.__link, self.local_path(src),
+                             self.local_path(dst))
+
+    @staticmethod
+    def __link(src: str, dst: str):
+        if os.path.exists(dst):
+            if os.path.samefile(src, dst):
+                return
+            tmp = f'{dst}.link'
+            os.link(src, tmp)
+            os.replace(tmp, dst)
+        else:
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            os.link(src, dst)
+
+    async def delete(self, key: str):
+        await FileSystem.unlink(self.local_path(key))
+
+    @staticmethod
+    def __walk(root: str) -> list[str]:
+        return [os.path.join(path, it)
+                for path, _, files in os.walk(root) for it in files]
+
+    async def list(self, prefix: str = ''):
+        folder = os.path.dirname(prefix)
+        root = self.local_path(folder) if folder else self.root
+        for path in await FileSystem.run(self.__walk, root):
+            key = os.path.relpath(path, self.root)
+            if key.startswith(prefix):
+                yield key
+
+    async def prune(self, folder: str):
+        folder = self.local_path(folder)
+        t_folder = f'{folder}/.thumb'
+        try:
+            if not await FileSystem.listdir(t_folder):
+                await FileSystem.rmdir(t_folder)
+                await FileSystem.rmdir(folder)
+                logger.info(f"The folder {folder} was empty and "
+                            f"it is deleted.")
+        except Exception:
+            pass
+
+    @contextlib.asynccontextmanager
+    async def local_copy(self, key: str):
+        yield self.local_path(key)
+
+    @contextlib.asynccontextmanager
+    async def local_output(self, key: str):
+        path = self.local_path(key)
+        await FileSystem.mkdir(os.path.dirname(path))
+        yield path
@@ -0,0 +1,269 @@
+import contextlib
+import datetime
+import hashlib
+import hmac
+import mimetypes
+import os
+import tempfile
+from email.utils import parsedate_to_datetime
+from urllib.parse import quote
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+from aiofile import async_open
+from loggate import get_logger
+from yarl import URL
+
+from config import get_config
+from libs.file_system import FileSystem
+from libs.http_client import HttpClient
+from libs.storage.base import Storage, StorageStat, StorageException, \
+    CHUNK_SIZE
+
+DATA_DIR = get_config('DATA_DIR')
+S3_ENDPOINT = get_config('S3_ENDPOINT')
+S3_BUCKET = get_config('S3_BUCKET')
+S3_REGION = get_config('S3_REGION')
+S3_ACCESS_KEY = get_config('S3_ACCESS_KEY')
+S3_SECRET_KEY = get_config('S3_SECRET_KEY')
+S3_PART_SIZE = get_config('S3_PART_SIZE', wrapper=int)
+
+logger = get_logger('S3Storage')
+
+
+def _quote(value: str, safe: str = '-_.~') -> str:
+    return quote(str(value), safe=safe)
+
+
+def _xml_values(body: bytes, tag: str) -> list[str]:
+    """
+    Texts of all elements with the tag (regardless of the namespace).
+    """
+    return [it.text or '' for it in ElementTree.fromstring(body).iter()
+            if it.tag.rsplit('}', 1)[-1] == tag]
+
+
+class S3Storage(Storage):
+    """
+    The files are stored in the bucket of S3-compatible object storage
+    (AWS S3, MinIO, ...). The requests are signed by AWS Signature V4
+    and sent by the shared HttpClient (path-style URLs).
+    The large files are uploaded by parts (multipart upload), the ranges
+    are read by the ranged GET requests.
+    The local copies are temporary files in DATA_DIR/.tmp.
+    """
+    NAME = 's3'
+    MIN_PART_SIZE = 5 * 1024 * 1024
+    UNSIGNED_PAYLOAD = 'UNSIGNED-PAYLOAD'
+
+    def __init__(self, endpoint: str = S3_ENDPOINT, bucket: str = S3_BUCKET,
+                 region: str = S3_REGION, access_key: str = S3_ACCESS_KEY,
+                 secret_key: str = S3_SECRET_KEY,
+                 part_size: int = S3_PART_SIZE):
+        if not endpoint or not bucket:
+            raise StorageException(
+                'The S3 storage requires S3_ENDPOINT and S3_BUCKET.')
+        self.endpoint = endpoint.rstrip('/')
+        self.bucket = bucket
+        self.region = region
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.part_size = max(part_size, self.MIN_PART_SIZE)
+        self.tmp_dir = f'{DATA_DIR}/.tmp'
+
+    def __sign(self, method: str, url: URL, query: str, headers: dict,
+               payload_hash: str) -> dict:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+        scope = f'{amz_date[:8]}/{self.region}/s3/aws4_request'
+        host = url.raw_host if url.is_default_port() \
+            else f'{url.raw_host}:{url.port}'
+        headers = {
+            **{key.lower(): str(val).strip() for key, val in headers.items()},
+            'host': host,
+            'x-amz-date': amz_date,
+            'x-amz-content-sha256': payload_hash
+        }
+        signed_headers = ';'.join(sorted(headers))
+        canonical_request = '\n'.join([
+            method,
+            url.raw_path,
+            query,
+            ''.join(f'{key}:{headers[key]}\n' for key in sorted(headers)),
+            signed_headers,
+            payload_hash
+        ])
+        string_to_sign = '\n'.join([
+            'AWS4-HMAC-SHA256',
+            amz_date,
+            scope,
+            hashlib.sha256(canonical_request.encode()).hexdigest()
+        ])
+        key = f'AWS4{self.secret_key}'.encode()
+        for it in (amz_date[:8], self.region, 's3', 'aws4_request'):
+            key = hmac.new(key, it.encode(), hashlib.sha256).digest()
+        signature = hmac.new(key, string_to_sign.encode(),
+                             hashlib.sha256).hexdigest()
+        headers['authorization'] = (
+            f'AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, '
+            f'SignedHeaders={signed_headers}, Signature={signature}')
+        return headers
+
+    def __request(self, method: str, key: str = '', params: dict = None,
+                  headers: dict = None, data: bytes = None,
+                  payload_hash: str = None):
+        query = '&'.join(f'{_quote(k)}={_quote(v)}'
+                         for k, v in sorted((params or {}).items()))
+        url = f'{self.endpoint}/{self.bucket}'
+        if key:
+            url = f'{url}/{_quote(key, "/-_.~")}'
+        url = URL(f'{url}?{query}' if query else url, encoded=True)
+        if payload_hash is None:
+            payload_hash = hashlib.sha256(data or b'').hexdigest()
+        return HttpClient.get_session().request(
+            method, url, data=data,
+            headers=self.__sign(method, url, query, headers or {},
+                                payload_hash))
+
+    @staticmethod
+    async def __check(response, expected=(200,)) -> bytes:
+        body = await response.read()
+        # Some operations return the error in the body of 200 response.
+        if response.status not in expected or \
+                (body and b'<Error>' in body[:256]):
+            raise StorageException(
+                f'S3 {response.method} {response.url.path} failed '
+                f'({response.status}): {body[:300].decode(errors="replace")}')
+        return body
+
+    async def stat(self, key: str) -> StorageStat | None:
+        async with self.__request('HEAD', key) as response:
+            if response.status == 404:
+                return None
+            await self.__check(response)
+            mtime = 0.0
+            if last_modified := response.headers.get('Last-Modified'):
+                mtime = parsedate_to_datetime(last_modified).timestamp()
+            return StorageStat(
+                int(response.headers.get('Content-Length', 0)),
+                mtime, int(mtime * 1_000_000_000))
+
+    async def stream(self, key: str, start: int = 0, stop: int = None,
+                     chunk: int = CHUNK_SIZE):
+        headers = {}
+        if stop is not None:
+            if stop <= start:
+                return
+            headers['Range'] = f'bytes={start}-{stop - 1}'
+        elif start:
+            headers['Range'] = f'bytes={start}-'
+        async with self.__request('GET', key, headers=headers) as response:
+            if response.status == 404:
+                raise StorageException(f'The file {key} does not exist.')
+            if response.status not in (200, 206):
+                await self.__check(response)
+            async for data in response.content.iter_chunked(chunk):
+                yield data
+
+    async def upload(self, key: str, path: str, move: bool = True):
+        headers = {
+            'Content-Type':
+                mimetypes.guess_type(key)[0] or 'application/octet-stream'
+        }
+        size = (await FileSystem.stat(path)).st_size
+        async with async_open(path, 'rb') as fd:
+            if size <= self.part_size:
+                async with self.__request(
+                        'PUT', key, headers=headers, data=await fd.read(),
+                        payload_hash=self.UNSIGNED_PAYLOAD) as response:
+                    await self.__check(response)
+            else:
+                await self.__multipart_upload(key, fd, headers)
+        if move:
+            await FileSystem.unlink(path)
+
+    async def __multipart_upload(self, key: str, fd, headers: dict):
+        async with self.__request('POST', key, {'uploads': ''},
+                                  headers=headers) as response:
+            upload_id = _xml_values(await self.__check(response),
+                                    'UploadId')[0]
+        try:
+            parts = []
+            while data := await fd.read(self.part_size):
+                params = {'partNumber': len(parts) + 1, 'uploadId': upload_id}
+                async with self.__request(
+                        'PUT', key, params, data=data,
+                        payload_hash=self.UNSIGNED_PAYLOAD) as response:
+                    await self.__check(response)
+                    parts.append(response.headers['ETag'])
+            body = ''.join(
+                f'<Part><PartNumber>{ix}</PartNumber>'
+                f'<ETag>{escape(etag)}</ETag></Part>'
+                for ix, etag in enumerate(parts, 1))
+            body = (f'<CompleteMultipartUpload>{body}'
+                    f'</CompleteMultipartUpload>').encode()
+            async with self.__request('POST', key, {'uploadId': upload_id},
+                                      data=body) as response:
+                await self.__check(response)
+            logger.debug(f'The file {key} was uploaded by {len(parts)} parts.')
+        except BaseException:
+            async with self.__request('DELETE', key,
+                                      {'uploadId': upload_id}) as response:
+                await response.read()
+            raise
+
+    async def rename(self, src: str, dst: str):
+        await self.link(src, dst)
+        await self.delete(src)
+
+    async def link(self, src: str, dst: str):
+        headers = {
+            'x-amz-copy-source': f'/{self.bucket}/{_quote(src, "/-_.~")}'
+        }
+        async with self.__request('PUT', dst, headers=headers) as response:
+            await self.__check(response)
+
+    async def delete(self, key: str):
+        async with self.__request('DELETE', key) as response:
+            await self.__check(response, (200, 204, 404))
+
+    async def list(self, prefix: str = ''):
+        params = {'list-type': 2, 'prefix': prefix}
+        while True:
+            async with self.__request('GET', params=params) as response:
+                body = await self.__check(response)
+            for key in _xml_values(body, 'Key'):
+                yield key
+            token = _xml_values(body, 'NextContinuationToken')
+            if 'true' not in _xml_values(body, 'IsTruncated') or not token:
+                return
+            params['continuation-token'] = token[0]
+
+    async def __make_tmp_file(self, key: str) -> str:
+        await FileSystem.mkdir(self.tmp_dir)
+        # The extension is kept, the libraries detect the format by it.
+        fd, path = await FileSystem.run(
+            tempfile.mkstemp, suffix=os.path.splitext(key)[1],
+            dir=self.tmp_dir)
+        os.close(fd)
+        return path
+
+    @contextlib.asynccontextmanager
+    async def local_copy(self, key: str):
+        path = await self.__make_tmp_file(key)
+        try:
+            async with async_open(path, 'wb') as fd:
+                async for data in self.stream(key):
+                    await fd.write(data)
+            yield path
+        finally:
+            await FileSystem.unlink(path)
+
+    @contextlib.asynccontextmanager
+    async def local_output(self, key: str):
+        path = await self.__make_tmp_file(key)
+        try:
+            yield path
+            await self.upload(key, path)
+        finally:
+            await FileSystem.unlink(path)
@@ -0,0 +1,139 @@
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import AsyncExitStack
+from typing import Callable, Coroutine
+
+from loggate import get_logger
+
+from config import get_config
+from libs.metrics import Metrics
+
+WORKER_PROCESSES = get_config('WORKER_PROCESSES')
+WORKER_LIMITS = get_config('WORKER_LIMITS')
+
+logger = get_logger('WorkerPool')
+
+
+class WorkerPoolException(Exception): pass     # noqa
+
+
+class WorkerPool:
+    """
+    The processes of CPU-bound actions (the supervisor mode of the worker).
+    The supervisor keeps Redis and the queue on its event loop, the actions
+    are run by the spawned processes (every process has got own connections
+    and caches, DESCRIPTOR_CACHE_SIZE is divided among them).
+    The running actions of every kind (e.g. 'image.resize', 'video.resize')
+    are limited by WORKER_LIMITS, e.g. 'video:1,image.find_same_images:2'
+    (the limit 'video' is shared by all video actions).
+    """
+    instance = None
+
+    @classmethod
+    def get(cls) -> 'WorkerPool':
+        return cls.instance
+
+    @staticmethod
+    def get_processes(value=WORKER_PROCESSES) -> int:
+        """
+        :return: int - the number of processes (0 - the supervisor mode
+                 is disabled)
+        """
+        if str(value).strip().lower() == 'auto':
+            return os.cpu_count() or 1
+        return max(int(value or 0), 0)
+
+    @staticmethod
+    def parse_limits(value: str = WORKER_LIMITS) -> dict[str, int]:
+        res = {}
+        for item in (value or '').split(','):
+            if item.strip():
+                name, _, limit = item.partition(':')
+                res[name.strip()] = int(limit)
+        return res
+
+    def __init__(self, processes: int, initializer: Callable = None,
+                 limits: dict[str, int] = None):
+        if self.__class__.instance:
+            raise WorkerPoolException('Multiple instances of WorkerPool')
+        self.processes = processes
+        self.initializer = initializer
+        self.executor = self.__create_executor()
+        self.limits = {name: asyncio.Semaphore(limit)
+                       for name, limit in sorted((limits or {}).items())}
+        self.running: set[asyncio.Task] = set()
+        self.closing = False
+        self.__class__.instance = self
+
+    def __create_executor(self) -> ProcessPoolExecutor:
+        # The processes are spawned, they do not inherit the connections
+        # and the event loop of the supervisor.
+        return ProcessPoolExecutor(
+            self.processes, mp_context=multiprocessing.get_context('spawn'),
+            initializer=self.initializer)
+
+    def __semaphores(self, kind: str) -> list[asyncio.Semaphore]:
+        return [sem for name, sem in self.limits.items()
+                if kind == name or kind.startswith(f'{name}.')]
+
+    async def run(self, kind: str, fce: Callable, *args,
+                  slot: asyncio.Semaphore = None):
+        """
+        Run the function in a process of the pool, it waits for the limits
+        of this kind.
+        :param kind: the kind of the action (e.g. 'image.resize')
+        :param fce: the picklable function (module level)
+        :param slot: the acquired slot of the caller, it is released while
+                     the action waits for the limits (the other kinds can
+                     use it)
+        """
+        async with AsyncExitStack() as stack:
+            semaphores = self.__semaphores(kind)
+            released = slot and any(sem.locked() for sem in semaphores)
+            if released:
+                slot.release()
+            try:
+                for sem in semaphores:
+                    await stack.enter_async_context(sem)
+            finally:
+                if released:
+                    await slot.acquire()
+            executor = self.executor
+            start = time.monotonic()
+            try:
+                return await asyncio.get_running_loop().run_in_executor(
+                    executor, fce, *args)
+            except BrokenProcessPool:
+                # A process was killed (e.g. OOM), the next tasks get
+                # the new processes.
+                if executor is self.executor and not self.closing:
+                    logger.error('The process pool is broken, restarting.')
+                    self.executor = self.__create_executor()
+                raise
+            finally:
+                Metrics.observe(f'pool.{kind}', time.monotonic() - start)
+
+    def submit(self, coro: Coroutine) -> asyncio.Task:
+        """
+        Run the coroutine (e.g. with WorkerPool.run) in the background,
+        it is waited for by close().
+        """
+        task = asyncio.create_task(coro)
+        self.running.add(task)
+        task.add_done_callback(self.running.discard)
+        return task
+
+    async def close(self):
+        """
+        Wait for the running tasks and stop the processes.
+        """
+        self.closing = True
+        while self.running:
+            logger.info(f'Waiting for {len(self.running)} running tasks.')
+            await asyncio.gather(*list(self.running), return_exceptions=True)
+        await asyncio.get_running_loop().run_in_executor(
+            None, self.executor.shutdown)
@@ -1,15 +1,23 @@
+import asyncio
+import hmac
 import os
 
 from aiohttp import web
 from aiohttp.abc import Request
-from aiohttp.web_response import Response, StreamResponse
+from aiohttp.web_response import Response
 from aiohttp.web_runner import GracefulExit
 from loggate import get_logger, setup_logging
 
 from libs import get_yaml
 from config import get_config
+from libs.http_client import HttpClient
+from libs.download_stream import DownloadStream
+from libs.metrics import Metrics
+from libs.media_response import media_response, storage_response, \
+    stream_response
 from libs.redis_manager import RedisManager
 from libs.socket_manager import SocketManager
+from libs.storage import Storage
 from modules.image_request_parser import ImageRequest
 from modules.plugins import Plugin
 
@@ -17,6 +25,8 @@ logging_profiles = get_yaml(get_config('LOGGING_DEFINITIONS'))
 setup_logging(profiles=logging_profiles)
 
 from config import get_config
+from modules.alternate_index import AlternateIndex
+from modules.blob_store import BlobStore
 from modules.collection import Collection
 from modules.image import Image, ImageDownloadException
 from modules.user_manager import UserManager
@@ -29,6 +39,7 @@ from modules.plugins.yandex import YandexPlugin     # noqa
 
 DATA_DIR = get_config('DATA_DIR')
 HOST_URL = get_config('HOST_URL')
+METRICS_TOKEN = get_config('METRICS_TOKEN')
 
 routes = web.RouteTableDef()
 logger = get_logger('main')
@@ -38,7 +49,13 @@ async def on_startup(app: web.Application):
     try:
         app['redis'] = RedisManager(get_config('REDIS_URI'), app=app)
         await app['redis'].connection()
+        app['http'] = HttpClient()
+        await app['http'].connection()
         await UserManager.create_accounts_by_env(app['redis'])
+        # The listings find the main images by alternates_count, the images
+        # stored before it are counted here (the worker can start later).
+        if not await app['redis'].r.exists(AlternateIndex.COUNTED):
+            await AlternateIndex.count(app['redis'])
     except Exception as ex:
         logger.error(ex)
         raise GracefulExit()
@@ -47,27 +64,24 @@ async def on_startup(app: web.Application):
 
 
 async def on_cleanup(app):
+    if app.get('http'):
+        await app['http'].disconnect()
     if app.get('redis'):
         await app['redis'].disconnect()
 
 
 @routes.get("/favicon.ico")
 async def favicon(request: Request) -> Response:
-    with open('static/favicon.ico', 'rb') as favicon_file:
-        favicon = favicon_file.read()
-    return web.Response(body=favicon, content_type='image/x-icon')
+    return await media_response(request, 'static/favicon.ico',
+                                content_type='image/x-icon')
 
 
 @routes.get(r"/{path:.*/\.thumb/[^/]+}")
 async def thumb(request: Request) -> Response:
     thumb_filename = request.match_info.get('path')
     logger.debug(f'Open thumb image {thumb_filename}')
-    if os.path.exists(f'{DATA_DIR}/{thumb_filename}'):
-        with open(f'{DATA_DIR}/{thumb_filename}', 'rb') as fd:
-            image_data = fd.read()
-        response = web.Response(
-            body=image_data
-        )
+    if await Storage.get().exists(thumb_filename):
+        response = await storage_response(request, thumb_filename)
     else:
         db = request.app["redis"]
         irp = ImageRequest(request=request)
@@ -94,40 +108,85 @@ async def index(request: Request):
     return web.FileResponse('static/index.html')
 
 
+@routes.get('/_metrics')
+async def metrics(request: Request) -> Response:
+    # The metrics expose the hosts and the processes of workers, they are
+    # disabled without METRICS_TOKEN.
+    if not METRICS_TOKEN:
+        raise web.HTTPNotFound()
+    token = request.query.get('token') or request.headers.get(
+        'Authorization', '').removeprefix('Bearer ')
+    if not hmac.compare_digest(token.encode(), METRICS_TOKEN.encode()):
+        raise web.HTTPForbidden()
+    return web.json_response({
+        'main': Metrics.snapshot(),
+        'workers': await Metrics.get_published(request.app['redis'])
+    })
+
+
+@routes.get(r'/_blobs/{digest:[0-9a-f]{64}}')
+async def blob(request: Request) -> Response:
+    """
+    The file by SHA-256 of its content. The url is content-addressed,
+    so the response is cached as immutable.
+    """
+    db = request.app['redis']
+    digest = request.match_info['digest']
+    for ref in await BlobStore.get_refs(db, digest):
+        img = await Image.get(ImageRequest(uuid=ref), db=db)
+        if img and img.sha256 == digest and img.filename:
+            return await storage_response(
+                request, img.filename, content_type=img.content_type,
+                etag_key=digest, immutable=True)
+    return Response(text="The file was not found.", status=404)
+
+
 @routes.get("/{path:.+}")
 async def root(request: Request) -> Response:
     db = request.app["redis"]
     irp = ImageRequest(request=request)
     img = await Image.get(irp, db=request.app["redis"])
-    if irp.url:
-        if img and not irp.was_uuid_generated:
+    is_ui = request.query.get('ui', False) or request.query.get('webui', False)
+    if irp.url and (not img or not irp.was_uuid_generated):
+        parent = None
+        if img:
             logger.info(
                 f"Downloading alternate image {irp.url} ({irp.uuid}) as "
                 f"alternate image for {img.filename}.")
-            try:
-                irp.update_uuid()
-                irp.parent_uuid = img.uuid
-                a_img = await Image.download(
-                    irp,
-                    parent=img,
-                    user_agent=request.headers.get('User-Agent'))
-                await a_img.save(db)
-                await a_img.make_thumb(db)
-                await img.move_to_own_subfolder(db)
-                img = a_img
-            except ImageDownloadException as ex:
-                return Response(text=str(ex), status=500)
-        elif not img:
+            irp.update_uuid()
+            irp.parent_uuid = img.uuid
+            parent = img
+        else:
             logger.info(
                 f"Downloading image {irp.url} ({irp.uuid}) to collection"
                 f" {irp.collection}.")
+        flight = asyncio.ensure_future(Image.fetch(
+            irp, db,
+            parent=parent,
+            user_agent=request.headers.get('User-Agent')))
+        stream = None
+        if not is_ui:
+            stream = await DownloadStream.wait(irp.full_uuid, flight)
+        if stream:
+            # The client gets the data while they are being downloaded.
+            response = await stream_response(
+                request, stream,
+                content_type=stream.owner.content_type,
+                filename=os.path.basename(stream.owner.filename))
             try:
-                img = await Image.download(irp, user_agent=request.headers.get(
-                    'User-Agent'))
-                await img.save(db)
-                await img.make_thumb(db)
-            except ImageDownloadException as ex:
-                return Response(text=str(ex), status=500)
+                img = await flight
+            except Exception as ex:
+                logger.error(f'Download of {irp.url} failed: {ex}')
+                return response
+            await Plugin.run(
+                Plugin.EVENT_OPEN_IMAGE,
+                {'img': img, 'db': db, 'url': irp.url}
+            )
+            return response
+        try:
+            img = await flight
+        except ImageDownloadException as ex:
+            return Response(text=str(ex), status=500)
     if not img:
         return Response(text="The image was not found.", status=404)
     else:
@@ -137,24 +196,12 @@ async def root(request: Request) -> Response:
         )
     if request.headers.get('Referer', ''):
         logger.debug('Referer: %s', request.headers.get('Referer', ''))
-    if request.query.get('ui', False) or request.query.get('webui', False):
-            # or request.headers.get('Referer', '').startswith(HOST_URL)):
+    if is_ui:
         return web.FileResponse('static/index.html')
-    response = StreamResponse()
-    response.content_type = img.content_type
-    response.content_length = img.size
-    response.headers[
-        'Content-Disposition'] = (f'inline; filename="'
-                                  f'{os.path.basename(img.filename)}"')
-    await response.prepare(request)
-    try:
-        async for data in img.get_content_chunks():
-            await response.write(data)
-        await response.write_eof()
-    except ConnectionResetError as exc:
-        logger.warning('StreamWriter patched to suppress '
-                       'ConnectionResetError\'s')
-    return response
+    return await storage_response(request, img.filename,
+                                  content_type=img.content_type,
+                                  filename=os.path.basename(img.filename),
+                                  etag_key=img.uuid)
 
 
 async def on_prepare(request, response):
@@ -2,19 +2,24 @@ import asyncio
 import datetime
 import json
 import math
-import os.path
-import pickle
-from pathlib import Path
 
 import cv2
 import imageio
+import numpy as np
 from loggate import get_logger
 
 from config import get_config
 from libs.redis_manager import RedisManager
+from libs.storage import Storage
 from modules.actions import Action, ImageActionException
+from modules.batch_matcher import BatchMatcher
+from modules.blob_store import BlobStore
 from modules.collection import Collection
+from modules.descriptor_cache import DescriptorCache
+from modules.descriptor_index import DescriptorIndex
+from modules.descriptor_store import DescriptorStore
 from modules.image import Image, AlternateImage
+from modules.perceptual_hash import PerceptualHash
 from PIL import Image as PilImage
 
 from modules.image_task import ImageTask
@@ -30,13 +35,14 @@ class ImageActions(Action):
     @classmethod
     async def update_metadata(cls, image: Image, db: RedisManager,
                               **kwargs) -> Image:
-        if not image.is_file_exist:
+        if not await image.file_exists():
             logger.error(f"I can not update metadata, the image "
-                         f"{image.full_path} does not exist.")
+                         f"{image.filename} does not exist.")
             return False
         if not image.width or not image.height:
-            with PilImage.open(image.full_path) as img:
-                image.width, image.height = img.size
+            async with Storage.get().local_copy(image.filename) as path:
+                with PilImage.open(path) as img:
+                    image.width, image.height = img.size
         await image.save(db)
         return True
 
@@ -45,7 +51,6 @@ class ImageActions(Action):
         if not image.width or not image.height:
             await cls.update_metadata(image, db)
         a_image = AlternateImage.create_from_image(image, **kwargs)
-        a_image.make_folder()
         a_image.width, a_image.height = \
             cls.calculation_size(image.width, image.height,
                                  int(kwargs.get('width', 0)),
@@ -54,35 +59,43 @@ class ImageActions(Action):
             raise ImageActionException(
                 'Resizing requires width and height parameter.')
 
-        with PilImage.open(image.full_path) as img:
-            if image.content_type == 'image/gif':
-                n_frames = img.n_frames
-                fps = img.info.get('duration', 100)
-                # if img.mode != 'RGB':
-                #     img = img.convert('RGB')
-                resized_frames = []
-                for frame_number in range(n_frames):
-                    img.seek(frame_number)
-                    resized_frame = img.resize((a_image.width, a_image.height))
-                    resized_frames.append(resized_frame)
-
-                # self.thumb_image = f'{self.uuid}/thumb.{ext}'
-                resized_frames[0].save(
-                    a_image.full_path,
-                    save_all=True,
-                    append_images=resized_frames[1:],
-                    duration=int(fps),
-                    loop=img.info['loop']
-                )
-            else:
-                if img.mode != 'RGB':
-                    img = img.convert('RGB')
-                img.resize((a_image.width, a_image.height)).save(
-                    a_image.full_path)
+        storage = Storage.get()
+        async with storage.local_copy(image.filename) as src, \
+                storage.local_output(a_image.filename) as dst:
+            with PilImage.open(src) as img:
+                if image.content_type == 'image/gif':
+                    n_frames = img.n_frames
+                    fps = img.info.get('duration', 100)
+                    # if img.mode != 'RGB':
+                    #     img = img.convert('RGB')
+                    resized_frames = []
+                    for frame_number in range(n_frames):
+                        img.seek(frame_number)
+                        resized_frame = img.resize(
+                            (a_image.width, a_image.height))
+                        resized_frames.append(resized_frame)
+
+                    # self.thumb_image = f'{self.uuid}/thumb.{ext}'
+                    resized_frames[0].save(
+                        dst,
+                        save_all=True,
+                        append_images=resized_frames[1:],
+                        duration=int(fps),
+                        loop=img.info['loop']
+                    )
+                    resized = resized_frames[0]
+                else:
+                    if img.mode != 'RGB':
+                        img = img.convert('RGB')
+                    resized = img.resize((a_image.width, a_image.height))
+                    resized.save(dst)
+                if kwargs.get('thumb'):
+                    hashes = PerceptualHash.compute(resized)
         logger.info(
             f"The image {image.filename} was resized "
             f"({a_image.width}x{a_image.height}) to {a_image.filename}")
         if kwargs.get('thumb'):
+            await PerceptualHash.add(db, image.uuid.split(':').pop(), hashes)
             image.thumb_created = datetime.datetime.now().timestamp()
             await image.save(db)
             task = ImageTask(
@@ -101,9 +114,11 @@ class ImageActions(Action):
         #
         for image in images:
             imgO = Image(**image)
-            if not imgO.is_file_exist:
+            if not await imgO.file_exists():
                 continue
-            img = PilImage.open(imgO.full_thumb_image_path)
+            async with Storage.get().local_copy(imgO.thumb_filename) as path:
+                img = PilImage.open(path)
+                img.load()
             # n_frames = getattr(img, 'n_frames', 0)
             if img.mode != 'RGB':
                 img = img.convert('RGB')
@@ -126,46 +141,83 @@ class ImageActions(Action):
                         f"{len(res)} pictures.")
             collection.thumb_file = (f'{collection.name}/.thumb/'
                                      f'{collection.name}.gif')
-            Path(os.path.dirname(collection.full_thumb_image_path)).mkdir(
-                parents=True, exist_ok=True)
             # gif = PilImage.new("RGBA", (max_width, max_height), (0, 0, 0, 0))
-            res[0].save(collection.full_thumb_image_path, save_all=True,
-                        append_images=res[1:], duration=2000, loop=0,
-                        disposal=2)
+            async with Storage.get().local_output(
+                    collection.thumb_file) as path:
+                res[0].save(path, save_all=True,
+                            append_images=res[1:], duration=2000, loop=0,
+                            disposal=2)
             collection.thumb_created = datetime.datetime.now().timestamp()
         await collection.save(db)
         return True
 
     @classmethod
-    async def __search_in_cache(cls, uuid, original_desc, db):
+    async def __search_in_cache(cls, uuid, original_desc, db, vector=None,
+                                candidates=()):
         len_original = len(original_desc)
-        index_params = dict(algorithm=0, trees=5)
-        search_params = dict()
-        uuids = {}
-        flann = cv2.FlannBasedMatcher(index_params, search_params)
-        # for uuid2, desc_2 in cls.DESCRIPTIONS.items():
-        for key in await db.r.keys('matrix:*'):
-            uuid2 = key.replace('matrix:', '')
-            if uuid2 == uuid:
-                continue
-            len_keys = int(await db.r.hget(key, 'number_keys'))
-            if len_keys > 10 * len_original or len_keys < len_original / 10:
-                continue
-            desc2 = await db.r.execute_command('HGET', key, 'descriptions',
-                                               NEVER_DECODE=True)
-            desc_2 = pickle.loads(desc2)
-            matches = flann.knnMatch(original_desc, desc_2, k=2)
-            len_desc2 = len(desc_2)
-            del desc_2
-            good_points = []
-            for m, n in matches:
-                if m.distance < 0.6 * n.distance:
-                    good_points.append(m)
-            len_key_points = min(len_original, len_desc2)
-            percent = round(len(good_points) / len_key_points, 4) * 100
-            if percent > 40:
-                uuids[uuid2] = percent
-        return uuids
+        if vector is not None:
+            # Only the shortlist of the index is verified
+            found = await DescriptorIndex.search(db, vector, exclude=uuid)
+        else:
+            found = await DescriptorStore.get_images(db)
+        candidates = [it for it in dict.fromkeys([*candidates, *found])
+                      if it != uuid]
+        # The images with very different number of keys are skipped
+        len_keys = await DescriptorCache.get_counts(db, candidates)
+        fits = (len_keys >= 2) & (len_keys <= 10 * len_original) & \
+            (len_keys >= len_original / 10)
+        candidates = [it for it, ok in zip(candidates, fits) if ok]
+        descs = await DescriptorCache.get_many(db, candidates)
+        candidates = [it for it in candidates
+                      if it in descs and len(descs[it]) >= 2]
+        if not candidates:
+            return {}
+        descs = [descs[it] for it in candidates]
+        good_points = await asyncio.get_running_loop().run_in_executor(
+            None, BatchMatcher.ratio_test, original_desc, descs)
+        len_key_points = np.minimum(len_original, [len(it) for it in descs])
+        percents = np.round(good_points / len_key_points, 4) * 100
+        return {uuid2: float(percent)
+                for uuid2, percent in zip(candidates, percents)
+                if percent > 40}
+
+    @classmethod
+    async def __find_exact_duplicate(cls, uuid, image, db) -> bool:
+        """
+        The image with the same content (SHA-256) was already analyzed,
+        its matrix is reused without any CV work.
+        """
+        for ref in await BlobStore.get_refs(db, image.sha256):
+            if await cls.__copy_matrix(uuid, ref, db, 100.0):
+                logger.info(f'The Image {image.uuid} is the exact duplicate '
+                            f'of {ref}.')
+                return True
+        return False
+
+    @classmethod
+    async def __copy_matrix(cls, uuid, ref, db, percent: float) -> bool:
+        """
+        Reuse the matrix of the duplicate image.
+        """
+        if ref == uuid or not await db.r.exists(f'matrix:{ref}'):
+            return False
+        await db.r.copy(f'matrix:{ref}', f'matrix:{uuid}', replace=True)
+        await DescriptorStore.add_image(db.r, uuid)
+        # The relation is symmetric
+        await cls.__add_similar(db, uuid, ref, percent)
+        await cls.__add_similar(db, ref, uuid, percent)
+        if await db.r.hexists(f'matrix:{uuid}', 'vector'):
+            await DescriptorIndex.add(db, uuid)
+        return True
+
+    @staticmethod
+    async def __add_similar(db, uuid, other, percent: float):
+        similar_images_uuids = json.loads(await db.r.hget(
+            f'matrix:{uuid}', 'similar_images_uuids') or '{}')
+        similar_images_uuids.pop(uuid, None)
+        similar_images_uuids[other] = percent
+        await db.r.hset(f'matrix:{uuid}', 'similar_images_uuids',
+                        json.dumps(similar_images_uuids))
 
     @staticmethod
     def __serialize_key_points(key_points):
@@ -187,26 +239,44 @@ class ImageActions(Action):
     async def find_same_images(cls, image, db: RedisManager, **kwargs):
         try:
             uuid = image.uuid.split(':').pop()
+            if image.sha256 and \
+                    await cls.__find_exact_duplicate(uuid, image, db):
+                return True
+            hashes = await PerceptualHash.get(db, uuid)
             sift = cv2.SIFT_create()
-            if image.content_type.endswith('gif'):
-                gif_reader = imageio.get_reader(image.full_thumb_image_path)
-                max_points = (-1, 0)
-                counter = 0
-                for frame in gif_reader:
-                    # We try to find the frame with the most keys
-                    counter += 1
-                    key_points = sift.detectAndCompute(frame, None)
-                    if len(key_points) > max_points[1]:
-                        max_points = (counter, len(key_points))
-                img = cv2.cvtColor(gif_reader.get_data(max_points[0]),
-                                   cv2.COLOR_BGR2GRAY)
-                key_points, desc = sift.detectAndCompute(img, None)
-                del gif_reader
-            else:
-                img = cv2.imread(image.full_thumb_image_path,
-                                 cv2.IMREAD_GRAYSCALE)
-                key_points, desc = sift.detectAndCompute(img, None)
-                del img
+            async with Storage.get().local_copy(
+                    image.thumb_filename) as thumb_path:
+                if not hashes:
+                    # The thumb was made before the hashes existed
+                    with PilImage.open(thumb_path) as img:
+                        hashes = PerceptualHash.compute(img)
+                    await PerceptualHash.add(db, uuid, hashes)
+                duplicates, candidates = await PerceptualHash.find(
+                    db, uuid, hashes)
+                for ref, dist in duplicates:
+                    if await cls.__copy_matrix(
+                            uuid, ref, db, round(100 * (1 - dist / 64), 2)):
+                        logger.info(f'The Image {image.uuid} is the near '
+                                    f'duplicate of {ref} (pHash).')
+                        return True
+                if image.content_type.endswith('gif'):
+                    gif_reader = imageio.get_reader(thumb_path)
+                    max_points = (-1, 0)
+                    counter = 0
+                    for frame in gif_reader:
+                        # We try to find the frame with the most keys
+                        counter += 1
+                        key_points = sift.detectAndCompute(frame, None)
+                        if len(key_points) > max_points[1]:
+                            max_points = (counter, len(key_points))
+                    img = cv2.cvtColor(gif_reader.get_data(max_points[0]),
+                                       cv2.COLOR_BGR2GRAY)
+                    key_points, desc = sift.detectAndCompute(img, None)
+                    del gif_reader
+                else:
+                    img = cv2.imread(thumb_path, cv2.IMREAD_GRAYSCALE)
+                    key_points, desc = sift.detectAndCompute(img, None)
+                    del img
             len_keys = len(key_points)
             if len_keys < 50:
                 logger.warning(
@@ -216,7 +286,9 @@ class ImageActions(Action):
                 logger.error(
                     f'Image {image.uuid} has got different number keys '
                     f'({len_keys}) and desc ({len(desc)})')
-            similar_images_uuids = await cls.__search_in_cache(uuid, desc, db)
+            vector = await DescriptorIndex.get_vector(db, desc)
+            similar_images_uuids = await cls.__search_in_cache(
+                uuid, desc, db, vector, [it for it, _ in candidates])
             # cls.DESCRIPTIONS[uuid] = desc
             if similar_images_uuids:
                 logger.info(
@@ -226,11 +298,15 @@ class ImageActions(Action):
             #     print(f'The Image {image.uuid} has got no good match')
             await db.r.hset(f'matrix:{uuid}', mapping={
                 'number_keys': len_keys,
-                'key_points': pickle.dumps(
+                'key_points': DescriptorStore.encode_key_points(
                     cls.__serialize_key_points(key_points)),
-                'descriptions': pickle.dumps(desc),
-                'similar_images_uuids': json.dumps(similar_images_uuids)
+                'descriptions': DescriptorStore.encode(desc),
+                'similar_images_uuids': json.dumps(similar_images_uuids),
+                **({'vector': vector.tobytes()} if vector is not None else {})
             })
+            await DescriptorStore.add_image(db.r, uuid)
+            if vector is not None:
+                await DescriptorIndex.add(db, uuid)
             await asyncio.sleep(.1)
             return True
         except Exception as ex:
@@ -7,6 +7,7 @@ from moviepy.video.io.VideoFileClip import VideoFileClip
 from moviepy.video.fx import resize as fx_resize
 from config import get_config
 from libs.redis_manager import RedisManager
+from libs.storage import Storage
 from modules.actions import Action, ImageActionException
 from modules.image import Image, AlternateImage
 
@@ -20,14 +21,15 @@ class VideoActions(Action):
     @classmethod
     async def update_metadata(cls, image: Image, db: RedisManager,
                               **kwargs) -> Image:
-        if not image.is_file_exist:
+        if not await image.file_exists():
             logger.error(
                 f"I can not update metadata, the image "
-                f"{image.full_path} does not exist.")
+                f"{image.filename} does not exist.")
             return
-        video = VideoFileClip(image.full_path)
-        image.width, image.height = video.size
-        video.close()
+        async with Storage.get().local_copy(image.filename) as path:
+            video = VideoFileClip(path)
+            image.width, image.height = video.size
+            video.close()
         await image.save(db)
         return True
 
@@ -38,7 +40,6 @@ class VideoActions(Action):
         if kwargs.get('thumb') and not kwargs.get('format'):
             kwargs['format'] = 'gif'
         a_image = AlternateImage.create_from_image(image, **kwargs)
-        a_image.make_folder()
         a_image.width, a_image.height = \
             cls.calculation_size(image.width, image.height,
                                  int(kwargs.get('width', 0)),
@@ -48,14 +49,17 @@ class VideoActions(Action):
             raise ImageActionException(
                 'Resizing requires width and height parameter.')
 
-        video_clip = VideoFileClip(image.full_path)
-        gif_clip = video_clip.subclip(0, 5) \
-            .fx(fx_resize.resize, (a_image.width, a_image.height))
-        logger.info(
-            f"The video {image.filename} was resized "
-            f"({a_image.width}x{a_image.height}) to {a_image.filename}")
-        gif_clip.write_gif(a_image.full_path)
-        video_clip.close()
+        storage = Storage.get()
+        async with storage.local_copy(image.filename) as src, \
+                storage.local_output(a_image.filename) as dst:
+            video_clip = VideoFileClip(src)
+            gif_clip = video_clip.subclip(0, 5) \
+                .fx(fx_resize.resize, (a_image.width, a_image.height))
+            logger.info(
+                f"The video {image.filename} was resized "
+                f"({a_image.width}x{a_image.height}) to {a_image.filename}")
+            gif_clip.write_gif(dst)
+            video_clip.close()
         if kwargs.get('thumb'):
             image.thumb_created = datetime.datetime.now().timestamp()
             image.thumb_file = a_image.filename
@@ -0,0 +1,116 @@
+from loggate import get_logger
+
+from libs.redis_manager import RedisManager
+
+logger = get_logger('AlternateIndex')
+
+# KEYS[1] - alternates:<parent uuid>, KEYS[2] - images:<parent uuid>:@
+SYNC_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    return 0
+end
+local newest = redis.call('ZREVRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+redis.call('HSET', KEYS[2], 'alternates_count', redis.call('ZCARD', KEYS[1]))
+if newest[2] then
+    redis.call('HSET', KEYS[2], 'alternate_created', newest[2])
+else
+    redis.call('HDEL', KEYS[2], 'alternate_created')
+end
+return 1
+"""
+
+
+class AlternateIndex:
+    """
+    Secondary indexes of alternate images, they replace KEYS scans
+    of the whole keyspace.
+        alternates:<parent uuid> - sorted set: child uuid (score: created)
+        alternate_parents - hash: child uuid -> parent uuid
+    The indexes are updated by the same pipeline (transaction) which
+    changes the images.
+    The main image hash keeps the number of its alternates
+    (alternates_count) and the creation time of the newest alternate
+    (alternate_created). Only main images have alternates_count, so the
+    listings find them by '@alternates_count:[0 +inf]'.
+    """
+    PARENTS = 'alternate_parents'
+    COUNTED = 'alternate_counts'
+    FIELDS = ('alternates_count', 'alternate_created')
+    __sync = None
+
+    @classmethod
+    async def sync(cls, pipe, parent: str):
+        """
+        Update the counters of alternates on the main image.
+        """
+        if not cls.__sync:
+            cls.__sync = RedisManager.get().r.register_script(SYNC_SCRIPT)
+        await cls.__sync(keys=[f'alternates:{parent}', f'images:{parent}:@'],
+                         client=pipe)
+
+    @classmethod
+    async def add(cls, pipe, parent: str, child: str, created=None):
+        await pipe.zadd(f'alternates:{parent}', {child: float(created or 0)})
+        await pipe.hset(cls.PARENTS, child, parent)
+        # The image could be the main image before
+        await pipe.hdel(f'images:{parent}:{child}', *cls.FIELDS)
+        await cls.sync(pipe, parent)
+
+    @classmethod
+    async def remove(cls, pipe, parent: str, child: str):
+        await pipe.zrem(f'alternates:{parent}', child)
+        await pipe.hdel(cls.PARENTS, child)
+        await cls.sync(pipe, parent)
+
+    @classmethod
+    async def get_children(cls, db: RedisManager, parent: str) -> list[str]:
+        """
+        :return: list - uuids of alternates sorted by the creation time
+        """
+        return await db.r.zrange(f'alternates:{parent}', 0, -1)
+
+    @classmethod
+    async def get_children_of(cls, db: RedisManager,
+                              parents: list[str]) -> list[list[str]]:
+        """
+        Uuids of alternates of more images (one pipeline).
+        """
+        async with db.r.pipeline(transaction=False) as pipe:
+            for parent in parents:
+                pipe.zrange(f'alternates:{parent}', 0, -1)
+            return await pipe.execute()
+
+    @classmethod
+    async def get_parent(cls, db: RedisManager, child: str) -> str | None:
+        return await db.r.hget(cls.PARENTS, child)
+
+    @classmethod
+    async def rebuild(cls, db: RedisManager):
+        """
+        Index the alternates of stored images (the images created before
+        the index existed).
+        """
+        counter = 0
+        async for key in db.r.scan_iter(match='images:*', count=1000):
+            _, parent, child = key.split(':', 2)
+            if child == '@':
+                continue
+            created = await db.r.hget(key, 'created')
+            async with db.r.pipeline(transaction=True) as pipe:
+                await cls.add(pipe, parent, child, created)
+                await pipe.execute()
+            counter += 1
+        logger.info(f'The alternate index was rebuilt ({counter} images).')
+
+    @classmethod
+    async def count(cls, db: RedisManager):
+        """
+        Set the counters of alternates on all stored main images (the web
+        and the worker run it on startup until COUNTED exists).
+        """
+        counter = 0
+        async for key in db.r.scan_iter(match='images:*:@', count=1000):
+            await cls.sync(db.r, key.split(':')[1])
+            counter += 1
+        await db.r.set(cls.COUNTED, 1)
+        logger.info(f'The alternates of {counter} images were counted.')
@@ -0,0 +1,58 @@
+import numpy as np
+
+
+class BatchMatcher:
+    """
+    The ratio test of one image against many candidates. The descriptors
+    of candidates are stacked to blocks (BLOCK_CELLS distances) and every
+    block is one matrix multiplication (BLAS); the nearest and the second
+    nearest descriptor of every candidate are found by numpy reductions.
+    """
+    RATIO = .6
+    BLOCK_CELLS = 1 << 24  # 64 MiB of float32 distances
+
+    @classmethod
+    def ratio_test(cls, query: np.ndarray,
+                   candidates: list[np.ndarray]) -> np.ndarray:
+        """
+        :param query: descriptors of the image
+        :param candidates: descriptors of candidates (at least 2 rows)
+        :return: numpy.ndarray - the number of good matches of every candidate
+        """
+        query = np.asarray(query, np.float32)
+        query_norms = np.einsum('ij,ij->i', query, query)[:, None]
+        max_cols = max(cls.BLOCK_CELLS // max(len(query), 1), 1)
+        res = np.zeros(len(candidates), np.int64)
+        start = 0
+        while start < len(candidates):
+            end, cols = start + 1, len(candidates[start])
+            while end < len(candidates) and \
+                    cols + len(candidates[end]) <= max_cols:
+                cols += len(candidates[end])
+                end += 1
+            res[start:end] = cls.__block(query, query_norms,
+                                         candidates[start:end])
+            start = end
+        return res
+
+    @classmethod
+    def __block(cls, query: np.ndarray, query_norms: np.ndarray,
+                candidates: list[np.ndarray]) -> np.ndarray:
+        block = np.vstack(candidates).astype(np.float32, copy=False)
+        lengths = np.array([len(it) for it in candidates])
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        # The squared distances |q|^2 - 2 q.b + |b|^2 (query x block)
+        dist = query @ block.T
+        dist *= -2
+        dist += query_norms
+        dist += np.einsum('ij,ij->i', block, block)
+        np.maximum(dist, 0, out=dist)
+        first = np.minimum.reduceat(dist, starts, axis=1)
+        nearest = dist == first[:, np.repeat(np.arange(len(lengths)),
+                                             lengths)]
+        ties = np.add.reduceat(nearest, starts, axis=1, dtype=np.int32) > 1
+        dist[nearest] = np.inf
+        second = np.where(ties, first,
+                          np.minimum.reduceat(dist, starts, axis=1))
+        # |m| < RATIO * |n| of the squared distances
+        return (first < cls.RATIO ** 2 * second).sum(axis=0)
@@ -0,0 +1,73 @@
+from loggate import get_logger
+
+from libs.redis_manager import RedisManager
+from libs.storage import Storage, StorageException
+
+logger = get_logger('BlobStore')
+
+
+class BlobStore:
+    """
+    Content-addressed storage of the downloaded files.
+    Every content is stored only once (.blobs/ab/cd/<sha256>), the filenames
+    of images are hard links to the blob. Redis keeps the references (uuids
+    of images) of every blob in the set blobs:<sha256>.
+    The storage without shared links (S3, the link is a server-side copy)
+    stores no blobs, only the references are kept (the exact duplicates
+    are still found by them).
+    """
+    DIR = '.blobs'
+
+    @classmethod
+    def blob_key(cls, digest: str) -> str:
+        return f'{cls.DIR}/{digest[:2]}/{digest[2:4]}/{digest}'
+
+    @classmethod
+    async def get_refs(cls, db: RedisManager, digest: str) -> set:
+        return await db.r.smembers(f'blobs:{digest}')
+
+    @classmethod
+    async def add(cls, db: RedisManager, digest: str, ref: str,
+                  key: str) -> set:
+        """
+        Store the file to the blob store. If the same content is already
+        stored, the file is replaced by the link to the stored blob.
+        :param db: RedisManager
+        :param digest: str - SHA-256 of the file
+        :param ref: str - uuid of the image
+        :param key: str - key of the file in the storage
+        :return: set - uuids of other images with the same content
+        """
+        storage = Storage.get()
+        blob = cls.blob_key(digest)
+        try:
+            if storage.SHARED_LINKS and await storage.exists(blob):
+                await storage.link(blob, key)
+            elif storage.SHARED_LINKS:
+                await storage.link(key, blob)
+        except (OSError, StorageException) as ex:
+            # e.g. the filesystem does not support hard links
+            logger.warning(f'The file {key} is not deduplicated: {ex}')
+            return set()
+        async with db.r.pipeline(transaction=True) as pipe:
+            pipe.smembers(f'blobs:{digest}')
+            pipe.sadd(f'blobs:{digest}', ref)
+            refs, _ = await pipe.execute()
+        refs.discard(ref)
+        if refs:
+            logger.info(f'The file {key} has the same content as {refs}.')
+        return refs
+
+    @classmethod
+    async def release(cls, db: RedisManager, digest: str, ref: str):
+        """
+        Remove the reference of the blob, the blob without references
+        is deleted.
+        """
+        async with db.r.pipeline(transaction=True) as pipe:
+            pipe.srem(f'blobs:{digest}', ref)
+            pipe.scard(f'blobs:{digest}')
+            _, count = await pipe.execute()
+        if count == 0 and Storage.get().SHARED_LINKS:
+            await Storage.get().delete(cls.blob_key(digest))
+            logger.info(f'The blob {digest} was deleted.')
@@ -1,37 +1,59 @@
-import os
-from collections import OrderedDict
+import time
 
 from redis.commands.search.query import Query
 
 from config import get_config
 from libs.redis_manager import RedisManager
+from libs.storage import Storage
+from modules.collection_stats import CollectionStats
 
 THUMB_HEIGHT = get_config('THUMB_HEIGHT', wrapper=int)
 THUMB_WIDTH = get_config('THUMB_WIDTH', wrapper=int)
 DATA_DIR = get_config('DATA_DIR')
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+COLLECTION_LIST_CACHE_TTL = get_config('COLLECTION_LIST_CACHE_TTL',
+                                       wrapper=float)
 
 
 class CollectionException(Exception): pass      # noqa
 
 
 class Collection:
+    # The fields of images in the lists (the grid and the detail panel)
+    LIST_FIELDS = ('title', 'filename', 'thumb_file', 'thumb_created',
+                   'width', 'height', 'size', 'content_type', 'created',
+                   'collection', 'url', 'original_uuid', 'state', 'duration',
+                   'bitrate_kbps', 'reddit_score', 'alternates_count',
+                   'alternate_created')
 
     @staticmethod
     def get_uuid_from_link(link):
         _, uuid, cuuid = link.split(':', 2)
         return f'{uuid}:{cuuid}' if cuuid != '@' else uuid
 
+    # (expiration, the list of collections)
+    __list_cache = (0, None)
+
     @classmethod
     async def get_collections(cls, *, db: RedisManager, **kwargs):
+        """
+        The list of collections with their counters. The list is cached
+        for COLLECTION_LIST_CACHE_TTL seconds (every open UI requests it).
+        """
+        expiration, result = cls.__list_cache
+        if result is not None and expiration > time.monotonic():
+            return result
         result = []
-        for it in await db.ix_images.tagvals('collection'):
-            if it != '@':
-                # if data := await db.r.hgetall(f'collections:{it}'):
-                # TODO: add private collection
-                res = await db.ix_images.search(
-                    Query(f'@collection:{{{it}}}').no_content())
-                if res.total > 0:
-                    result.append({'name': it, 'num_member': res.total})
+        for name, stats in sorted(
+                (await CollectionStats.get_all(db)).items()):
+            # TODO: add private collection
+            if name != '@' and stats['members'] > 0:
+                result.append({'name': name, 'num_member': stats['members'],
+                               **stats})
+        if COLLECTION_LIST_CACHE_TTL > 0:
+            cls.__list_cache = (
+                time.monotonic() + COLLECTION_LIST_CACHE_TTL, result)
         return result
 
     @classmethod
@@ -67,8 +89,8 @@ class Collection:
 
     async def make_thumb(self, db: RedisManager, force=False):
         from modules.image_task import ImageTask
-        if not self.full_thumb_image_path or not os.path.exists(
-                self.full_thumb_image_path) or force:
+        if force or not self.thumb_file or \
+                not await Storage.get().exists(self.thumb_file):
             task2 = ImageTask().set_action(
                 collection=self.name,
                 cmd='make_gif_from_images',
@@ -78,38 +100,61 @@ class Collection:
             )
             await task2.save(db)
 
-    async def get_members(self, db, offset: int = 0, num: int = 10000,
-                          get_alternates: bool = False):
-        if num < 0:
-            num = 10000
-        members = OrderedDict()
+    @staticmethod
+    def parse_cursor(cursor: str = None) -> tuple[float | None, set]:
+        """
+        :param cursor: str - '<created>:<uuid>,<uuid>...' (the creation time
+                       of the last image and uuids of already returned images
+                       with this creation time)
+        """
+        if not cursor:
+            return None, set()
+        try:
+            created, uuids = cursor.split(':', 1)
+            return float(created), set(filter(None, uuids.split(',')))
+        except ValueError:
+            raise CollectionException(f'Invalid cursor: {cursor}')
+
+    async def get_members(self, db: RedisManager, num: int = 100,
+                          cursor: str = None) -> tuple[list, str | None]:
+        """
+        The main images of the collection sorted by the creation time
+        (the newest first). The pages are given by the cursor (created + uuid),
+        so they are stable when images are added or removed.
+        :param num: int - the number of images
+        :param cursor: str - the cursor of the previous page
+        :return: (images, the cursor of the next page or None)
+        """
+        num = min(num if num > 0 else PAGE_SIZE, MAX_PAGE_SIZE)
+        created, seen = self.parse_cursor(cursor)
         _name = self.name.replace("@", '\\@')
-        query = (Query(f'@collection:{{{_name}}}')
-                 .sort_by('created', False)
-                 .paging(offset, min(num, 10000)))
-        for it in (await db.ix_images.search(query)).docs:
+        # Only main images have alternates_count
+        query = f'@collection:{{{_name}}} @alternates_count:[0 +inf]'
+        if created is not None:
+            query = f'{query} @created:[-inf {created!r}]'
+        # The images with the creation time of the cursor are returned again
+        size = num + len(seen)
+        res = await db.ix_images.search(
+            Query(query)
+            .sort_by('created', False)
+            .return_fields(*self.LIST_FIELDS)
+            .paging(0, size))
+        members = []
+        for it in res.docs:
             data = it.__dict__
             data.pop('payload')
             data['uuid'] = self.get_uuid_from_link(data.pop('id'))
-            rr = data['uuid'].split(':')
-            main = rr.pop(0)
-            if len(rr) == 0:
-                data['alternates_count'] = len(members.get(main, [])) + 1
-            if main not in members:
-                members[main] = [data]
-            else:
-                if not rr:
-                    # This is main picture
-                    members[main].insert(0, data)
-                else:
-                    # Alternates
-                    if 'alternates_count' in members[main][0]:
-                        members[main][0]['alternates_count'] += 1
-                    members[main].append(data)
-        if get_alternates:
-            return list(members.values())
-        else:
-            return [it[0] for it in members.values()]
+            if data['uuid'] in seen:
+                continue
+            data['alternates_count'] = int(data.get('alternates_count') or 0)
+            _created = float(data.get('created') or 0)
+            if _created != created:
+                created, seen = _created, set()
+            seen.add(data['uuid'])
+            members.append(data)
+        if len(res.docs) < size:
+            return members, None
+        return members, f'{created!r}:{",".join(sorted(seen))}'
 
     async def save(self, db: RedisManager, pipe=None):
         if not pipe:
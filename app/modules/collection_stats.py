@@ -0,0 +1,164 @@
+from loggate import get_logger
+
+from libs.redis_manager import RedisManager
+
+logger = get_logger('CollectionStats')
+
+# KEYS[1] - stats:images, KEYS[2] - collection_stats,
+# KEYS[3] - collection_created, KEYS[4] - collection_names
+# ARGV[1] - uuid of the image
+# ARGV[2] - the new entry 'collection\tmain\tsize\tcreated' ('' - deleted)
+UPDATE_SCRIPT = """
+local function apply(entry, sign)
+    local coll, main, size, created = string.match(
+        entry, '^(.*)\\t(%d)\\t(%d+)\\t(.*)$')
+    local field = coll .. '\\t'
+    local members = redis.call('HINCRBY', KEYS[2], field .. 'members', sign)
+    if main == '1' then
+        redis.call('HINCRBY', KEYS[2], field .. 'main_images', sign)
+    else
+        redis.call('HINCRBY', KEYS[2], field .. 'alternates', sign)
+    end
+    redis.call('HINCRBY', KEYS[2], field .. 'size', sign * tonumber(size))
+    local member = created ~= '' and field .. string.format(
+        '%020.6f', tonumber(created)) .. '\\t' .. ARGV[1]
+    if sign > 0 then
+        redis.call('SADD', KEYS[4], coll)
+        if member then
+            redis.call('ZADD', KEYS[3], 0, member)
+        end
+    else
+        if member then
+            redis.call('ZREM', KEYS[3], member)
+        end
+        if members <= 0 then
+            redis.call('HDEL', KEYS[2], field .. 'members',
+                       field .. 'main_images', field .. 'alternates',
+                       field .. 'size')
+            redis.call('SREM', KEYS[4], coll)
+        end
+    end
+end
+local old = redis.call('HGET', KEYS[1], ARGV[1])
+if old == ARGV[2] then
+    return 0
+end
+if old then
+    apply(old, -1)
+end
+if ARGV[2] ~= '' then
+    apply(ARGV[2], 1)
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+else
+    redis.call('HDEL', KEYS[1], ARGV[1])
+end
+return 1
+"""
+
+# KEYS[1] - collection_stats, KEYS[2] - collection_created,
+# KEYS[3] - collection_names
+LIST_SCRIPT = """
+local res = {}
+for _, coll in ipairs(redis.call('SMEMBERS', KEYS[3])) do
+    local field = coll .. '\\t'
+    local newest = redis.call('ZREVRANGEBYLEX', KEYS[2], '(' .. coll ..
+                              '\\n', '(' .. field, 'LIMIT', 0, 1)
+    table.insert(res, {coll,
+                       redis.call('HMGET', KEYS[1], field .. 'members',
+                                  field .. 'main_images',
+                                  field .. 'alternates', field .. 'size'),
+                       newest[1] and string.match(newest[1],
+                                                  '\\t([^\\t]*)\\t') or ''})
+end
+return res
+"""
+
+
+class CollectionStats:
+    """
+    Counters of collections maintained incrementally by every change
+    of an image record.
+        stats:images - hash: uuid of the image -> the counted entry
+        collection_stats - hash: <name>\t<counter> -> value, the counters
+                           are members, main_images, alternates and
+                           size (bytes)
+        collection_created - sorted set (by lex): <name>\t<created>\t<uuid>
+        collection_names - set of non-empty collections
+    The script subtracts the previously counted entry of the image and
+    adds the new one, so repeated updates are harmless. The keys do not
+    depend on the collection, so the scripts declare all of them.
+    """
+    KEY = 'stats:images'
+    STATS = 'collection_stats'
+    CREATED = 'collection_created'
+    NAMES = 'collection_names'
+    COUNTERS = ('members', 'main_images', 'alternates', 'size')
+    __update = None
+    __list = None
+
+    @classmethod
+    def __scripts(cls):
+        if not cls.__update:
+            r = RedisManager.get().r
+            cls.__update = r.register_script(UPDATE_SCRIPT)
+            cls.__list = r.register_script(LIST_SCRIPT)
+        return cls.__update, cls.__list
+
+    @staticmethod
+    def entry(uuid: str, collection: str, size=0, created=None) -> str:
+        main = '0' if ':' in uuid else '1'
+        return f'{collection or "@"}\t{main}\t{int(size or 0)}\t' \
+               f'{created or ""}'
+
+    @classmethod
+    async def update(cls, pipe, uuid: str, collection: str, size=0,
+                     created=None):
+        """
+        Count the image record.
+        :param pipe: Redis or pipeline
+        :param uuid: str - uuid of the record (parent:child for alternates)
+        """
+        await cls.__scripts()[0](
+            keys=[cls.KEY, cls.STATS, cls.CREATED, cls.NAMES],
+            args=[uuid, cls.entry(uuid, collection, size, created)],
+            client=pipe)
+
+    @classmethod
+    async def remove(cls, pipe, uuid: str):
+        await cls.__scripts()[0](
+            keys=[cls.KEY, cls.STATS, cls.CREATED, cls.NAMES],
+            args=[uuid, ''], client=pipe)
+
+    @classmethod
+    async def get_all(cls, db: RedisManager) -> dict[str, dict]:
+        """
+        Counters of all collections (one round trip).
+        :return: dict - name -> {members, main_images, alternates, size,
+                                 last_created}
+        """
+        res = {}
+        for name, counters, newest in await cls.__scripts()[1](
+                keys=[cls.STATS, cls.CREATED, cls.NAMES], args=[],
+                client=db.r):
+            stats = {key: int(val or 0)
+                     for key, val in zip(cls.COUNTERS, counters)}
+            stats['last_created'] = float(newest) if newest else None
+            res[name] = stats
+        return res
+
+    @classmethod
+    async def rebuild(cls, db: RedisManager):
+        """
+        Count the stored images (the images created before the counters
+        existed).
+        """
+        counter = 0
+        async for key in db.r.scan_iter(match='images:*', count=1000):
+            _, parent, child = key.split(':', 2)
+            uuid = parent if child == '@' else f'{parent}:{child}'
+            collection, size, created = await db.r.hmget(
+                key, 'collection', 'size', 'created')
+            await cls.update(db.r, uuid, collection, size, created)
+            counter += 1
+        logger.info(f'The statistics of collections were rebuilt '
+                    f'({counter} images).')
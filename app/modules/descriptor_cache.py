@@ -0,0 +1,177 @@
+from collections import OrderedDict
+
+import numpy as np
+from loggate import get_logger
+
+from config import get_config
+from libs.metrics import Metrics
+from libs.redis_manager import RedisManager
+from modules.descriptor_store import DescriptorStore
+
+DESCRIPTOR_CACHE_SIZE = get_config('DESCRIPTOR_CACHE_SIZE', wrapper=int)
+
+logger = get_logger('DescriptorCache')
+
+
+class DescriptorCache:
+    """
+    The descriptors of images in the memory of the worker (LRU bounded
+    by DESCRIPTOR_CACHE_SIZE MiB, the processes of the supervisor mode
+    get its share). The matrices are kept in the stored type (uint8),
+    every change of matrix:<uuid> (keyspace notification) evicts the image.
+    The numbers of descriptors (number_keys) of analyzed images are kept
+    up to MAX_COUNTS images (the oldest are dropped), the images which are
+    not analyzed yet are not cached.
+    """
+    MAX_COUNTS = 100_000
+    items: OrderedDict[str, np.ndarray] = OrderedDict()
+    counts: OrderedDict[str, int] = OrderedDict()
+    size = 0
+    max_size = DESCRIPTOR_CACHE_SIZE * 1024 * 1024
+    # It is increased by every invalidation, the descriptors loaded during
+    # an invalidation could be old and they are not cached.
+    version = 0
+
+    @classmethod
+    def __put(cls, uuid: str, desc: np.ndarray):
+        cls.discard(uuid)
+        cls.items[uuid] = desc
+        cls.__put_count(uuid, len(desc))
+        cls.size += desc.nbytes
+        while cls.size > cls.max_size and cls.items:
+            _, old = cls.items.popitem(last=False)
+            cls.size -= old.nbytes
+            Metrics.inc('descriptors.evict')
+
+    @classmethod
+    def __put_count(cls, uuid: str, count: int):
+        if not count:
+            return
+        cls.counts[uuid] = count
+        cls.counts.move_to_end(uuid)
+        while len(cls.counts) > cls.MAX_COUNTS:
+            cls.counts.popitem(last=False)
+
+    @classmethod
+    def discard(cls, uuid: str):
+        if (desc := cls.items.pop(uuid, None)) is not None:
+            cls.size -= desc.nbytes
+
+    @classmethod
+    def invalidate(cls, uuid: str):
+        cls.version += 1
+        cls.discard(uuid)
+        cls.counts.pop(uuid, None)
+
+    @classmethod
+    async def get(cls, db: RedisManager, uuid: str,
+                  dtype=np.float32) -> np.ndarray | None:
+        """
+        :return: the descriptors of the image or None (not analyzed)
+        """
+        if (desc := cls.items.get(uuid)) is not None:
+            cls.items.move_to_end(uuid)
+            Metrics.inc('descriptors.hit')
+        else:
+            Metrics.inc('descriptors.miss')
+            version = cls.version
+            desc = await DescriptorStore.get(db, uuid, dtype=None)
+            if desc is None:
+                return None
+            if version == cls.version:
+                cls.__put(uuid, desc)
+        return desc if dtype is None else desc.astype(dtype, copy=False)
+
+    @classmethod
+    async def get_counts(cls, db: RedisManager, uuids: list) -> np.ndarray:
+        """
+        :return: numpy.ndarray - the numbers of descriptors of images
+                 (0 - not analyzed)
+        """
+        # The known counts are taken first, the new ones can evict them
+        counts = {it: cls.counts[it] for it in uuids if it in cls.counts}
+        if missing := [it for it in uuids if it not in counts]:
+            version = cls.version
+            async with db.r.pipeline(transaction=False) as pipe:
+                for uuid in missing:
+                    pipe.hget(f'matrix:{uuid}', 'number_keys')
+                rows = await pipe.execute()
+            for uuid, count in zip(missing, rows):
+                counts[uuid] = int(count or 0)
+                if version == cls.version:
+                    cls.__put_count(uuid, counts[uuid])
+        return np.array([counts[it] for it in uuids], np.int64)
+
+    @classmethod
+    async def get_many(cls, db: RedisManager, uuids: list,
+                       dtype=np.float32) -> dict:
+        """
+        The missing descriptors are loaded by one pipeline.
+        :return: dict - uuid -> descriptors (the analyzed images)
+        """
+        res = {}
+        missing = []
+        for uuid in uuids:
+            if (desc := cls.items.get(uuid)) is not None:
+                cls.items.move_to_end(uuid)
+                res[uuid] = desc
+            else:
+                missing.append(uuid)
+        Metrics.inc('descriptors.hit', len(res))
+        if missing:
+            Metrics.inc('descriptors.miss', len(missing))
+            version = cls.version
+            async with db.r.pipeline(transaction=False) as pipe:
+                for uuid in missing:
+                    pipe.execute_command('HGET', f'matrix:{uuid}',
+                                         'descriptions', NEVER_DECODE=True)
+                rows = await pipe.execute()
+            for uuid, data in zip(missing, rows):
+                if (desc := DescriptorStore.decode(data, dtype=None)) is None:
+                    continue
+                res[uuid] = desc
+                if version == cls.version:
+                    cls.__put(uuid, desc)
+        if dtype is None:
+            return res
+        return {uuid: desc.astype(dtype, copy=False)
+                for uuid, desc in res.items()}
+
+    @classmethod
+    async def warm(cls, db: RedisManager):
+        """
+        Load the descriptors of stored images until the cache is full.
+        """
+        keys = []
+        async for key in db.r.scan_iter(match='matrix:*', count=1000):
+            keys.append(key)
+            if len(keys) == 100:
+                if not await cls.__load(db, keys):
+                    break
+                keys = []
+        if keys:
+            await cls.__load(db, keys)
+        logger.info(f'The cache has got descriptors of {len(cls.items)} '
+                    f'images ({cls.size // (1024 * 1024)} MiB).')
+
+    @classmethod
+    async def __load(cls, db: RedisManager, keys: list[str]) -> bool:
+        """
+        :return: bool - the cache is not full
+        """
+        version = cls.version
+        async with db.r.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.execute_command('HGET', key, 'descriptions',
+                                     NEVER_DECODE=True)
+            rows = await pipe.execute()
+        if version != cls.version:
+            return True
+        for key, data in zip(keys, rows):
+            desc = DescriptorStore.decode(data, dtype=None)
+            if desc is None:
+                continue
+            if cls.size + desc.nbytes > cls.max_size:
+                return False
+            cls.__put(key.split(':', 1)[1], desc)
+        return True
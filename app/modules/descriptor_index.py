@@ -0,0 +1,244 @@
+import asyncio
+import time
+
+import cv2
+import numpy as np
+from loggate import get_logger
+from redis.exceptions import LockError
+
+from config import get_config
+from libs.redis_manager import RedisManager
+from modules.descriptor_store import DescriptorStore
+from modules.similarity_keys import SimilarityKeys
+
+ANN_WORDS = get_config('ANN_WORDS', wrapper=int)
+ANN_MIN_IMAGES = get_config('ANN_MIN_IMAGES', wrapper=int)
+ANN_SHORTLIST = get_config('ANN_SHORTLIST', wrapper=int)
+
+logger = get_logger('DescriptorIndex')
+
+# KEYS[1] - ann:images, KEYS[2] - ann:seq, ARGV[1] - uuid of the image
+ADD_SCRIPT = """
+local seq = redis.call('INCR', KEYS[2])
+redis.call('ZADD', KEYS[1], seq, ARGV[1])
+return seq
+"""
+
+
+class DescriptorIndex:
+    """
+    Approximate nearest neighbour search of similar images. Every image
+    is described by one vector - the normalized histogram of visual words
+    of its SIFT descriptors (the vocabulary is k-means of the descriptors
+    of stored images, it is trained once when there are ANN_MIN_IMAGES,
+    the untrained index is checked again after RETRY_INTERVAL).
+        ann:vocabulary - the vocabulary (DescriptorStore format)
+        ann:images - sorted set: uuid (score: the sequence number of adding)
+        ann:seq - the sequence
+        matrix:<uuid> vector - the vector of the image (float32)
+    Every worker keeps FLANN KD-tree of the vectors in memory. The images
+    added later (by any worker) are read by the sequence and compared
+    linearly until the tree is rebuilt, the deleted images are skipped.
+    """
+    VOCABULARY = 'ann:vocabulary'
+    IMAGES = SimilarityKeys.ANN_IMAGES
+    SEQ = 'ann:seq'
+    LOCK = 'ann:lock'
+    SAMPLE = 100  # descriptors of every image for the training
+    MAX_SAMPLE_IMAGES = 2000
+    REBUILD_RATIO = .2
+    RETRY_INTERVAL = 60  # seconds
+    TREE_PARAMS = {'algorithm': 1, 'trees': 4}  # KD-tree
+    SEARCH_PARAMS = {'checks': 64}
+
+    vocabulary: np.ndarray = None
+    tree = None
+    uuids: list[str] = []
+    pending: dict[str, np.ndarray] = {}
+    removed: set[str] = set()
+    seq = 0
+    # The monotonic time of the next check of the untrained index
+    retry_at = 0
+    __add = None
+
+    @classmethod
+    def vector(cls, desc: np.ndarray) -> np.ndarray:
+        """
+        The histogram of visual words (Hellinger normalization).
+        """
+        voc = cls.vocabulary
+        desc = np.asarray(desc, np.float32)
+        # The squared distances without the constant |desc|^2
+        dist = (voc * voc).sum(axis=1) - 2 * desc @ voc.T
+        hist = np.sqrt(np.bincount(dist.argmin(axis=1),
+                                   minlength=len(voc)).astype(np.float32))
+        norm = np.linalg.norm(hist)
+        return hist / norm if norm else hist
+
+    @classmethod
+    async def get_vector(cls, db: RedisManager,
+                         desc: np.ndarray) -> np.ndarray | None:
+        """
+        :return: the vector of descriptors or None (the index is not ready)
+        """
+        if cls.vocabulary is None and time.monotonic() < cls.retry_at:
+            return None
+        if not await cls.load(db) and not await cls.train(db):
+            cls.retry_at = time.monotonic() + cls.RETRY_INTERVAL
+            return None
+        return cls.vector(desc)
+
+    @classmethod
+    async def add(cls, db: RedisManager, uuid: str):
+        """
+        Add the image, its vector has to be already stored.
+        """
+        if not cls.__add:
+            cls.__add = db.r.register_script(ADD_SCRIPT)
+        await cls.__add(keys=[cls.IMAGES, cls.SEQ], args=[uuid])
+
+    @classmethod
+    async def remove(cls, db: RedisManager, uuid: str):
+        cls.removed.add(uuid)
+        cls.pending.pop(uuid, None)
+        await db.r.zrem(cls.IMAGES, uuid)
+
+    @classmethod
+    async def search(cls, db: RedisManager, vector: np.ndarray,
+                     num: int = ANN_SHORTLIST, exclude: str = None) -> list:
+        """
+        :return: list - uuids of the most similar images
+        """
+        await cls.sync(db)
+        found = {}
+        if cls.tree is not None:
+            knn = min(num + len(cls.removed) + 1, len(cls.uuids))
+            indexes, dists = cls.tree.knnSearch(
+                vector.reshape(1, -1), knn, params=cls.SEARCH_PARAMS)
+            for ix, dist in zip(indexes[0], dists[0]):
+                found[cls.uuids[ix]] = float(dist)
+        if cls.pending:
+            vectors = np.vstack(list(cls.pending.values()))
+            # The vectors are normalized: |a - b|^2 = 2 - 2 * a.b
+            for uuid, dist in zip(cls.pending, 2 - 2 * vectors @ vector):
+                found[uuid] = float(dist)
+        return [uuid for uuid in sorted(found, key=found.get)
+                if uuid != exclude and uuid not in cls.removed][:num]
+
+    @classmethod
+    async def load(cls, db: RedisManager) -> bool:
+        """
+        Load the vocabulary and the vectors (first call in the process).
+        :return: bool - the index is ready
+        """
+        if cls.vocabulary is None:
+            data = await db.r.execute_command('GET', cls.VOCABULARY,
+                                              NEVER_DECODE=True)
+            if not data:
+                return False
+            cls.vocabulary = DescriptorStore.decode(data)
+            await cls.rebuild(db)
+        return True
+
+    @classmethod
+    async def __get_vectors(cls, db: RedisManager, uuids: list) -> dict:
+        res = {}
+        async with db.r.pipeline(transaction=False) as pipe:
+            for uuid in uuids:
+                pipe.execute_command('HGET', f'matrix:{uuid}', 'vector',
+                                     NEVER_DECODE=True)
+            for uuid, data in zip(uuids, await pipe.execute()):
+                if data:
+                    res[uuid] = np.frombuffer(data, np.float32)
+        missing = set(uuids) - res.keys()
+        if missing:
+            await db.r.zrem(cls.IMAGES, *missing)
+        return res
+
+    @classmethod
+    async def rebuild(cls, db: RedisManager):
+        """
+        Build the tree of all vectors.
+        """
+        images = await db.r.zrange(cls.IMAGES, 0, -1, withscores=True)
+        vectors = {}
+        for ix in range(0, len(images), 1000):
+            vectors.update(await cls.__get_vectors(
+                db, [uuid for uuid, _ in images[ix:ix + 1000]]))
+        tree = None
+        if vectors:
+            tree = await asyncio.get_running_loop().run_in_executor(
+                None, cv2.flann_Index, np.vstack(list(vectors.values())),
+                cls.TREE_PARAMS)
+        cls.tree, cls.uuids = tree, list(vectors)
+        cls.pending, cls.removed = {}, set()
+        cls.seq = int(images[-1][1]) if images else 0
+        logger.info(f'The index of {len(cls.uuids)} images was built.')
+
+    @classmethod
+    async def sync(cls, db: RedisManager):
+        """
+        Read the images added after the last synchronization.
+        """
+        images = await db.r.zrange(cls.IMAGES, f'({cls.seq}', '+inf',
+                                   byscore=True, withscores=True)
+        if not images:
+            return
+        cls.seq = int(images[-1][1])
+        uuids = [uuid for uuid, _ in images]
+        cls.removed.difference_update(uuids)
+        cls.pending.update(await cls.__get_vectors(db, uuids))
+        if len(cls.pending) > max(cls.REBUILD_RATIO * len(cls.uuids), 100):
+            await cls.rebuild(db)
+
+    @classmethod
+    async def train(cls, db: RedisManager) -> bool:
+        """
+        Train the vocabulary from the descriptors of stored images and index
+        them (only one worker does it).
+        :return: bool - the index is ready
+        """
+        if await DescriptorStore.count_images(db) < ANN_MIN_IMAGES:
+            return False
+        lock = RedisManager.get_lock(cls.LOCK, timeout=600)
+        if not await lock.acquire(blocking=False):
+            return False
+        try:
+            if await cls.load(db):
+                return True
+            uuids = await DescriptorStore.get_images(db)
+            rng = np.random.default_rng()
+            sample = []
+            for uuid in rng.permutation(uuids)[:cls.MAX_SAMPLE_IMAGES]:
+                desc = await DescriptorStore.get(db, uuid)
+                if desc is not None and len(desc):
+                    sample.append(desc[rng.choice(
+                        len(desc), min(cls.SAMPLE, len(desc)), False)])
+            vocabulary = await asyncio.get_running_loop().run_in_executor(
+                None, cls.__kmeans, np.vstack(sample))
+            await db.r.set(cls.VOCABULARY, DescriptorStore.encode(vocabulary))
+            cls.vocabulary = np.asarray(vocabulary, np.float32)
+            for uuid in uuids:
+                desc = await DescriptorStore.get(db, uuid)
+                if desc is not None and len(desc):
+                    await db.r.hset(f'matrix:{uuid}', 'vector',
+                                    cls.vector(desc).tobytes())
+                    await cls.add(db, uuid)
+            logger.info(f'The vocabulary was trained from {len(sample)} '
+                        f'images.')
+            await cls.rebuild(db)
+            return True
+        finally:
+            try:
+                await lock.release()
+            except LockError:
+                # The training took longer than the timeout of the lock
+                logger.warning('The lock of training expired.')
+
+    @staticmethod
+    def __kmeans(data: np.ndarray) -> np.ndarray:
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 1.)
+        _, _, centers = cv2.kmeans(np.ascontiguousarray(data, np.float32),
+                                   min(ANN_WORDS, len(data)), None, criteria,
+                                   1, cv2.KMEANS_PP_CENTERS)
+        return centers
@@ -0,0 +1,177 @@
+import io
+import pickle
+import struct
+
+import numpy as np
+from loggate import get_logger
+
+from libs.redis_manager import RedisManager
+from modules.similarity_keys import SimilarityKeys
+
+logger = get_logger('DescriptorStore')
+
+
+class _LegacyUnpickler(pickle.Unpickler):
+    """
+    The unpickler of the old format, it loads only numpy arrays
+    and the plain containers.
+    """
+    ALLOWED = {
+        ('numpy', 'ndarray'),
+        ('numpy', 'dtype'),
+        ('numpy.core.multiarray', '_reconstruct'),
+        ('numpy.core.multiarray', 'scalar'),
+        ('numpy._core.multiarray', '_reconstruct'),
+        ('numpy._core.multiarray', 'scalar')
+    }
+
+    def find_class(self, module, name):
+        if (module, name) in self.ALLOWED:
+            return super().find_class(module, name)
+        raise pickle.UnpicklingError(f'{module}.{name} is not allowed.')
+
+
+class DescriptorStore:
+    """
+    The SIFT descriptors and keypoints of images (matrix:<uuid> hashes).
+        descriptions - header (magic, dtype, rows, cols) + the raw matrix
+        key_points - header (magic, 0, rows, 0) + packed KEY_POINT_DTYPE
+        matrix_images - set: uuids of images with the descriptors (they
+                        are not found by scans of the keyspace)
+    The matrices are read by numpy.frombuffer without any copy.
+    The descriptors of OpenCV SIFT are whole numbers 0-255, so they are
+    stored as uint8 (4x smaller than float32) when no value is lost.
+    """
+    HEADER = struct.Struct('<4sB3xII')
+    DESC_MAGIC = b'DSC1'
+    KP_MAGIC = b'KPT1'
+    DTYPES = {1: np.dtype(np.uint8), 2: np.dtype('<f4')}
+    KEY_POINT_DTYPE = np.dtype([
+        ('pt', '<f4', 2), ('size', '<f4'), ('angle', '<f4'),
+        ('response', '<f4'), ('octave', '<i4'), ('class_id', '<i4')])
+    MIGRATED = 'descriptors_format'
+    IMAGES = SimilarityKeys.MATRIX_IMAGES
+
+    @classmethod
+    def encode(cls, desc: np.ndarray) -> bytes:
+        desc = np.asarray(desc if desc is not None else [], np.float32)
+        desc = desc.reshape(len(desc), -1) if desc.size else \
+            desc.reshape(0, 0)
+        if desc.size and desc.min() >= 0 and desc.max() <= 255 and \
+                np.array_equal(desc, np.rint(desc)):
+            code = 1
+        else:
+            code = 2
+        data = np.ascontiguousarray(desc, cls.DTYPES[code])
+        return cls.HEADER.pack(cls.DESC_MAGIC, code, *desc.shape) + \
+            data.tobytes()
+
+    @classmethod
+    def decode(cls, data: bytes, dtype=np.float32) -> np.ndarray | None:
+        """
+        :param data: bytes - the stored descriptors
+        :param dtype: the type of the result (None - the stored type,
+                      the float32 storage is never copied)
+        :return: numpy.ndarray (read-only) or None (unknown format)
+        """
+        if not data or len(data) < cls.HEADER.size:
+            return None
+        magic, code, rows, cols = cls.HEADER.unpack_from(data)
+        if magic != cls.DESC_MAGIC or code not in cls.DTYPES:
+            return None
+        desc = np.frombuffer(data, cls.DTYPES[code], rows * cols,
+                             cls.HEADER.size).reshape(rows, cols)
+        return desc if dtype is None else desc.astype(dtype, copy=False)
+
+    @classmethod
+    def encode_key_points(cls, key_points: list[dict]) -> bytes:
+        """
+        :param key_points: list - dicts with attributes of cv2.KeyPoint
+        """
+        data = np.array([(it['pt'], it['size'], it['angle'], it['response'],
+                          it['octave'], it['class_id'])
+                         for it in key_points], cls.KEY_POINT_DTYPE)
+        return cls.HEADER.pack(cls.KP_MAGIC, 0, len(data), 0) + \
+            data.tobytes()
+
+    @classmethod
+    def decode_key_points(cls, data: bytes) -> np.ndarray | None:
+        if not data or len(data) < cls.HEADER.size:
+            return None
+        magic, _, rows, _ = cls.HEADER.unpack_from(data)
+        if magic != cls.KP_MAGIC:
+            return None
+        return np.frombuffer(data, cls.KEY_POINT_DTYPE, rows,
+                             cls.HEADER.size)
+
+    @classmethod
+    async def get(cls, db: RedisManager, uuid: str,
+                  dtype=np.float32) -> np.ndarray | None:
+        return cls.decode(await db.r.execute_command(
+            'HGET', f'matrix:{uuid}', 'descriptions', NEVER_DECODE=True),
+            dtype)
+
+    @classmethod
+    async def add_image(cls, pipe, uuid: str):
+        """
+        :param pipe: Redis or pipeline
+        """
+        await pipe.sadd(cls.IMAGES, uuid)
+
+    @classmethod
+    async def remove_image(cls, pipe, uuid: str):
+        await pipe.srem(cls.IMAGES, uuid)
+
+    @classmethod
+    async def get_images(cls, db: RedisManager) -> list[str]:
+        return list(await db.r.smembers(cls.IMAGES))
+
+    @classmethod
+    async def count_images(cls, db: RedisManager) -> int:
+        return await db.r.scard(cls.IMAGES)
+
+    @classmethod
+    async def rebuild(cls, db: RedisManager):
+        """
+        Index the images with the descriptors (the images analyzed before
+        the index existed).
+        """
+        counter = 0
+        async for key in db.r.scan_iter(match='matrix:*', count=1000):
+            if await db.r.hexists(key, 'descriptions'):
+                await cls.add_image(db.r, key.split(':', 1)[1])
+                counter += 1
+        logger.info(f'The index of descriptors was rebuilt ({counter} '
+                    f'images).')
+
+    @classmethod
+    async def migrate(cls, db: RedisManager):
+        """
+        Convert the pickled descriptors and keypoints to the binary format.
+        """
+        counter = 0
+        async for key in db.r.scan_iter(match='matrix:*', count=1000):
+            desc, key_points = await db.r.execute_command(
+                'HMGET', key, 'descriptions', 'key_points',
+                NEVER_DECODE=True)
+            mapping = {}
+            try:
+                if desc and not desc.startswith(cls.DESC_MAGIC):
+                    mapping['descriptions'] = cls.encode(
+                        cls.__unpickle(desc))
+                if key_points and not key_points.startswith(cls.KP_MAGIC):
+                    mapping['key_points'] = cls.encode_key_points(
+                        cls.__unpickle(key_points))
+            except Exception as ex:
+                logger.warning(f'The descriptors of {key} can not be '
+                               f'converted: {ex}')
+                continue
+            if mapping:
+                await db.r.hset(key, mapping=mapping)
+                counter += 1
+        await db.r.set(cls.MIGRATED, 1)
+        logger.info(f'The descriptors of {counter} images were converted.')
+
+    @staticmethod
+    def __unpickle(data: bytes):
+        return _LegacyUnpickler(io.BytesIO(data)).load()
@@ -0,0 +1,132 @@
+import re
+
+from loggate import get_logger
+
+from libs.redis_manager import RedisManager
+from libs.storage import Storage
+
+logger = get_logger('FilenameIndex')
+
+# KEYS[1] - filenames, KEYS[2] - filenames:seq, KEYS[3] - filenames:free:<base>,
+# ARGV[1] - path/filename.ext (base), ARGV[2] - path/filename, ARGV[3] - .ext,
+# ARGV[4] - owner
+ALLOCATE_SCRIPT = """
+local ix = redis.call('ZPOPMIN', KEYS[3])[1]
+if not ix then
+    ix = redis.call('HINCRBY', KEYS[2], ARGV[1], 1)
+end
+ix = tonumber(ix)
+local name = ARGV[1]
+if ix > 1 then
+    name = ARGV[2] .. '-' .. (ix - 2) .. ARGV[3]
+end
+return {name, redis.call('HSETNX', KEYS[1], name, ARGV[4])}
+"""
+
+# KEYS[1] - filenames, KEYS[2] - filenames:seq, KEYS[3] - filenames:free:<base>,
+# ARGV[1] - the filename, ARGV[2] - base, ARGV[3] - index of the filename
+RELEASE_SCRIPT = """
+redis.call('HDEL', KEYS[1], ARGV[1])
+if tonumber(ARGV[3]) <= tonumber(redis.call('HGET', KEYS[2], ARGV[2]) or 0) then
+    redis.call('ZADD', KEYS[3], ARGV[3], ARGV[3])
+end
+"""
+
+
+class FilenameIndex:
+    """
+    Allocation of unique filenames shared by all processes.
+        filenames - hash: filename -> uuid of the owner (reservation)
+        filenames:seq - hash: requested filename -> number of allocations
+        filenames:free:<requested filename> - sorted set: the released
+                                              indexes of allocations
+    The next suffix (name, name-0, name-1, ...) is given by the counter,
+    the released names are reused first (the lowest index), so the
+    allocation does not probe the names one by one.
+    The saved images update the owners of their filenames, so the hash
+    is also the exact lookup of images by filename.
+    """
+    UNKNOWN_OWNER = '?'
+
+    __allocate = None
+    __release = None
+
+    @classmethod
+    async def allocate(cls, db: RedisManager, path: str, filename: str,
+                       ext: str, owner: str) -> str:
+        """
+        Reserve the unique filename.
+        :param db: RedisManager
+        :param path: str - folder of the file (key in the storage)
+        :param filename: str - requested filename without extension
+        :param ext: str - extension
+        :param owner: str - uuid of the image
+        :return: str - the reserved filename (path/filename[-N].ext)
+        """
+        if not cls.__allocate:
+            cls.__allocate = db.r.register_script(ALLOCATE_SCRIPT)
+        base = f'{path}/{filename}.{ext}'
+        while True:
+            test_name, reserved = await cls.__allocate(
+                keys=['filenames', 'filenames:seq', f'filenames:free:{base}'],
+                args=[base, f'{path}/{filename}', f'.{ext}', owner],
+                client=db.r)
+            if not reserved:
+                continue
+            if not await Storage.get().exists(test_name):
+                return test_name
+            # The file was created before the index
+            await db.r.hset('filenames', test_name, cls.UNKNOWN_OWNER)
+
+    @staticmethod
+    def split(filename: str) -> tuple[str, int]:
+        """
+        :return: (the requested filename, index of the allocation) - e.g.
+                 'a/b-0.png' -> ('a/b.png', 2), 'a/b.png' -> ('a/b.png', 1)
+        """
+        if match := re.fullmatch(r'(.*)-(\d+)(\.[^./]*)', filename):
+            return f'{match[1]}{match[3]}', int(match[2]) + 2
+        return filename, 1
+
+    @classmethod
+    async def release(cls, db: RedisManager, filename: str, pipe=None):
+        """
+        The name is free, it is given by the next allocation of the same
+        requested filename.
+        """
+        if not filename:
+            return
+        if not cls.__release:
+            cls.__release = db.r.register_script(RELEASE_SCRIPT)
+        base, ix = cls.split(filename)
+        await cls.__release(
+            keys=['filenames', 'filenames:seq', f'filenames:free:{base}'],
+            args=[filename, base, ix], client=pipe or db.r)
+
+    @classmethod
+    async def set_owner(cls, pipe, filename: str, owner: str):
+        """
+        :param pipe: Redis or pipeline
+        :param owner: str - uuid of the image (parent:child for alternates)
+        """
+        if filename:
+            await pipe.hset('filenames', filename, owner)
+
+    @classmethod
+    async def get_owner(cls, db: RedisManager, filename: str) -> str:
+        return await db.r.hget('filenames', filename)
+
+    @classmethod
+    async def rebuild(cls, db: RedisManager):
+        """
+        Index the filenames of stored images (the images created before
+        the index existed).
+        """
+        counter = 0
+        async for key in db.r.scan_iter(match='images:*', count=1000):
+            if filename := await db.r.hget(key, 'filename'):
+                _, uuid, cuuid = key.split(':', 2)
+                owner = uuid if cuuid == '@' else f'{uuid}:{cuuid}'
+                await db.r.hset('filenames', filename, owner)
+                counter += 1
+        logger.info(f'The filename index was rebuilt ({counter} files).')
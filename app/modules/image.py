@@ -2,7 +2,6 @@ import asyncio
 import datetime
 import hashlib
 import json
-import time
 import urllib.parse
 
 import os
@@ -10,22 +9,34 @@ import re
 from pathlib import Path
 
 import aiohttp
-from aiofile import async_open
 from loggate import get_logger
 from redis.commands.search.query import Query
 
 from config import get_config
+from libs.download_stream import DownloadStream
+from libs.file_system import FileSystem
 from libs.helper import dict_bytes2str
+from libs.http_client import HttpClient
 from libs.redis_manager import RedisManager
+from libs.single_flight import SingleFlight
+from libs.storage import Storage, StorageException
+from modules.alternate_index import AlternateIndex
+from modules.collection_stats import CollectionStats
+from modules.blob_store import BlobStore
 from modules.collection import Collection
+from modules.filename_index import FilenameIndex
 from modules.image_request_parser import ImageRequest
 from modules.image_task import ImageTask
 from modules.plugins import Plugin
+from modules.similarity_keys import SimilarityKeys
 
 logger = get_logger('image')
 
 DEFAULT_USER_AGENT = get_config('DEFAULT_USER_AGENT')
-DOWNLOAD_TIMEOUT = get_config('DOWNLOAD_TIMEOUT')
+DOWNLOAD_TIMEOUT = get_config('DOWNLOAD_TIMEOUT', wrapper=int)
+DOWNLOAD_LOCK_TIMEOUT = get_config('DOWNLOAD_LOCK_TIMEOUT', wrapper=int)
+DOWNLOAD_RETRIES = get_config('DOWNLOAD_RETRIES', wrapper=int)
+PARTIAL_DOWNLOAD_TTL = get_config('PARTIAL_DOWNLOAD_TTL', wrapper=int)
 CHUNK_SIZE = get_config('CHUNK_SIZE')
 THUMB_HEIGHT = get_config('THUMB_HEIGHT', wrapper=int)
 THUMB_WIDTH = get_config('THUMB_WIDTH', wrapper=int)
@@ -100,6 +111,7 @@ class ParsePath:
 
 class Image:
     DATA_DIR = get_config('DATA_DIR')
+    downloads = SingleFlight('downloads', DOWNLOAD_LOCK_TIMEOUT)
 
     STATE_CREATED = 'created'
     STATE_DOWNLOADED = 'downloaded'
@@ -127,40 +139,56 @@ class Image:
         return None, None
 
     @staticmethod
-    def get_unique_filename(path: str | ParsePath, filename: str = None,
-                            ext: str = None) -> str:
+    async def get_unique_filename(db: RedisManager, owner: str,
+                                  path: str | ParsePath, filename: str = None,
+                                  ext: str = None) -> str:
+        """
+        Reserve the unique filename (name, name-0, name-1, ...) for the image.
+        :param db: RedisManager
+        :param owner: str - uuid of the image
+        :param path: str or ParsePath
+        :param filename: str - without extension
+        :param ext: str
+        :return: str
+        """
         if isinstance(path, ParsePath):
             filename = path.filename
             ext = path.ext
             path = path.get_path(no_filename=True)
-        ix = 0
-        it = ''
-        test_name = f'{path}/{filename}{it}.{ext}'
-        while os.path.exists(f'{Image.DATA_DIR}/{test_name}'):
-            it = f'-{ix}'
-            ix += 1
-            test_name = f'{path}/{filename}{it}.{ext}'
-        return test_name
+        return await FilenameIndex.allocate(db, path, filename, ext, owner)
 
     @classmethod
     async def get(cls, image_request: ImageRequest, db: RedisManager,
                   with_matrix=False):
         if image_request.filename:
+            filename = image_request.full_filename
+            owner = await FilenameIndex.get_owner(db, filename)
+            if owner and owner != FilenameIndex.UNKNOWN_OWNER:
+                link = f'images:{owner}' if ':' in owner \
+                    else f'images:{owner}:@'
+                data = await db.r.hgetall(link)
+                # The reservation of the filename could be stale
+                if data.get('filename') == filename:
+                    data['uuid'] = owner
+                    logger.info(f'Load image {owner}')
+                    return Image(**data)
+            # The images saved before the filenames were indexed
             query = Query(
-                f'@filename:({image_request.full_filename.replace("-", "?")})'
+                f'@filename:({filename.replace("-", "?")})'
             ).dialect(2)
             result = await db.ix_images.search(query)
             if result.total == 0:
                 return None
             data = None
             for it in result.docs:
-                if it.filename == image_request.full_filename:
+                if it.filename == filename:
                     data = it.__dict__
             if not data:
                 return None
             data.pop('payload')  # Default result of search
             data['uuid'] = cls.get_uuid_from_link(data.pop('id'))
             logger.info(f'Load image {data["uuid"]}')
+            await FilenameIndex.set_owner(db.r, filename, data['uuid'])
             # if 'matrix' in data and not with_matrix:
             #     data.pop('matrix')
             data = dict_bytes2str(data)
@@ -168,9 +196,11 @@ class Image:
         elif image_request.uuid:
             data = await db.r.hgetall(image_request.redis_link)
             if not data:
-                keys = await db.r.keys(f'images:*:{image_request.uuid}')
-                if keys:
-                    data = await db.r.hgetall(keys[0])
+                parent = await AlternateIndex.get_parent(db,
+                                                         image_request.uuid)
+                if parent and (data := await db.r.hgetall(
+                        f'images:{parent}:{image_request.uuid}')):
+                    data['uuid'] = f'{parent}:{image_request.uuid}'
                     logger.info(f'Load image {data["uuid"]}')
                 else:
                     # Search by original uuid
@@ -192,6 +222,102 @@ class Image:
         else:
             return None
 
+    @classmethod
+    async def get_many(cls, requests: list[ImageRequest],
+                       db: RedisManager) -> list['Image | None']:
+        """
+        Load more images at once. The images requested by uuid are loaded
+        by one pipeline, the others (and the images found only by
+        the original uuid) by Image.get.
+        :param requests: list of ImageRequest
+        :param db: RedisManager
+        :return: list of Image (None if the image does not exist)
+                 in the order of the requests
+        """
+        res = [None] * len(requests)
+        by_uuid = [ix for ix, it in enumerate(requests)
+                   if it.uuid and not it.filename]
+        async with db.r.pipeline(transaction=False) as pipe:
+            for ix in by_uuid:
+                pipe.hgetall(requests[ix].redis_link)
+            rows = await pipe.execute()
+        missing = []
+        for ix, data in zip(by_uuid, rows):
+            if data:
+                data.setdefault('uuid', requests[ix].full_uuid)
+                res[ix] = Image(**data)
+            else:
+                missing.append(ix)
+        if missing:
+            # Alternates requested by their own uuid
+            parents = await db.r.hmget(AlternateIndex.PARENTS,
+                                       [requests[ix].uuid for ix in missing])
+            found = [(ix, f'{parent}:{requests[ix].uuid}')
+                     for ix, parent in zip(missing, parents) if parent]
+            async with db.r.pipeline(transaction=False) as pipe:
+                for _, uuid in found:
+                    pipe.hgetall(f'images:{uuid}')
+                rows = await pipe.execute()
+            for (ix, uuid), data in zip(found, rows):
+                if data:
+                    res[ix] = Image(**{**data, 'uuid': uuid})
+        for ix, it in enumerate(requests):
+            if res[ix] is None:
+                res[ix] = await cls.get(it, db)
+        return res
+
+    @classmethod
+    async def get_alternates_of(cls, images: list['Image'],
+                                db: RedisManager) -> dict[str, list['Image']]:
+        """
+        Load the alternates of more images by two pipelines.
+        :param images: list of Image
+        :param db: RedisManager
+        :return: dict - uuid of the main image -> list of alternates
+                 (sorted by the creation time)
+        """
+        parents = list(dict.fromkeys(it.uuid_parts[0] for it in images))
+        children = await AlternateIndex.get_children_of(db, parents)
+        uuids = [f'{parent}:{child}'
+                 for parent, items in zip(parents, children)
+                 for child in items]
+        async with db.r.pipeline(transaction=False) as pipe:
+            for uuid in uuids:
+                pipe.hgetall(f'images:{uuid}')
+            rows = await pipe.execute()
+        res = {parent: [] for parent in parents}
+        for uuid, data in zip(uuids, rows):
+            if data:
+                image = Image(**{**data, 'uuid': uuid})
+                res[image.uuid_parts[0]].append(image)
+        return res
+
+    @classmethod
+    async def fetch(cls, image_request: ImageRequest, db: RedisManager,
+                    parent: 'Image' = None, **kwargs) -> 'Image':
+        """
+        Download, save and make thumb of the image. Concurrent requests
+        of the same image (in all processes) share one download.
+        :param image_request: ImageRequest
+        :param db: RedisManager
+        :param parent: Image - the new image is alternate of this image
+        :return: Image
+        """
+        async def download():
+            img = await cls.download(image_request, parent=parent, **kwargs)
+            await img.save(db)
+            await img.make_thumb(db)
+            if parent:
+                await parent.move_to_own_subfolder(db)
+            return img
+
+        async def lookup():
+            return await cls.get(ImageRequest(uuid=image_request.full_uuid),
+                                 db)
+
+        return await cls.downloads.run(image_request.full_uuid, download,
+                                       lookup)
+
     @classmethod
     async def download(cls, image_request: ImageRequest, **kwargs):
         img = Image(
@@ -205,6 +331,119 @@ class Image:
         await img.redownload(user_agent=kwargs.get('user_agent'))
         return img
 
+    async def get_partial_download(self, db: RedisManager, url: str) -> dict:
+        """
+        Return the record of the unfinished download of this image.
+        :param db: RedisManager
+        :param url: str
+        :return: dict (empty if the download can not be resumed)
+        """
+        partial = await db.r.hgetall(f'partials:{self.uuid}')
+        if partial and partial.get('url') == url:
+            part = f'{self.DATA_DIR}/{partial["filename"]}.part'
+            if st := await FileSystem.stat(part):
+                partial['size'] = st.st_size
+                return partial
+        if partial:
+            await db.r.delete(f'partials:{self.uuid}')
+        return {}
+
+    async def save_partial_download(self, db: RedisManager, url: str,
+                                    response) -> dict:
+        """
+        Record the download, so it can be resumed when it is interrupted.
+        Only responses with a strong validator (ETag or Last-Modified)
+        can be resumed by the Range request.
+        :return: dict (empty if the download can not be resumed)
+        """
+        validator = response.headers.get('ETag', '')
+        if not validator or validator.startswith('W/'):
+            validator = response.headers.get('Last-Modified')
+        if not validator or \
+                response.headers.get('Accept-Ranges', 'bytes') == 'none':
+            return {}
+        partial = {
+            'url': url,
+            'filename': self.filename,
+            'validator': validator,
+            'content_type': self.content_type or '',
+            'title': self.title or '',
+            'total': self.size or 0
+        }
+        await db.r.hset(f'partials:{self.uuid}', mapping=partial)
+        await db.r.expire(f'partials:{self.uuid}', PARTIAL_DOWNLOAD_TTL)
+        return partial
+
+    async def __parse_response(self, db: RedisManager, response, url: str,
+                               rewrite: bool):
+        logger.info(response.headers.items())
+        self.content_type = response.headers.get('content-type')
+        if self.content_type and \
+                self.content_type not in SUPPORTED_FORMATS:
+            raise ImageDownloadException(
+                f"The format of the downloading file "
+                f"'{url}' is not supported. "
+                f"(content-type: {self.content_type})")
+        self.size = response.content_length
+        if response.headers.get('content-encoding'):
+            # The content is decoded, the size is not known
+            self.size = 0
+        if not rewrite:
+            filename, ext = self.get_filename_from_url_link(url)
+            know_type = SUPPORTED_EXTS.get(ext, None)
+            if not self.content_type:
+                self.content_type = SUPPORTED_EXTS.get(ext, None)
+            elif know_type != self.content_type:
+                # Fix file extension
+                new_ext = SUPPORTED_FORMATS.get(self.content_type)
+                logger.info(
+                    f"The image has got wrong file "
+                    f"extension {ext} -> {new_ext}")
+                ext = new_ext
+            path = self.collection if self.collection != '@' \
+                else datetime.date.today().year
+            if self._parent:
+                path = ParsePath.parse(self._parent.filename).get_path(
+                    no_ext=True, no_parent=True)
+            self.filename = await self.get_unique_filename(
+                db, self.uuid, path, filename, ext)
+            if not self.title:
+                self.title = re.sub(
+                    r'[_-]', ' ', filename
+                ).capitalize()
+
+    def __resume_response(self, response, partial: dict, offset: int):
+        """
+        Use the partial response (206) of the resumed download.
+        :return: bool - the response continues at the offset
+        """
+        if response.status != 206:
+            return False
+        match = re.match(r'bytes\s+(?P<start>\d+)-\d+/(?P<total>\d+|\*)',
+                         response.headers.get('Content-Range', ''))
+        if not match or int(match.group('start')) != offset:
+            return False
+        self.content_type = partial.get('content_type') or \
+            response.headers.get('content-type')
+        total = match.group('total')
+        self.size = int(total) if total.isdigit() else 0
+        if partial.get('filename'):
+            self.filename = partial['filename']
+        if not self.title:
+            self.title = partial.get('title') or None
+        logger.info(f'The download of {self.url} is resumed '
+                    f'from {offset} bytes.')
+        return True
+
+    async def __drop_partial(self, db: RedisManager, partial: dict):
+        """
+        Release the filename and remove the file of the partial download
+        which is not resumed (the origin sends the whole file again).
+        """
+        await FilenameIndex.release(db, partial['filename'])
+        await FileSystem.unlink(
+            f'{self.DATA_DIR}/{partial["filename"]}.part')
+
     async def redownload(self, **kwargs):
         params = {
             'img': self,
@@ -217,52 +456,75 @@ class Image:
             await Plugin.run(Plugin.EVENT_PARSE_URL, params)
             url = self.url
             rewrite = False
-        async with (aiohttp.ClientSession(
-                connector=aiohttp.TCPConnector(ssl=False)) as session):
-            async with session.get(
-                    url,
-                    headers=params['_headers'],
-                    timeout=aiohttp.ClientTimeout(total=DOWNLOAD_TIMEOUT)
-            ) as response:
-                logger.info(response.headers.items())
-                self.content_type = response.headers.get('content-type')
-                if self.content_type and \
-                        self.content_type not in SUPPORTED_FORMATS:
-                    raise ImageDownloadException(
-                        f"The format of the downloading file "
-                        f"'{url}' is not supported. "
-                        f"(content-type: {self.content_type})")
-                self.size = response.content_length
+        db = RedisManager.get()
+        session = HttpClient.get_session()
+        partial = await self.get_partial_download(db, url)
+        stream: DownloadStream = None
+        attempt = 0
+        while True:
+            offset = stream.size if stream else partial.get('size', 0)
+            headers = dict(params['_headers'])
+            if offset:
+                headers['Range'] = f'bytes={offset}-'
+                headers['If-Range'] = partial['validator']
+            try:
+                async with session.get(
+                        url,
+                        headers=headers,
+                        ssl=False,
+                        timeout=aiohttp.ClientTimeout(total=DOWNLOAD_TIMEOUT)
+                ) as response:
+                    resumed = bool(offset) and self.__resume_response(
+                        response, partial, offset)
+                    if stream and not resumed:
+                        raise ImageDownloadException(
+                            f"The download of '{url}' can not be resumed.")
+                    if not stream:
+                        if not resumed:
+                            if partial and not rewrite:
+                                await self.__drop_partial(db, partial)
+                            await self.__parse_response(db, response, url,
+                                                        rewrite)
+                            partial = await self.save_partial_download(
+                                db, url, response)
+                        await self.make_folder()
+                        stream = await DownloadStream.open(
+                            self.uuid, self.full_path,
+                            total=self.size or None,
+                            owner=self,
+                            offset=offset if resumed else 0,
+                            storage_key=self.filename)
+                    async for data in response.content.iter_any():
+                        await stream.write(data)
+                await stream.finish()
+                break
+            except (asyncio.TimeoutError, aiohttp.ClientPayloadError,
+                    aiohttp.ClientConnectionError) as ex:
+                attempt += 1
+                if stream and partial and attempt <= DOWNLOAD_RETRIES:
+                    logger.warning(f"The download of '{url}' was interrupted "
+                                   f"at {stream.size} bytes ({ex!r}).")
+                    continue
+                if stream:
+                    await stream.fail(ex, keep=bool(partial))
+                if not rewrite and not (stream and partial):
+                    await FilenameIndex.release(db, self.filename)
+                raise ImageDownloadException(
+                    f"The download of '{url}' failed ({ex!r}).")
+            except BaseException as ex:
+                if stream:
+                    await stream.fail(ex)
                 if not rewrite:
-                    filename, ext = self.get_filename_from_url_link(url)
-                    know_type = SUPPORTED_EXTS.get(ext, None)
-                    if not self.content_type:
-                        self.content_type = SUPPORTED_EXTS.get(ext, None)
-                    elif know_type != self.content_type:
-                        # Fix file extension
-                        new_ext = SUPPORTED_FORMATS.get(self.content_type)
-                        logger.info(
-                            f"The image has got wrong file "
-                            f"extension {ext} -> {new_ext}")
-                        ext = new_ext
-                    path = self.collection if self.collection != '@' \
-                        else datetime.date.today().year
-                    if self._parent:
-                        path = ParsePath.parse(self._parent.filename).get_path(
-                            no_ext=True, no_parent=True)
-                    self.filename = self.get_unique_filename(path, filename,
-                                                             ext)
-                    self.make_folder()
-                    if not self.title:
-                        self.title = re.sub(
-                            r'[_-]', ' ', filename
-                        ).capitalize()
-
-                fd = await async_open(self.full_path, 'w+b')
-                async for data in response.content.iter_any():
-                    await fd.write(data)
-                await fd.close()
-                return True
+                    await FilenameIndex.release(db, self.filename)
+                raise
+        await db.r.delete(f'partials:{self.uuid}')
+        await Storage.get().upload(self.filename, self.full_path)
+        self.size = stream.size
+        old_digest, self.sha256 = self.sha256, stream.digest
+        await BlobStore.add(db, self.sha256, self.own_uuid, self.filename)
+        if old_digest and old_digest != self.sha256:
+            await BlobStore.release(db, old_digest, self.own_uuid)
+        return True
 
     def __init__(self, **kwargs):
         self.uuid = None
@@ -280,25 +542,33 @@ class Image:
         self.url = None
         self._parent = None
         self.original_uuid = ''
-        for key in ['width', 'height', 'size']:
+        self.sha256 = None
+        for key in ['width', 'height', 'size', 'alternates_count']:
             if key in kwargs:
                 kwargs[key] = int(kwargs[key])
         self.__dict__.update(kwargs)
 
     @property
     def full_path(self) -> str:
+        """
+        The local path of the file (the downloads are written here before
+        they are stored to the storage).
+        """
         return f'{self.DATA_DIR}/{self.filename}'
 
     @property
-    def full_thumb_image_path(self) -> str:
+    def thumb_filename(self) -> str:
         if self.thumb_file:
-            return f'{DATA_DIR}/{self.thumb_file}'
-        _dir, _file = self.full_path.rsplit('/', 1)
-        return f'{_dir}/.thumb/{_file}'
+            return self.thumb_file
+        return os.path.join(os.path.dirname(self.filename), '.thumb',
+                            os.path.basename(self.filename))
 
     @property
-    def is_file_exist(self) -> bool:
-        return os.path.exists(self.full_path)
+    def full_thumb_image_path(self) -> str:
+        return f'{DATA_DIR}/{self.thumb_filename}'
+
+    async def file_exists(self) -> bool:
+        return await Storage.get().exists(self.filename)
 
     @property
     def data(self):
@@ -313,6 +583,14 @@ class Image:
     def uuid_parts(self):
         return self.uuid.split(':', 1)
 
+    @property
+    def own_uuid(self) -> str:
+        """
+        The uuid of the image without the uuid of the main image.
+        It is not changed when the image is moved to another main image.
+        """
+        return self.uuid.split(':')[-1]
+
     def add_url_reference(self, url):
         self.add_uuid_reference(ImageRequest.make_uuid(url))
 
@@ -325,46 +603,30 @@ class Image:
             hashes.remove(self.uuid)
         self.original_uuid = ';'.join(hashes)
 
-    def make_folder(self):
-        (Path(os.path.dirname(self.full_path))
-         .mkdir(parents=True, exist_ok=True))
-        (Path(os.path.dirname(self.full_thumb_image_path))
-         .mkdir(parents=True, exist_ok=True))
+    async def make_folder(self):
+        await FileSystem.mkdir(os.path.dirname(self.full_path))
 
-    def delete_empty_folders(self, file):
-        folder = os.path.dirname(file)
-        t_folder = f'{folder}/.thumb'
-        try:
-            if not os.listdir(t_folder):
-                Path(t_folder).rmdir()
-                Path(folder).rmdir()
-                logger.info(f"The folder {folder} was empty and "
-                            f"it is deleted.")
-        except Exception:
-            pass
+    async def delete_empty_folders(self, filename):
+        await Storage.get().prune(os.path.dirname(filename))
+
+    async def __rename_files(self, old_filename: str, old_thumb: str):
+        storage = Storage.get()
+        await storage.rename(old_filename, self.filename)
+        await storage.rename(old_thumb, self.thumb_filename)
 
     async def get_all_alternates(self, db: RedisManager) -> ['Image']:
-        uuids = self.uuid.split(':', 1)
-        keys = await db.r.keys(f'images:{uuids[0]}:*')
-        res = []
-        for key in keys:
-            if key[-1] != '@':
-                data = await db.r.hgetall(key)
-                if data:
-                    # TODO: remove after clean up DB
-                    data['uuid'] = ImageRequest(redis_channel=key).full_uuid
-                    res.append(Image(**data))
-        return sorted(res, key=lambda x: x.created)
+        return (await Image.get_alternates_of([self], db))[
+            self.uuid_parts[0]]
 
     async def get_content_chunks(self, chunk=None):
-        if not self.is_file_exist:
+        if not await self.file_exists():
             raise ImageFileMissingException('File missing', code=404)
-        async with async_open(self.full_path, 'rb') as fd:
-            async for data in fd.iter_chunked(chunk or CHUNK_SIZE):
-                yield data
+        async for data in Storage.get().stream(self.filename,
+                                               chunk=chunk or CHUNK_SIZE):
+            yield data
 
     async def make_thumb(self, db: RedisManager, force=False):
-        if not os.path.exists(self.full_thumb_image_path) or force:
+        if force or not await Storage.get().exists(self.thumb_filename):
             logger.info(f"Making thumb image for {self.filename}")
             task = ImageTask().set_action(
                 uuid=self.uuid,
@@ -374,7 +636,7 @@ class Image:
                 thumb=True
             )
             await task.save(db)
-            time.sleep(.5)
+            await asyncio.sleep(.5)
             if self.collection and self.collection != '@':
                 task2 = ImageTask().set_action(
                     collection=self.collection,
@@ -387,11 +649,24 @@ class Image:
 
     async def save(self, db: RedisManager, pipe=None):
         if not pipe:
-            pipe = db.r
+            async with db.r.pipeline(transaction=True) as pipe:
+                await self.save(db, pipe)
+                await pipe.execute()
+            return
         alternate = ':@' if self.is_main_image else ''
         topic = f'images:{self.uuid}{alternate}'
-        await pipe.hset(topic, mapping={k: v for k, v in self.data.items() if
-                                        k != 'uuid'})
+        # The counters of alternates are maintained by AlternateIndex only
+        await pipe.hset(topic, mapping={
+            k: v for k, v in self.data.items()
+            if k != 'uuid' and k not in AlternateIndex.FIELDS})
+        await FilenameIndex.set_owner(pipe, self.filename, self.uuid)
+        if self.is_main_image:
+            await AlternateIndex.sync(pipe, self.uuid)
+        else:
+            await AlternateIndex.add(pipe, *self.uuid_parts,
+                                     getattr(self, 'created', None))
+        await CollectionStats.update(pipe, self.uuid, self.collection,
+                                     self.size, getattr(self, 'created', None))
 
     async def delete(self, db: RedisManager):
         topic = f'images:{self.uuid}'
@@ -400,6 +675,8 @@ class Image:
         alternates = await self.get_all_alternates(db)
         uuids = self.uuid.split(':')
         _uuid = uuids[-1]
+        # The alternate which is removed from the index
+        child = None if self.is_main_image else _uuid
         if self.is_main_image:
             _uuid = uuids[0]
             topic = f'{topic}:@'
@@ -407,12 +684,22 @@ class Image:
                 # set another alternate as main
                 if res := await alternates[0].set_as_main(db):
                     topic = f'images:{res["original_main"]}'
+                    child = res['original_main'].split(':')[-1]
                     await asyncio.sleep(.5)
-        await db.r.delete(topic)
-        await db.r.delete(f'matrix:{_uuid}')
-        os.path.exists(self.full_path) and os.unlink(self.full_path)
-        os.path.exists(self.full_thumb_image_path) and os.unlink(
-            self.full_thumb_image_path)
+        async with db.r.pipeline(transaction=True) as pipe:
+            await pipe.delete(topic)
+            await pipe.delete(f'matrix:{_uuid}')
+            if child:
+                await AlternateIndex.remove(pipe, uuids[0], child)
+            await CollectionStats.remove(
+                pipe, f'{uuids[0]}:{child}' if child else uuids[0])
+            await pipe.execute()
+        await SimilarityKeys.remove(db, _uuid)
+        await Storage.get().delete(self.filename)
+        await Storage.get().delete(self.thumb_filename)
+        if self.sha256:
+            await BlobStore.release(db, self.sha256, _uuid)
+        await FilenameIndex.release(db, self.filename)
         new_main = await Image.get(ImageRequest(uuid=uuids[0]), db=db)
         [new_main.add_uuid_reference(u) for u in original_uuids]
         await new_main.save(db)
@@ -420,7 +707,7 @@ class Image:
             # The image is only one - no alternates
             await new_main.move_from_own_subfolder(db)
 
-        self.delete_empty_folders(self.full_path)
+        await self.delete_empty_folders(self.filename)
         if self.is_main_image and self.collection != '@':
             task = ImageTask().set_action(
                 collection=self.collection,
@@ -432,65 +719,117 @@ class Image:
             await task.save(db)
 
     async def move_to_own_subfolder(self, db):
-        org_filename = self.full_path
-        org_thumb = self.full_thumb_image_path
+        old_filename = self.filename
+        old_thumb = self.thumb_filename
         path = ParsePath.parse(self.filename)
         path.parent_dir = path.filename
-        self.filename = self.get_unique_filename(path)
-        self.make_folder()
-        os.rename(org_filename, self.full_path)
-        os.rename(org_thumb, self.full_thumb_image_path)
+        self.filename = await self.get_unique_filename(db, self.uuid, path)
+        await self.__rename_files(old_filename, old_thumb)
+        await FilenameIndex.release(db, old_filename)
         await self.save(db)
 
     async def move_from_own_subfolder(self, db):
-        org_filename = self.full_path
-        org_thumb = self.full_thumb_image_path
+        old_filename = self.filename
+        old_thumb = self.thumb_filename
         path = ParsePath.parse(self.filename)
         path.parent_dir = None
-        self.filename = self.get_unique_filename(path)
-        self.make_folder()
-        os.rename(org_filename, self.full_path)
-        os.rename(org_thumb, self.full_thumb_image_path)
-        self.delete_empty_folders(org_filename)
+        self.filename = await self.get_unique_filename(db, self.uuid, path)
+        await self.__rename_files(old_filename, old_thumb)
+        await self.delete_empty_folders(old_filename)
+        await FilenameIndex.release(db, old_filename)
         await self.save(db)
 
-    def __move_files(self, collection):
-        org_filename = self.full_path
-        org_thumb = self.full_thumb_image_path
-        path = ParsePath.parse(self.filename)
-        path.collection = collection
-        self.filename = self.get_unique_filename(path)
-        self.make_folder()
-        os.rename(org_filename, self.full_path)
-        os.rename(org_thumb, self.full_thumb_image_path)
-        self.delete_empty_folders(org_filename)
-
-    async def set_collection(self, db: RedisManager, collection, pipe=None):
-        async def __process(pipe, coll):
-            # Update this image
-            self.collection = coll.name
-            self.__move_files(coll.name)
-            await self.save(None, pipe)
-            if self.is_main_image:
-                # Update alternates
-                alternates = await self.get_all_alternates(db)
-                for aimage in alternates:
-                    await aimage.set_collection(None, coll, pipe)
-
-        old_collection_name = self.collection
-        if pipe:
-            await __process(pipe, collection)
-            return
+    async def set_collection(self, db: RedisManager, collection,
+                             alternates: list['Image'] = None):
+        await Image.set_collection_many(
+            db, [self], collection,
+            None if alternates is None else {self.uuid: alternates})
+
+    @classmethod
+    async def set_collection_many(cls, db: RedisManager, images: list['Image'],
+                                  collection,
+                                  alternates: dict[str, list['Image']] = None):
+        """
+        Move the images (the main images with their alternates) to
+        the collection. All new filenames are allocated first, the files
+        are renamed concurrently and all records are saved by one
+        transaction. The thumb of every affected collection is rebuilt once.
+        :param db: RedisManager
+        :param images: list of Image
+        :param collection: Collection
+        :param alternates: dict - preloaded alternates (get_alternates_of)
+        """
+        images = list({it.uuid: it for it in images}.values())
+        if alternates is None:
+            alternates = await cls.get_alternates_of(
+                [it for it in images if it.is_main_image], db)
+        affected = set()
+        moves = []  # (image, old filename, old thumb, old collection)
+        for image in images:
+            items = [image]
+            if image.is_main_image:
+                affected.update({image.collection, collection.name})
+                items += alternates.get(image.uuid, [])
+            for it in items:
+                moves.append((it, it.filename, it.thumb_filename,
+                              it.collection))
+                path = ParsePath.parse(it.filename)
+                path.collection = collection.name
+                it.collection = collection.name
+                it.filename = await it.get_unique_filename(db, it.uuid, path)
+        try:
+            await cls.__rename_many(moves)
+        except BaseException:
+            for it, old_filename, _, old_collection in moves:
+                await FilenameIndex.release(db, it.filename)
+                it.filename, it.collection = old_filename, old_collection
+            raise
         async with db.r.pipeline(transaction=True) as pipe:
-            pipe.multi()
-            await __process(pipe, collection)
+            for it, old_filename, _, _ in moves:
+                await it.save(None, pipe)
+                await FilenameIndex.release(db, old_filename, pipe)
             await pipe.execute()
-        if self.is_main_image:
-            if collection.name != '@':
-                await collection.make_thumb(db, True)
-            if old_collection_name != '@':
-                old_collection = await Collection.get(old_collection_name, db)
-                await old_collection.make_thumb(db, True)
+        logger.info(f'{len(moves)} images were moved to the collection '
+                    f'{collection.name}.')
+        storage = Storage.get()
+        for folder in {os.path.dirname(it[1]) for it in moves}:
+            await storage.prune(folder)
+        for name in affected - {'@'}:
+            coll = collection if name == collection.name \
+                else await Collection.get(name, db)
+            await coll.make_thumb(db, True)
+
+    @staticmethod
+    async def __rename_many(moves: list[tuple]):
+        """
+        Rename the files concurrently, the renamed files are moved back
+        if any rename fails.
+        """
+        storage = Storage.get()
+
+        async def rename(it, old_filename, old_thumb, reverse=False):
+            src, dst = (it.filename, old_filename) if reverse \
+                else (old_filename, it.filename)
+            await storage.rename(src, dst)
+            if old_thumb == it.thumb_filename:
+                return
+            src, dst = (it.thumb_filename, old_thumb) if reverse \
+                else (old_thumb, it.thumb_filename)
+            try:
+                await storage.rename(src, dst)
+            except (OSError, StorageException):
+                # The thumb will be made again
+                logger.warning(f'The thumb {src} was not moved.')
+
+        results = await asyncio.gather(
+            *[rename(*it[:3]) for it in moves], return_exceptions=True)
+        errors = [res for res in results if isinstance(res, BaseException)]
+        if errors:
+            await asyncio.gather(
+                *[rename(*it[:3], reverse=True)
+                  for it, res in zip(moves, results) if res is None],
+                return_exceptions=True)
+            raise errors[0]
 
     async def set_as_main(self, db: RedisManager):
         if self.is_main_image:
@@ -507,28 +846,44 @@ class Image:
                 iro.update_uuid()
                 await pipe.rename(f'images:{old_main.uuid}:@',
                                   f'images:{iro.full_uuid}')
+                await AlternateIndex.add(pipe, iro.parent_uuid, iro.uuid,
+                                         getattr(old_main, 'created', None))
+                await CollectionStats.update(
+                    pipe, iro.full_uuid, old_main.collection, old_main.size,
+                    getattr(old_main, 'created', None))
+                await FilenameIndex.set_owner(pipe, old_main.filename,
+                                              iro.full_uuid)
                 res['original_main'] = iro.full_uuid
             await pipe.rename(f'images:{self.uuid}',
                               f'images:{self.uuid_parts[0]}:@')
+            await AlternateIndex.remove(pipe, *self.uuid_parts)
+            await CollectionStats.remove(pipe, self.uuid)
+            await CollectionStats.update(
+                pipe, self.uuid_parts[0], self.collection, self.size,
+                getattr(self, 'created', None))
+            await FilenameIndex.set_owner(pipe, self.filename,
+                                          self.uuid_parts[0])
             await pipe.execute()
         return res
 
     async def set_as_alternation_of(self, image: 'Image', db: RedisManager):
         org_uuid = self.uuid_parts
         self.uuid = f'{image.uuid_parts[0]}:{self.uuid_parts[-1]}'
-        org_filename = self.full_path
-        org_thumb = self.full_thumb_image_path
+        old_filename = self.filename
+        old_thumb = self.thumb_filename
         path = ParsePath.parse(self.filename)
         path.parent_dir = ParsePath.parse(image.filename).filename
-        self.filename = self.get_unique_filename(path)
-        self.make_folder()
-        os.rename(org_filename, self.full_path)
-        os.rename(org_thumb, self.full_thumb_image_path)
-        self.delete_empty_folders(org_filename)
+        self.filename = await self.get_unique_filename(db, self.uuid, path)
+        await self.__rename_files(old_filename, old_thumb)
+        await self.delete_empty_folders(old_filename)
         async with db.r.pipeline(transaction=True) as pipe:
             pipe.multi()
+            await FilenameIndex.release(db, old_filename, pipe)
+            await CollectionStats.remove(pipe, ':'.join(org_uuid))
             if len(org_uuid) == 1:
                 org_uuid.append('@')
+            else:
+                await AlternateIndex.remove(pipe, *org_uuid)
             await pipe.rename(
                 f'images:{":".join(org_uuid)}',
                 f'images:{self.uuid}')
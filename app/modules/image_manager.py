@@ -3,7 +3,7 @@ from loggate import get_logger
 from libs.redis_manager import redis_subscribe, RedisManager
 from libs.socket_manager import socket_command, SocketManager
 from libs.helper import login_required
-from modules.collection import Collection
+from modules.collection import Collection, CollectionException
 from modules.image import Image
 from modules.image_request_parser import ImageRequest
 
@@ -21,8 +21,12 @@ class ImageManager:
         collection = await Collection.get(collection_name, db)
         res = {key: val for key, val in collection.__dict__.items() if
                val and not key.startswith('_')}
-        res['members'] = await collection.get_members(db, offset=payload.get(
-            'offset', 0), num=payload.get('num', 10000))
+        try:
+            res['members'], res['cursor'] = await collection.get_members(
+                db, num=int(payload.get('num') or 0),
+                cursor=payload.get('cursor'))
+        except CollectionException as ex:
+            return {'status': 'ng', 'msg': str(ex)}
         return res
 
     @socket_command('get_image_alternates')
@@ -96,19 +100,18 @@ class ImageManager:
     async def set_image_collection(payload, db, **kwargs):
         params = payload.get('params')
         collection_name = params.get('collection')
-        for uuid in params.pop('uuid', []):
-            uuids = uuid.split(':', 1)
-            irp = ImageRequest(uuid=uuids[0])
-            image = await Image.get(irp, db=db)
-            if not image:
-                return {'status': 'ng', 'msg': 'Image not found.'}
-            if image.collection == collection_name:
-                return {'status': 'ng', 'msg': 'The same collection.'}
-            collection = await Collection.get(collection_name, db)
-            logger.info(
-                f"Move image (uuid: {irp.uuid}) "
-                f"to collection '{collection_name}'")
-            await image.set_collection(db, collection)
+        images = await Image.get_many(
+            [ImageRequest(uuid=uuid.split(':', 1)[0])
+             for uuid in params.pop('uuid', [])], db)
+        if not all(images):
+            return {'status': 'ng', 'msg': 'Image not found.'}
+        if any(image.collection == collection_name for image in images):
+            return {'status': 'ng', 'msg': 'The same collection.'}
+        collection = await Collection.get(collection_name, db)
+        logger.info(
+            f"Move images (uuids: {[image.uuid for image in images]}) "
+            f"to collection '{collection_name}'")
+        await Image.set_collection_many(db, images, collection)
         return {'status': 'ok'}
 
     @socket_command('set_main_image')
@@ -132,17 +135,20 @@ class ImageManager:
         uuids = params.get('uuids', [])
         if len(uuids) < 2:
             return {'status': 'ng', 'msg': 'Required minimum two images.'}
-        main_image = await Image.get(ImageRequest(uuid=uuids.pop(0)), db=db)
-        if not main_image:
+        requests = [ImageRequest(uuid=uuids[0])]
+        requests += [ImageRequest(uuid=uuid.split(':')[-1])
+                     for uuid in uuids[1:]]
+        main_image, *images = await Image.get_many(requests, db)
+        if not main_image or not all(images):
             return {'status': 'ng', 'msg': 'Image not found.'}
-        logger.info(f"Join images (uuids: {uuids}) to image {main_image.uuid}")
-        for uuid in uuids:
-            image = await Image.get(ImageRequest(uuid=uuid.split(':')[-1]),
-                                    db=db)
-            alternates = await image.get_all_alternates(db=db) or []
-            print(alternates)
+        logger.info(f"Join images (uuids: {uuids[1:]}) to image "
+                    f"{main_image.uuid}")
+        alternates = await Image.get_alternates_of(
+            [image for image in images if image.is_main_image], db)
+        for image in images:
+            image_alternates = alternates.get(image.uuid, [])
             await image.set_as_alternation_of(main_image, db=db)
-            for a_image in alternates:
+            for a_image in image_alternates:
                 await a_image.set_as_alternation_of(main_image, db=db)
         await main_image.move_to_own_subfolder(db)
         return {'status': 'ok'}
@@ -3,65 +3,272 @@ import hashlib
 import json
 
 from loggate import get_logger
-from redis.commands.search.query import Query
-from redis.exceptions import LockError
+from redis.exceptions import ResponseError
 
+from config import get_config
 from libs.redis_manager import RedisManager
 from libs.socket_manager import socket_command
 
+TASK_CLAIM_TIMEOUT = get_config('TASK_CLAIM_TIMEOUT', wrapper=int)
+TASK_MAX_DELIVERIES = get_config('TASK_MAX_DELIVERIES', wrapper=int)
+
 logger = get_logger('ImageTask')
 
+# KEYS[1] - tasks:<uuid>, KEYS[2] - the stream, ARGV[1] - the status ready,
+# ARGV[2] - uuid of the task, ARGV[3] - the action, ARGV[4:] - other fields
+ENQUEUE_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'status') == ARGV[1] then
+    return false
+end
+local message_id = redis.call('XADD', KEYS[2], '*', 'task_uuid', ARGV[2],
+                              'action', ARGV[3])
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], 'status', ARGV[1], 'action', ARGV[3],
+           'message_id', message_id, unpack(ARGV, 4))
+return message_id
+"""
+
+# The status is changed by the message of the last enqueuing only (the task
+# can be enqueued again while it is running).
+# KEYS[1] - tasks:<uuid>, ARGV[1] - id of the message, ARGV[2] - the status
+START_SCRIPT = """
+local message_id = redis.call('HGET', KEYS[1], 'message_id')
+if message_id and message_id ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'status', ARGV[2])
+return 1
+"""
+
+# KEYS[1] - tasks:<uuid>, KEYS[2] - the stream, ARGV[1] - the group,
+# ARGV[2] - id of the message (or ''), ARGV[3] - TTL of the status,
+# ARGV[4:] - the fields of the status
+FINISH_SCRIPT = """
+if ARGV[2] ~= '' then
+    redis.call('XACK', KEYS[2], ARGV[1], ARGV[2])
+    redis.call('XDEL', KEYS[2], ARGV[2])
+    local message_id = redis.call('HGET', KEYS[1], 'message_id')
+    if message_id and message_id ~= ARGV[2] then
+        return 0
+    end
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 4))
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
 
 class ImageTask:
+    """
+    The tasks are delivered by Redis Streams (at least once):
+        stream:tasks:<priority> - stream: task_uuid, action
+        tasks:<uuid> - hash: the status of the task (it expires STATUS_TTL
+                       after the task is finished)
+    Every priority class (PRIORITIES, from the highest) has got own stream,
+    the worker takes them by TaskScheduler. Every worker is a consumer
+    of the group GROUP. The task is acknowledged when it is finished (done
+    or error), the tasks of crashed workers are claimed after
+    TASK_CLAIM_TIMEOUT (the running tasks are kept by heartbeat). The same
+    task is not enqueued while it is ready. The task enqueued again while
+    it is running keeps the new status (the hash has got the id of the last
+    message).
+    """
     STATUS_READY = 'ready'
     STATUS_RUNNING = 'running'
     STATUS_ERROR = 'error'
     STATUS_DONE = 'done'
 
-    task_lock = None
+    PRIORITY_THUMB = 'thumb'  # the thumb which somebody waits for
+    PRIORITY_RESIZE = 'resize'
+    PRIORITY_DEDUP = 'dedup'
+    PRIORITY_COLLECTION = 'collection'
+    PRIORITIES = (PRIORITY_THUMB, PRIORITY_RESIZE, PRIORITY_DEDUP,
+                  PRIORITY_COLLECTION)
 
-    @classmethod
-    def get_lock(cls):
-        if not cls.task_lock:
-            cls.task_lock = RedisManager.get_lock('task_lock_key', timeout=20)
-        return cls.task_lock
+    STREAM = 'stream:tasks'  # the prefix (one stream before priorities)
+    GROUP = 'workers'
+    STATUS_TTL = 1800  # seconds
+
+    __enqueue = None
+    __start_script = None
+    __finish_script = None
 
     @socket_command('add_task')
     @classmethod
     async def ws_add_task(cls, payload, db, **kwargs):
         params = payload.get('params')
         task = ImageTask(**params)
-        async with cls.get_lock():
-            await task.save(db)
+        await task.save(db)
+
+    @classmethod
+    def get_priority(cls, action: dict) -> str:
+        if action.get('collection'):
+            return cls.PRIORITY_COLLECTION
+        if action.get('cmd') == 'find_same_images':
+            return cls.PRIORITY_DEDUP
+        if action.get('cmd') == 'resize' and action.get('thumb'):
+            return cls.PRIORITY_THUMB
+        return cls.PRIORITY_RESIZE
+
+    @classmethod
+    def get_stream(cls, priority: str) -> str:
+        return f'{cls.STREAM}:{priority}'
+
+    @classmethod
+    async def init(cls, db: RedisManager):
+        """
+        Create the consumer groups. The tasks of the one stream (before
+        priorities) or of the hashes (before streams) are enqueued.
+        """
+        streams = [cls.get_stream(it) for it in cls.PRIORITIES]
+        if (existing := await db.r.exists(*streams)) == len(streams):
+            return
+        for stream in streams:
+            try:
+                await db.r.xgroup_create(stream, cls.GROUP, id='0',
+                                         mkstream=True)
+            except ResponseError as ex:
+                if 'BUSYGROUP' not in str(ex):
+                    raise
+        if existing:
+            return
+        if await db.r.exists(cls.STREAM):
+            messages = await db.r.xrange(cls.STREAM)
+            for _, fields in messages:
+                if fields.get('action'):
+                    await db.r.xadd(cls.get_stream(cls.get_priority(
+                        json.loads(fields['action']))), fields)
+            await db.r.delete(cls.STREAM)
+            logger.info(f'{len(messages)} tasks were moved to the streams '
+                        f'of priorities.')
+            return
+        counter = 0
+        async for key in db.r.scan_iter(match='tasks:*', count=1000,
+                                        _type='hash'):
+            data = await db.r.hgetall(key)
+            if data.get('status') in (cls.STATUS_READY, cls.STATUS_RUNNING) \
+                    and data.get('action'):
+                await db.r.hset(key, 'status', cls.STATUS_READY)
+                await db.r.persist(key)
+                await db.r.xadd(cls.get_stream(cls.get_priority(
+                    json.loads(data['action']))), {
+                    'task_uuid': key.split(':', 1)[1],
+                    'action': data['action']})
+                counter += 1
+        if counter:
+            logger.info(f'{counter} tasks were moved to the streams.')
 
     @classmethod
-    async def take_ready_task(cls, db: RedisManager,
-                              task_uuid=None) -> 'ImageTask':
-        try:
-            async with cls.get_lock():
-                if task_uuid is None:
-                    query = Query(f'@status:{cls.STATUS_READY}').dialect(2)
-                    result = await db.ix_tasks.search(query)
-                    if result.total == 0:
-                        return None
-                    task_data = result.docs[0].__dict__
-                    task_data.pop('payload')
-                    _, task_uuid = task_data.pop('id').split(':', 1)
-                else:
-                    task_data = await db.r.hgetall(task_uuid)
-                if task_data.get('status') != cls.STATUS_READY:
-                    return
-                if 'action' not in task_data:
-                    return
-                task_data['action'] = json.loads(task_data['action'])
-                task_data['task_uuid'] = task_uuid.replace('tasks:', '')
-                task = ImageTask(**task_data)
-                task.run_at = int(datetime.datetime.now().timestamp())
-                await db.r.hset(task_uuid, 'status', cls.STATUS_RUNNING)
-                return task
-        except LockError:
-            logger.error('I can not get the task lock.')
-        return
+    async def __start(cls, db: RedisManager, stream: str, message_id: str,
+                      fields: dict) -> 'ImageTask':
+        if not fields or 'action' not in fields:
+            # The message was deleted
+            await db.r.xack(stream, cls.GROUP, message_id)
+            return None
+        task = ImageTask(task_uuid=fields['task_uuid'],
+                         action=json.loads(fields['action']),
+                         message_id=message_id,
+                         priority=stream.rsplit(':', 1)[1],
+                         status=cls.STATUS_RUNNING)
+        task.run_at = int(datetime.datetime.now().timestamp())
+        if not cls.__start_script:
+            cls.__start_script = db.r.register_script(START_SCRIPT)
+        await cls.__start_script(keys=[f'tasks:{task.task_uuid}'],
+                                 args=[message_id, cls.STATUS_RUNNING],
+                                 client=db.r)
+        return task
+
+    @classmethod
+    async def take(cls, db: RedisManager, consumer: str, priorities: list,
+                   block: int = None) -> list['ImageTask']:
+        """
+        :param consumer: the name of the worker
+        :param priorities: the priority classes
+        :param block: milliseconds of waiting for any task
+        :return: list - new tasks (one of every priority class at most)
+        """
+        res = await db.r.xreadgroup(
+            cls.GROUP, consumer, {cls.get_stream(it): '>'
+                                  for it in priorities},
+            count=1, block=block)
+        tasks = []
+        for stream, messages in res or []:
+            for message_id, fields in messages:
+                if task := await cls.__start(db, stream, message_id, fields):
+                    tasks.append(task)
+        return tasks
+
+    @classmethod
+    async def take_pending(cls, db: RedisManager,
+                           consumer: str) -> list['ImageTask']:
+        """
+        The tasks delivered to this consumer and not finished (the previous
+        run of the worker).
+        """
+        tasks = []
+        for stream in map(cls.get_stream, cls.PRIORITIES):
+            last_id = '0'
+            while True:
+                res = await db.r.xreadgroup(cls.GROUP, consumer,
+                                            {stream: last_id}, count=100)
+                if not (messages := res[0][1] if res else []):
+                    break
+                for message_id, fields in messages:
+                    last_id = message_id
+                    if task := await cls.__start(db, stream, message_id,
+                                                 fields):
+                        tasks.append(task)
+        return tasks
+
+    @classmethod
+    async def reclaim(cls, db: RedisManager, consumer: str,
+                      count: int = 10) -> list['ImageTask']:
+        """
+        Claim the tasks of crashed consumers (pending longer than
+        TASK_CLAIM_TIMEOUT). The task delivered more than
+        TASK_MAX_DELIVERIES times is finished with the error.
+        """
+        messages = []
+        for stream in map(cls.get_stream, cls.PRIORITIES):
+            if len(messages) >= count:
+                break
+            _, claimed, *_ = await db.r.xautoclaim(
+                stream, cls.GROUP, consumer, TASK_CLAIM_TIMEOUT * 1000,
+                count=count - len(messages))
+            messages += [(stream, *it) for it in claimed]
+        tasks = []
+        for stream, message_id, fields in messages:
+            if not message_id:
+                continue
+            if not (task := await cls.__start(db, stream, message_id,
+                                              fields)):
+                continue
+            pending = await db.r.xpending_range(
+                stream, cls.GROUP, min=message_id, max=message_id,
+                count=1)
+            deliveries = pending[0]['times_delivered'] if pending else 0
+            if deliveries > TASK_MAX_DELIVERIES:
+                await task.set_error(db, f'The task {task.task_uuid} was '
+                                         f'delivered {deliveries} times.')
+                continue
+            logger.warning(f'The task {task.task_uuid} was claimed '
+                           f'(delivery {deliveries}).')
+            tasks.append(task)
+        return tasks
+
+    @classmethod
+    async def heartbeat(cls, db: RedisManager, consumer: str,
+                        tasks: list['ImageTask']):
+        """
+        Reset the idle time of the running tasks (they are not claimed).
+        """
+        streams = {}
+        for task in tasks:
+            if task.message_id:
+                streams.setdefault(task.stream, []).append(task.message_id)
+        for stream, message_ids in streams.items():
+            await db.r.xclaim(stream, cls.GROUP, consumer, 0, message_ids,
+                              justid=True)
 
     def __init__(self, **kwargs):
         if not kwargs.get('status'):
@@ -69,6 +276,8 @@ class ImageTask:
         self.action = {}
         self.task_uuid = None
         self.status = None
+        self.message_id = None
+        self.priority = None
         self.__dict__.update(kwargs)
 
     @property
@@ -76,33 +285,56 @@ class ImageTask:
         return {key: val for key, val in self.__dict__.items() if
                 val and not key.startswith('_')}
 
+    @property
+    def stream(self) -> str:
+        if self.priority not in self.PRIORITIES:
+            return self.get_stream(self.get_priority(self.action))
+        return self.get_stream(self.priority)
+
     def set_action(self, **kwargs):
         self.action.update(kwargs)
         return self
 
+    async def __finish(self, db: RedisManager, status: str, **kwargs):
+        if not self.__class__.__finish_script:
+            self.__class__.__finish_script = db.r.register_script(
+                FINISH_SCRIPT)
+        fields = {'status': status, **kwargs}
+        await self.__finish_script(
+            keys=[f'tasks:{self.task_uuid}', self.stream],
+            args=[self.GROUP, self.message_id or '', self.STATUS_TTL,
+                  *[it for item in fields.items() for it in item]],
+            client=db.r)
+
     async def set_error(self, db: RedisManager, msg=None):
-        async with self.get_lock():
-            await db.r.hset(f'tasks:{self.task_uuid}', 'status',
-                            self.STATUS_ERROR)
-            if msg:
-                logger.error(msg)
-                await db.r.hset(f'tasks:{self.task_uuid}',
-                                'error_message', msg)
+        if msg:
+            logger.error(msg)
+        await self.__finish(db, self.STATUS_ERROR,
+                            **({'error_message': msg} if msg else {}))
 
     async def set_done(self, db: RedisManager, msg: str = None):
-        async with self.get_lock():
-            await db.r.hset(f'tasks:{self.task_uuid}', 'status',
-                            self.STATUS_DONE)
-            if msg:
-                logger.debug(msg)
-                await db.r.hset(f'tasks:{self.task_uuid}', 'message', msg)
+        if msg:
+            logger.debug(msg)
+        await self.__finish(db, self.STATUS_DONE,
+                            **({'message': msg} if msg else {}))
 
     async def save(self, db: RedisManager):
+        """
+        Enqueue the task (it is skipped when the same task is ready).
+        """
         data = self.data
-        data['action'] = json.dumps(data['action'])
+        data.pop('message_id', None)
+        data.pop('status', None)
+        action = json.dumps(data.pop('action', {}))
         if not self.task_uuid:
             self.task_uuid = str(hashlib.md5(
                 repr(sorted(self.data.items())).encode()).hexdigest())
-        async with self.get_lock():
-            await db.r.hset(f'tasks:{self.task_uuid}', mapping=data)
-            await db.r.expire(f'tasks:{self.task_uuid}', 1800)
+        data.pop('task_uuid', None)
+        data.pop('priority', None)
+        if not self.__class__.__enqueue:
+            self.__class__.__enqueue = db.r.register_script(ENQUEUE_SCRIPT)
+        fields = [it for item in data.items() for it in item]
+        await self.__enqueue(
+            keys=[f'tasks:{self.task_uuid}', self.stream],
+            args=[self.STATUS_READY, self.task_uuid, action, *fields],
+            client=db.r)
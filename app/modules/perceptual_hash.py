@@ -0,0 +1,119 @@
+import cv2
+import numpy as np
+from loggate import get_logger
+
+from libs.redis_manager import RedisManager
+from modules.similarity_keys import SimilarityKeys
+
+logger = get_logger('PerceptualHash')
+
+
+class PerceptualHash:
+    """
+    The cheap first stage of the duplicate detection. Every thumb has
+    64-bit pHash (DCT), 64-bit dHash (gradients) and RGB histogram
+    (4x4x4 bins).
+        phash:images - hash: uuid -> phash (16 hex) + dhash (16 hex)
+                                      + histogram (128 hex)
+        phash:<chunk>:<value> - set: uuids with this 16-bit part of pHash
+    The images are found by multi-index hashing: the pHash is split into
+    4 parts, so every image with the distance <= 3 has at least one equal
+    part (the more distant images are found when any part is equal).
+    """
+    IMAGES = SimilarityKeys.PHASH_IMAGES
+    # The near-duplicate (it is not verified by SIFT)
+    DUPLICATE_PHASH = 3
+    DUPLICATE_DHASH = 6
+    DUPLICATE_HISTOGRAM = .9
+    # The candidate verified by SIFT
+    CANDIDATE_PHASH = 16
+
+    @staticmethod
+    def __bits(values: np.ndarray) -> int:
+        return int(''.join('1' if it else '0' for it in values.flatten()), 2)
+
+    @classmethod
+    def compute(cls, img) -> str:
+        """
+        :param img: PIL.Image
+        :return: str - the encoded hashes
+        """
+        rgb = np.asarray(img.convert('RGB'))
+        gray = cv2.cvtColor(rgb, cv2.COLOR_RGB2GRAY)
+        dct = cv2.dct(np.float32(cv2.resize(gray, (32, 32),
+                                            interpolation=cv2.INTER_AREA)))
+        low = dct[:8, :8].flatten()
+        phash = cls.__bits(low > np.median(low[1:]))
+        small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+        dhash = cls.__bits(small[:, 1:] > small[:, :-1])
+        hist = cv2.calcHist([rgb], [0, 1, 2], None, [4, 4, 4],
+                            [0, 256, 0, 256, 0, 256]).flatten()
+        hist = np.uint8(np.rint(255 * hist / max(hist.sum(), 1)))
+        return f'{phash:016x}{dhash:016x}{hist.tobytes().hex()}'
+
+    @classmethod
+    def compare(cls, hashes1: str, hashes2: str) -> tuple[int, int, float]:
+        """
+        :return: (distance of pHash, distance of dHash,
+                  intersection of histograms 0-1)
+        """
+        dist_p = int(hashes1[:16], 16) ^ int(hashes2[:16], 16)
+        dist_d = int(hashes1[16:32], 16) ^ int(hashes2[16:32], 16)
+        hist1 = np.frombuffer(bytes.fromhex(hashes1[32:]), np.uint8)
+        hist2 = np.frombuffer(bytes.fromhex(hashes2[32:]), np.uint8)
+        return dist_p.bit_count(), dist_d.bit_count(), \
+            float(np.minimum(hist1, hist2).sum()) / 255
+
+    @classmethod
+    async def get(cls, db: RedisManager, uuid: str) -> str | None:
+        return await db.r.hget(cls.IMAGES, uuid)
+
+    @classmethod
+    async def add(cls, db: RedisManager, uuid: str, hashes: str):
+        async with db.r.pipeline(transaction=True) as pipe:
+            if old := await db.r.hget(cls.IMAGES, uuid):
+                for key in SimilarityKeys.phash_chunks(old):
+                    await pipe.srem(key, uuid)
+            for key in SimilarityKeys.phash_chunks(hashes):
+                await pipe.sadd(key, uuid)
+            await pipe.hset(cls.IMAGES, uuid, hashes)
+            await pipe.execute()
+
+    @classmethod
+    async def remove(cls, db: RedisManager, uuid: str):
+        if hashes := await db.r.hget(cls.IMAGES, uuid):
+            async with db.r.pipeline(transaction=True) as pipe:
+                for key in SimilarityKeys.phash_chunks(hashes):
+                    await pipe.srem(key, uuid)
+                await pipe.hdel(cls.IMAGES, uuid)
+                await pipe.execute()
+
+    @classmethod
+    async def find(cls, db: RedisManager, uuid: str,
+                   hashes: str) -> tuple[list, list]:
+        """
+        :return: (near-duplicates, candidates) - lists of (uuid, distance
+                 of pHash) sorted by the distance
+        """
+        async with db.r.pipeline(transaction=False) as pipe:
+            for key in SimilarityKeys.phash_chunks(hashes):
+                pipe.smembers(key)
+            uuids = set().union(*await pipe.execute())
+        uuids.discard(uuid)
+        if not uuids:
+            return [], []
+        uuids = list(uuids)
+        duplicates, candidates = [], []
+        for uuid2, hashes2 in zip(uuids, await db.r.hmget(cls.IMAGES,
+                                                          uuids)):
+            if not hashes2:
+                continue
+            dist_p, dist_d, hist = cls.compare(hashes, hashes2)
+            if dist_p <= cls.DUPLICATE_PHASH and \
+                    dist_d <= cls.DUPLICATE_DHASH and \
+                    hist >= cls.DUPLICATE_HISTOGRAM:
+                duplicates.append((uuid2, dist_p))
+            elif dist_p <= cls.CANDIDATE_PHASH:
+                candidates.append((uuid2, dist_p))
+        return sorted(duplicates, key=lambda it: it[1]), \
+            sorted(candidates, key=lambda it: it[1])
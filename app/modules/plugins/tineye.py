@@ -4,6 +4,8 @@ import aiohttp
 from loggate import get_logger
 
 from config import get_config
+from libs.http_client import HttpClient
+from libs.storage import Storage
 from libs.socket_manager import socket_command
 from libs.helper import login_required
 from modules.image import Image
@@ -35,15 +37,15 @@ class TineyePlugin:
     @classmethod
     async def try_to_get_tineye_links(cls, image: Image):
         try:
-            async with aiohttp.ClientSession() as session:
-                data = aiohttp.FormData()
-                data.add_field('image', open(image.full_path, 'rb'),
-                               filename=os.path.basename(image.filename))
-                async with session.post(cls.URL, data=data,
-                                        headers=cls.HEADERS,
-                                        timeout=aiohttp.ClientTimeout(
-                                            total=60)) as response:
-                    data = await response.json()
+            session = HttpClient.get_session()
+            data = aiohttp.FormData()
+            data.add_field('image', await Storage.get().read(image.filename),
+                           filename=os.path.basename(image.filename))
+            async with session.post(cls.URL, data=data,
+                                    headers=cls.HEADERS,
+                                    timeout=aiohttp.ClientTimeout(
+                                        total=60)) as response:
+                data = await response.json()
             return data.get('matches', [])
         except Exception as ex:
             logger.error(ex)
@@ -7,6 +7,8 @@ from loggate import get_logger
 
 from config import get_config
 from libs.helper import login_required
+from libs.http_client import HttpClient
+from libs.storage import Storage
 from libs.socket_manager import socket_command
 from modules.image import Image
 from modules.image_request_parser import ImageRequest
@@ -42,47 +44,46 @@ class YandexPlugin:
 
     @classmethod
     async def try_to_get_yandex_links(cls, image: Image):
+        session = HttpClient.get_session()
         try:
-            async with aiohttp.ClientSession() as session:
-                data = aiohttp.FormData()
-                data.add_field('upfile',
-                               open(image.full_path, 'rb'),
-                               filename=os.path.basename(image.filename))
-                async with session.post(
-                        cls.REQUEST_URL, data=data, headers=cls.HEADERS,
-                        timeout=aiohttp.ClientTimeout(total=60)) as response:
-                    if res := await response.json():
-                        url = (f'{cls.RESPONSE_URL}?'
-                               f'{res["blocks"][0]["params"]["url"]}')
-                        logger.info(f'Response url: {url}')
-                        async with session.get(
-                                cls.RESPONSE_URL,
-                                params=res["blocks"][0]["params"]["url"],
-                                headers=cls.HEADERS,
-                                timeout=aiohttp.ClientTimeout(total=30)
-                        ) as page:
-                            page.raise_for_status()
-                            data = cls.parse_page(await page.text())
-                            data['response_url'] = url
-                            return {'status': 'ok', 'response': data}
+            data = aiohttp.FormData()
+            data.add_field('upfile',
+                           await Storage.get().read(image.filename),
+                           filename=os.path.basename(image.filename))
+            async with session.post(
+                    cls.REQUEST_URL, data=data, headers=cls.HEADERS,
+                    timeout=aiohttp.ClientTimeout(total=60)) as response:
+                if res := await response.json():
+                    url = (f'{cls.RESPONSE_URL}?'
+                           f'{res["blocks"][0]["params"]["url"]}')
+                    logger.info(f'Response url: {url}')
+                    async with session.get(
+                            cls.RESPONSE_URL,
+                            params=res["blocks"][0]["params"]["url"],
+                            headers=cls.HEADERS,
+                            timeout=aiohttp.ClientTimeout(total=30)
+                    ) as page:
+                        page.raise_for_status()
+                        data = cls.parse_page(await page.text())
+                        data['response_url'] = url
+                        return {'status': 'ok', 'response': data}
         except (aiohttp.client_exceptions.ClientOSError,
                 aiohttp.client_exceptions.ServerDisconnectedError):
             if not LOCAL_HOSTNAME:
                 try:
-                    async with (aiohttp.ClientSession() as session):
-                        logger.info("Pushing image failed, we try backup way.")
-                        params = {'source': 'collections',
-                                  'rpt': 'imageview',
-                                  'url': f'{HOST_URL}/{image.filename}'}
-                        async with session.get(
-                                cls.RESPONSE_URL,
-                                params=params,
-                                headers=cls.HEADERS,
-                                timeout=aiohttp.ClientTimeout(total=30)
-                        ) as page:
-                            page.raise_for_status()
-                            data = cls.parse_page(await page.text())
-                            return {'status': 'ok', 'response': data}
+                    logger.info("Pushing image failed, we try backup way.")
+                    params = {'source': 'collections',
+                              'rpt': 'imageview',
+                              'url': f'{HOST_URL}/{image.filename}'}
+                    async with session.get(
+                            cls.RESPONSE_URL,
+                            params=params,
+                            headers=cls.HEADERS,
+                            timeout=aiohttp.ClientTimeout(total=30)
+                    ) as page:
+                        page.raise_for_status()
+                        data = cls.parse_page(await page.text())
+                        return {'status': 'ok', 'response': data}
                 except Exception:
                     pass
             return {'status': 'ng', 'response': {'error': 'Connection erorr.'}}
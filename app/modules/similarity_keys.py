@@ -0,0 +1,42 @@
+from libs.redis_manager import RedisManager
+
+
+class SimilarityKeys:
+    """
+    The indexes of the duplicate detection which are changed also by
+    the web server (it has neither numpy nor OpenCV).
+        matrix_images - set: uuids of images with the descriptors
+                        (DescriptorStore)
+        ann:images - sorted set: uuids of images with the vectors
+                     (DescriptorIndex)
+        phash:images - hash: uuid -> the perceptual hashes
+                       (PerceptualHash)
+        phash:<chunk>:<value> - set: uuids with this 16-bit part of pHash
+    The deleted image is removed from all of them, also when it has no
+    matrix (the worker cleans them only when the matrix is deleted).
+    """
+    MATRIX_IMAGES = 'matrix_images'
+    ANN_IMAGES = 'ann:images'
+    PHASH_IMAGES = 'phash:images'
+    PHASH_CHUNKS = 4
+
+    @classmethod
+    def phash_chunks(cls, hashes: str) -> list[str]:
+        size = 16 // cls.PHASH_CHUNKS
+        return [f'phash:{ix}:{hashes[ix * size:(ix + 1) * size]}'
+                for ix in range(cls.PHASH_CHUNKS)]
+
+    @classmethod
+    async def remove(cls, db: RedisManager, uuid: str):
+        """
+        Remove the deleted image from the indexes.
+        """
+        hashes = await db.r.hget(cls.PHASH_IMAGES, uuid)
+        async with db.r.pipeline(transaction=True) as pipe:
+            await pipe.srem(cls.MATRIX_IMAGES, uuid)
+            await pipe.zrem(cls.ANN_IMAGES, uuid)
+            if hashes:
+                for key in cls.phash_chunks(hashes):
+                    await pipe.srem(key, uuid)
+                await pipe.hdel(cls.PHASH_IMAGES, uuid)
+            await pipe.execute()
@@ -0,0 +1,100 @@
+import time
+
+from config import get_config
+from libs.metrics import Metrics
+from libs.redis_manager import RedisManager
+from modules.image_task import ImageTask
+
+TASK_WEIGHTS = get_config('TASK_WEIGHTS')
+
+
+class TaskScheduler:
+    """
+    Weighted fair scheduling of the priority classes of tasks (smooth
+    weighted round-robin). Every class with waiting tasks gets the share
+    of taken tasks by its weight (TASK_WEIGHTS), so the flood of one class
+    (e.g. the similarity of a bulk import) does not delay the thumbs.
+    The classes without tasks do not collect the credit. Only the chosen
+    task is taken from its stream, the others are left to other workers.
+    """
+
+    @staticmethod
+    def parse_weights(value: str = TASK_WEIGHTS) -> dict[str, int]:
+        weights = dict.fromkeys(ImageTask.PRIORITIES, 1)
+        for item in (value or '').split(','):
+            name, _, weight = item.partition(':')
+            if name.strip() in weights:
+                weights[name.strip()] = max(int(weight), 1)
+        return weights
+
+    def __init__(self, consumer: str, weights: dict[str, int] = None):
+        self.consumer = consumer
+        self.weights = weights or self.parse_weights()
+        self.current = dict.fromkeys(self.weights, 0)
+
+    def __peek(self, active: list[str]) -> str:
+        """
+        :return: str - the class which choose() returns (without the change
+                 of credits)
+        """
+        return max(active, key=lambda it: (
+            self.current[it] + self.weights[it],
+            -ImageTask.PRIORITIES.index(it)))
+
+    def choose(self, active: list[str]) -> str:
+        """
+        :param active: the priority classes with waiting tasks
+        :return: str - the class of the next task
+        """
+        for priority in self.current:
+            if priority in active:
+                self.current[priority] += self.weights[priority]
+            else:
+                self.current[priority] = 0
+        res = max(active, key=lambda it: (self.current[it],
+                                          -ImageTask.PRIORITIES.index(it)))
+        self.current[res] -= sum(self.weights[it] for it in active)
+        return res
+
+    async def get_active(self, db: RedisManager,
+                         block: int = None) -> list[str]:
+        """
+        The classes with undelivered tasks. The streams are read after
+        the last delivered message of the group (XREAD), so no task
+        is taken.
+        :param block: milliseconds of waiting for any task
+        """
+        streams = [ImageTask.get_stream(it) for it in self.weights]
+        async with db.r.pipeline(transaction=False) as pipe:
+            for stream in streams:
+                pipe.xinfo_groups(stream)
+            groups = await pipe.execute()
+        last_ids = {}
+        for stream, info in zip(streams, groups):
+            for group in info:
+                if group['name'] == ImageTask.GROUP:
+                    last_ids[stream] = group['last-delivered-id']
+        res = await db.r.xread(last_ids, count=1, block=block)
+        return [stream.rsplit(':', 1)[1] for stream, messages in res or []
+                if messages]
+
+    async def take(self, db: RedisManager, block: int = None) -> ImageTask:
+        """
+        :param block: milliseconds of waiting for any task
+        :return: the next task or None
+        """
+        active = await self.get_active(db, block)
+        while active:
+            priority = self.__peek(active)
+            if tasks := await ImageTask.take(db, self.consumer, [priority]):
+                break
+            # The task was taken by another worker (or deleted)
+            active.remove(priority)
+        else:
+            return None
+        task = tasks[0]
+        self.choose(active)
+        # The id of the message is the time of enqueuing (milliseconds)
+        Metrics.observe(f'tasks.{priority}.wait', max(
+            time.time() - int(task.message_id.split('-')[0]) / 1000, 0))
+        return task
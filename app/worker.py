@@ -1,5 +1,8 @@
 import asyncio
 import os
+import signal
+import socket
+import threading
 
 os.environ['APP_TYPE'] = 'worker'
 
@@ -9,19 +12,42 @@ from loggate import setup_logging, get_logger
 from config import get_config
 
 from libs import get_yaml
+from libs.http_client import HttpClient
+from libs.metrics import Metrics
 from libs.redis_manager import RedisManager, redis_subscribe
+from libs.worker_pool import WorkerPool
 from modules.image_task import ImageTask
 from modules.actions.image_actions import ImageActions
 from modules.actions.video_actions import VideoActions
 from modules.collection import Collection
+from modules.alternate_index import AlternateIndex
+from modules.collection_stats import CollectionStats
+from modules.descriptor_cache import DescriptorCache
+from modules.descriptor_index import DescriptorIndex
+from modules.descriptor_store import DescriptorStore
+from modules.filename_index import FilenameIndex
 from modules.image import Image
+from modules.perceptual_hash import PerceptualHash
+from modules.task_scheduler import TaskScheduler
 from modules.image_request_parser import ImageRequest
 
 logging_profiles = get_yaml(get_config('LOGGING_DEFINITIONS'))
 setup_logging(profiles=logging_profiles)
 logger = get_logger('main')
 
+METRICS_INTERVAL = 60  # seconds
+TASK_BLOCK = 5000  # milliseconds of waiting for a new task
+TASK_CLAIM_TIMEOUT = get_config('TASK_CLAIM_TIMEOUT', wrapper=int)
+CONSUMER = f'{socket.gethostname()}-{os.getpid()}'
+
 is_init_redis_done = False
+# The tasks taken by this worker (message id -> task)
+running_tasks: dict[str, ImageTask] = {}
+# The tasks claimed from crashed workers (and the previous run)
+claimed_tasks: list[ImageTask] = []
+scheduler = TaskScheduler(CONSUMER)
+# The event loop of the action process (supervisor mode)
+process_loop: asyncio.AbstractEventLoop = None
 
 
 async def graceful_shutdown(loop, sig=None):
@@ -37,6 +63,20 @@ async def graceful_shutdown(loop, sig=None):
         loop.stop()
 
 
+async def shutdown(loop, sig):
+    """
+    Stop taking tasks, wait for the running ones and stop (supervisor mode).
+    """
+    global is_init_redis_done
+    pool = WorkerPool.get()
+    if pool.closing:
+        return
+    logger.info(f"Received exit signal {sig.name}, draining tasks...")
+    is_init_redis_done = False
+    await pool.close()
+    await graceful_shutdown(loop, sig)
+
+
 def handle_exception(loop, context):
     logger.error(f'{context["future"]}')
     print(context.get('exception', ''))
@@ -66,7 +106,7 @@ async def run_task(db: RedisManager, task: ImageTask):
         return
     elif col_name := task.action.get('collection'):
         collection: Collection = await Collection.get(col_name, db)
-        images = await collection.get_members(db, 0, 25)
+        images, _ = await collection.get_members(db, 25)
         if cmd == 'make_gif_from_images' and images:
             if await ImageActions.make_gif_from_images(
                     images,
@@ -79,45 +119,223 @@ async def run_task(db: RedisManager, task: ImageTask):
     await task.set_error(db, 'Unknown action')
 
 
-@redis_subscribe('__key*__:tasks:*', 'worker')
-async def redis_watcher(channel: str, action: str, db: RedisManager, **kwargs):
-    global is_init_redis_done
-    if not is_init_redis_done:
-        return
-    _, task_uuid = channel.rsplit(':', 1)
-    if task_uuid:
-        task_uuid = f'tasks:{task_uuid}'
-        task = await ImageTask.take_ready_task(db, task_uuid)
-        if task:
+async def get_task_kind(db: RedisManager, task: ImageTask) -> str:
+    """
+    :return: str - the kind of the task for WORKER_LIMITS (e.g. video.resize)
+    """
+    cmd = task.action.get('cmd')
+    if uuid := task.action.get('uuid'):
+        image = await Image.get(ImageRequest(uuid=uuid), db)
+        if image and image.content_type.startswith('video'):
+            return f'video.{cmd}'
+        return f'image.{cmd}'
+    return f'collection.{cmd}'
+
+
+def execute_task(task_data: dict):
+    """
+    Run the task in the action process (supervisor mode).
+    """
+    asyncio.run_coroutine_threadsafe(
+        run_task(RedisManager.get(), ImageTask(**task_data)),
+        process_loop).result()
+
+
+async def run_task_in_pool(db: RedisManager, pool: WorkerPool,
+                           task: ImageTask, slot: asyncio.Semaphore):
+    await pool.run(await get_task_kind(db, task), execute_task,
+                   task.__dict__, slot=slot)
+
+
+async def start_task(db: RedisManager, task: ImageTask,
+                     slots: asyncio.Semaphore, taken: asyncio.Semaphore):
+    running_tasks[task.message_id] = task
+    try:
+        if pool := WorkerPool.get():
+            await run_task_in_pool(db, pool, task, slots)
+        else:
             await run_task(db, task)
+    except Exception as ex:
+        # The task is not acknowledged, it is claimed again (up to
+        # TASK_MAX_DELIVERIES times).
+        logger.error(f'The task {task.task_uuid} failed. {ex}', exc_info=ex)
+    finally:
+        running_tasks.pop(task.message_id, None)
+        slots.release()
+        taken.release()
+
+
+async def consume_tasks(db: RedisManager):
+    """
+    Take the tasks from the streams (TaskScheduler). The number of taken
+    tasks is limited by the processes of the pool (one task in the inline
+    mode), the other tasks are left to other workers. The task waiting
+    for the limit of its kind (WORKER_LIMITS) does not hold the slot,
+    so the saturated kind does not block the others (up to the same
+    number of waiting tasks).
+    """
+    pool = WorkerPool.get()
+    slots = asyncio.Semaphore(pool.processes if pool else 1)
+    taken = asyncio.Semaphore(2 * pool.processes if pool else 1)
+    try:
+        while is_init_redis_done:
+            await taken.acquire()
+            await slots.acquire()
+            task = None
+            while is_init_redis_done and not task:
+                if claimed_tasks:
+                    task = claimed_tasks.pop(0)
+                else:
+                    try:
+                        task = await scheduler.take(db, block=TASK_BLOCK)
+                    except Exception as ex:
+                        logger.error(f'I can not take the task. {ex}')
+                        await asyncio.sleep(1)
+            if not is_init_redis_done:
+                # The task is not acknowledged, it is claimed later
+                slots.release()
+                taken.release()
+                break
+            if pool:
+                pool.submit(start_task(db, task, slots, taken))
+            else:
+                await start_task(db, task, slots, taken)
+    except asyncio.CancelledError:
+        pass
+
+
+async def maintain_tasks(db: RedisManager):
+    """
+    Keep the taken tasks (heartbeat) and claim the tasks of crashed workers.
+    """
+    try:
+        while True:
+            await asyncio.sleep(TASK_CLAIM_TIMEOUT / 3)
+            try:
+                await ImageTask.heartbeat(
+                    db, CONSUMER, [*running_tasks.values(), *claimed_tasks])
+                if is_init_redis_done and not claimed_tasks:
+                    claimed_tasks.extend(
+                        await ImageTask.reclaim(db, CONSUMER))
+            except Exception as ex:
+                logger.error(f'I can not maintain the tasks. {ex}')
+    except asyncio.CancelledError:
+        pass
+
+
+@redis_subscribe('__key*__:matrix:*', 'worker')
+async def matrix_watcher(channel: str, action: str, db: RedisManager,
+                         **kwargs):
+    uuid = channel.rsplit(':', 1)[-1]
+    DescriptorCache.invalidate(uuid)
+    if action == 'del':
+        await DescriptorStore.remove_image(db.r, uuid)
+        await DescriptorIndex.remove(db, uuid)
+        await PerceptualHash.remove(db, uuid)
 
 
 async def redis_init(db: RedisManager):
     """
-    Run after start and do all incomplete tasks.
+    Run after start, the incomplete tasks of this worker are taken again.
     :param db:
     :return:
     """
     try:
-        while task := await ImageTask.take_ready_task(db):
-            await run_task(db, task)
+        if not await db.r.exists('filenames'):
+            await FilenameIndex.rebuild(db)
+        if not await db.r.exists(AlternateIndex.PARENTS):
+            await AlternateIndex.rebuild(db)
+        if not await db.r.exists(AlternateIndex.COUNTED):
+            await AlternateIndex.count(db)
+        if not await db.r.exists(DescriptorStore.MIGRATED):
+            await DescriptorStore.migrate(db)
+        if not await db.r.exists(DescriptorStore.IMAGES):
+            await DescriptorStore.rebuild(db)
+        if not WorkerPool.get():
+            await process_init(db)
+        if not await db.r.exists(CollectionStats.KEY):
+            await CollectionStats.rebuild(db)
+        await ImageTask.init(db)
+        claimed_tasks.extend(await ImageTask.take_pending(db, CONSUMER))
         global is_init_redis_done
         is_init_redis_done = True
     except asyncio.CancelledError:
         pass
 
 
+async def process_init(db: RedisManager):
+    """
+    Load the in-memory state of the process which runs the actions.
+    """
+    if not await DescriptorIndex.load(db):
+        await DescriptorIndex.train(db)
+    await DescriptorCache.warm(db)
+
+
+def init_process():
+    """
+    The initializer of the action process (supervisor mode). The process
+    has got own event loop in the thread (the Redis watcher of matrices
+    runs between tasks), the tasks are dispatched by the supervisor.
+    """
+    global process_loop
+    # SIGINT of the terminal is handled by the supervisor
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # The memory of descriptors is shared by the processes of the worker
+    DescriptorCache.max_size //= WorkerPool.get_processes()
+    process_loop = asyncio.new_event_loop()
+    threading.Thread(target=process_loop.run_forever, name='loop',
+                     daemon=True).start()
+    db = RedisManager(get_config('REDIS_URI'), {})
+    http = HttpClient()
+
+    async def init():
+        await db.connection()
+        await http.connection()
+        await process_init(db)
+        process_loop.create_task(publish_metrics(db), name='metrics')
+
+    asyncio.run_coroutine_threadsafe(init(), process_loop).result()
+
+
+async def publish_metrics(db: RedisManager):
+    try:
+        while True:
+            await Metrics.publish(db)
+            await asyncio.sleep(METRICS_INTERVAL)
+    except asyncio.CancelledError:
+        pass
+
+
 def main():
     loop = asyncio.get_event_loop()
     loop.set_exception_handler(handle_exception)
     db = RedisManager(get_config('REDIS_URI'), {})
+    http = HttpClient()
+    if processes := WorkerPool.get_processes():
+        # The supervisor only dispatches tasks, the watcher of matrices
+        # (the caches) runs in the processes.
+        RedisManager.handlers = {}
+        WorkerPool(processes, initializer=init_process,
+                   limits=WorkerPool.parse_limits())
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(
+                sig, lambda s=sig: loop.create_task(
+                    shutdown(loop, s), name='tasks/shutdown'))
+        logger.info(f'The supervisor runs actions in {processes} '
+                    f'processes.')
     loop.run_until_complete(db.connection())
+    loop.run_until_complete(http.connection())
     loop.run_until_complete(redis_init(db))
+    loop.create_task(publish_metrics(db), name='metrics')
+    loop.create_task(consume_tasks(db), name='tasks')
+    loop.create_task(maintain_tasks(db), name='tasks/maintenance')
     try:
         loop.run_forever()
     except KeyboardInterrupt:
         pass
     finally:
+        loop.run_until_complete(http.disconnect())
         loop.run_until_complete(db.disconnect())
 
 
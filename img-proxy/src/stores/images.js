@@ -9,7 +9,9 @@ export const useImagesStore = defineStore('image', {
     imageAlternates: [],
     alternatesForUUID: null,
     shownItems: 30,
-    scrollTop: 0
+    scrollTop: 0,
+    cursor: null,
+    pageSize: 100
   }),
   getters: {
     imageDetailCount: (state)  => state.imageAlternates.length,  // Object.keys(
@@ -29,6 +31,7 @@ export const useImagesStore = defineStore('image', {
       this.images = []
       this.shownItems = 30
       this.scrollTop = 0
+      this.cursor = null
     },
     // append(newImages) {
     //   for (const img of newImages){
@@ -157,18 +160,29 @@ export const useImagesStore = defineStore('image', {
       }
       return true
     },
+    async loadPage() {
+      const socket = useWebSocketStore()
+      const res = await socket.sendRequest({
+        cmd: 'get_collection_images', collection: this.collection, num: this.pageSize, cursor: this.cursor
+      })
+      if (res.status === 'ng') {
+        console.error(res.msg)
+        return
+      }
+      this.images = [...this.images, ...res.members]
+      this.cursor = res.cursor
+    },
     async loadCollectionImages(name=null) {
       this.loading = true
       if (name && this.collection !== name) {
         this.clear()
         this.collection = name
-        const socket = useWebSocketStore()
-        const res = await socket.sendRequest({
-          cmd: 'get_collection_images', collection: this.collection, offset: 0, num: -1
-        })
-        this.images = [...this.images, ...res.members]
+        await this.loadPage()
       }
       this.shownItems += 30
+      if (this.cursor && this.shownItems > this.images.length) {
+        await this.loadPage()
+      }
       this.loading = false
     },
     addTask(params) {
@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# The modules of the application are imported from app/ (as in Docker)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+os.environ.setdefault('DATA_DIR', tempfile.mkdtemp(prefix='img-cacher-'))
@@ -0,0 +1,54 @@
+import asyncio
+
+import fakeredis
+
+from libs.redis_manager import RedisManager
+from modules.collection_stats import CollectionStats
+
+
+def run(test):
+    """
+    Run the test coroutine test(db) with the empty fake Redis.
+    """
+    async def main():
+        db = RedisManager.get() or RedisManager('redis://', None)
+        db.r = fakeredis.FakeAsyncRedis(decode_responses=True)
+        return await test(db)
+
+    return asyncio.run(main())
+
+
+class TestCollectionStats:
+
+    def test_update(self):
+        async def test(db):
+            await CollectionStats.update(db.r, 'a', 'col', 10, 1700000000.5)
+            await CollectionStats.update(db.r, 'a:b', 'col', 5, 1600000000)
+            await CollectionStats.update(db.r, 'c', 'col-2', 1)
+            # The repeated update is counted once
+            await CollectionStats.update(db.r, 'c', 'col-2', 1)
+            assert await CollectionStats.get_all(db) == {
+                'col': {'members': 2, 'main_images': 1, 'alternates': 1,
+                        'size': 15, 'last_created': 1700000000.5},
+                'col-2': {'members': 1, 'main_images': 1, 'alternates': 0,
+                          'size': 1, 'last_created': None}}
+
+        run(test)
+
+    def test_move_remove(self):
+        async def test(db):
+            await CollectionStats.update(db.r, 'a', 'col', 10, 1700000000)
+            await CollectionStats.update(db.r, 'b', 'col', 5, 1600000000)
+            await CollectionStats.update(db.r, 'a', 'other', 10, 1700000000)
+            stats = await CollectionStats.get_all(db)
+            assert stats['col']['members'] == 1
+            assert stats['col']['last_created'] == 1600000000
+            assert stats['other']['last_created'] == 1700000000
+            for uuid in ('a', 'b'):
+                await CollectionStats.remove(db.r, uuid)
+            assert await CollectionStats.get_all(db) == {}
+            assert not await db.r.exists(CollectionStats.STATS,
+                                         CollectionStats.CREATED,
+                                         CollectionStats.NAMES)
+
+        run(test)
@@ -0,0 +1,82 @@
+import asyncio
+
+import fakeredis
+import numpy as np
+from redis.exceptions import LockError
+
+from libs.redis_manager import RedisManager
+from modules import descriptor_index
+from modules.descriptor_index import DescriptorIndex
+from modules.descriptor_store import DescriptorStore
+
+
+def run(test):
+    """
+    Run the test coroutine test(db) with the empty fake Redis.
+    """
+    async def main():
+        db = RedisManager.get() or RedisManager('redis://', None)
+        db.r = fakeredis.FakeAsyncRedis(decode_responses=True)
+        return await test(db)
+
+    return asyncio.run(main())
+
+
+class TestDescriptorIndex:
+
+    def test_rebuild_images(self):
+        async def test(db):
+            for uuid in ('a', 'b'):
+                await db.r.hset(f'matrix:{uuid}', 'descriptions', 'x')
+            await db.r.hset('matrix:c', 'similar_images_uuids', '{}')
+            await DescriptorStore.rebuild(db)
+            assert sorted(await DescriptorStore.get_images(db)) == ['a', 'b']
+
+        run(test)
+
+    def test_untrained_is_cached(self, monkeypatch):
+        calls = []
+
+        async def count_images(db):
+            calls.append(db)
+            return 0
+
+        monkeypatch.setattr(DescriptorStore, 'count_images', count_images)
+        monkeypatch.setattr(DescriptorIndex, 'vocabulary', None)
+        monkeypatch.setattr(DescriptorIndex, 'retry_at', 0)
+
+        async def test(db):
+            desc = np.zeros((2, 128), np.float32)
+            assert await DescriptorIndex.get_vector(db, desc) is None
+            assert await DescriptorIndex.get_vector(db, desc) is None
+            assert len(calls) == 1
+            # It is checked again after RETRY_INTERVAL
+            DescriptorIndex.retry_at = 0
+            assert await DescriptorIndex.get_vector(db, desc) is None
+            assert len(calls) == 2
+
+        run(test)
+
+    def test_expired_lock(self, monkeypatch):
+        class ExpiredLock:
+            async def acquire(self, blocking=True):
+                return True
+
+            async def release(self):
+                raise LockError('expired')
+
+        async def load(db):
+            return True
+
+        async def count_images(db):
+            return descriptor_index.ANN_MIN_IMAGES
+
+        monkeypatch.setattr(RedisManager, 'get_lock',
+                            lambda *args, **kwargs: ExpiredLock())
+        monkeypatch.setattr(DescriptorIndex, 'load', load)
+        monkeypatch.setattr(DescriptorStore, 'count_images', count_images)
+
+        async def test(db):
+            assert await DescriptorIndex.train(db)
+
+        run(test)
@@ -0,0 +1,75 @@
+import asyncio
+import os
+
+import fakeredis
+
+from libs.redis_manager import RedisManager
+from libs.storage import Storage
+from modules.filename_index import FilenameIndex
+
+
+def run(test):
+    """
+    Run the test coroutine test(db) with the empty fake Redis.
+    """
+    async def main():
+        db = RedisManager.get() or RedisManager('redis://', None)
+        db.r = fakeredis.FakeAsyncRedis(decode_responses=True)
+        return await test(db)
+
+    return asyncio.run(main())
+
+
+async def allocate(db, filename='a', owner='u'):
+    return await FilenameIndex.allocate(db, 'col', filename, 'png', owner)
+
+
+class TestFilenameIndex:
+
+    def test_split(self):
+        assert FilenameIndex.split('col/a.png') == ('col/a.png', 1)
+        assert FilenameIndex.split('col/a-0.png') == ('col/a.png', 2)
+        assert FilenameIndex.split('col/a-b-12.png') == ('col/a-b.png', 14)
+
+    def test_allocate(self):
+        async def test(db):
+            names = [await allocate(db, owner=f'u{it}') for it in range(3)]
+            assert names == ['col/a.png', 'col/a-0.png', 'col/a-1.png']
+            assert await FilenameIndex.get_owner(db, 'col/a-0.png') == 'u1'
+            # The requested name is taken by other allocation
+            assert await allocate(db, 'a-2') == 'col/a-2.png'
+            assert await allocate(db) == 'col/a-3.png'
+
+        run(test)
+
+    def test_reuse_released(self):
+        async def test(db):
+            for _ in range(4):
+                await allocate(db)
+            async with db.r.pipeline(transaction=True) as pipe:
+                await FilenameIndex.release(db, 'col/a-1.png', pipe)
+                await FilenameIndex.release(db, 'col/a.png', pipe)
+                await pipe.execute()
+            assert await FilenameIndex.get_owner(db, 'col/a.png') is None
+            # The lowest released name first, then the counter
+            assert [await allocate(db) for _ in range(3)] == [
+                'col/a.png', 'col/a-1.png', 'col/a-3.png']
+            # The name which was not given by the counter is not reused
+            await FilenameIndex.release(db, 'col/b-5.png')
+            assert await allocate(db, 'b') == 'col/b.png'
+
+        run(test)
+
+    def test_skip_stored_file(self):
+        async def test(db):
+            path = Storage.get().local_path('col/a.png')
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'wb').close()
+            try:
+                assert await allocate(db) == 'col/a-0.png'
+                assert await FilenameIndex.get_owner(db, 'col/a.png') == \
+                    FilenameIndex.UNKNOWN_OWNER
+            finally:
+                os.unlink(path)
+
+        run(test)
@@ -0,0 +1,153 @@
+import asyncio
+import time
+
+import fakeredis
+import pytest
+
+from libs.redis_manager import RedisManager
+from modules import image_task
+from modules.image_task import ImageTask
+
+THUMB = {'cmd': 'resize', 'thumb': True}
+DEDUP = {'cmd': 'find_same_images'}
+
+
+def run(test):
+    """
+    Run the test coroutine test(db) with the empty fake Redis.
+    """
+    async def main():
+        db = RedisManager.get() or RedisManager('redis://', None)
+        db.r = fakeredis.FakeAsyncRedis(decode_responses=True)
+        await ImageTask.init(db)
+        return await test(db)
+
+    return asyncio.run(main())
+
+
+async def pending(db, priority: str) -> list[dict]:
+    return await db.r.xpending_range(ImageTask.get_stream(priority),
+                                     ImageTask.GROUP, '-', '+', 10)
+
+
+@pytest.fixture
+def claim_timeout(monkeypatch):
+    monkeypatch.setattr(image_task, 'TASK_CLAIM_TIMEOUT', 0)
+
+
+class TestImageTask:
+
+    def test_priority(self):
+        assert ImageTask.get_priority(THUMB) == ImageTask.PRIORITY_THUMB
+        assert ImageTask.get_priority({'cmd': 'resize'}) == \
+            ImageTask.PRIORITY_RESIZE
+        assert ImageTask.get_priority(DEDUP) == ImageTask.PRIORITY_DEDUP
+        assert ImageTask.get_priority({**DEDUP, 'collection': 'a'}) == \
+            ImageTask.PRIORITY_COLLECTION
+
+    def test_save_ready_once(self):
+        async def test(db):
+            for _ in range(2):
+                await ImageTask(action=THUMB, task_uuid='a').save(db)
+            stream = ImageTask.get_stream(ImageTask.PRIORITY_THUMB)
+            messages = await db.r.xrange(stream)
+            assert len(messages) == 1
+            data = await db.r.hgetall('tasks:a')
+            assert data['status'] == ImageTask.STATUS_READY
+            assert data['message_id'] == messages[0][0]
+
+        run(test)
+
+    def test_take_done(self):
+        async def test(db):
+            await ImageTask(action=THUMB, task_uuid='a').save(db)
+            await ImageTask(action=DEDUP, task_uuid='b').save(db)
+            tasks = await ImageTask.take(db, 'c1', [ImageTask.PRIORITY_THUMB])
+            assert [(it.task_uuid, it.priority, it.action) for it in tasks] \
+                == [('a', ImageTask.PRIORITY_THUMB, THUMB)]
+            assert await db.r.hget('tasks:a', 'status') == \
+                ImageTask.STATUS_RUNNING
+            assert await db.r.hget('tasks:b', 'status') == \
+                ImageTask.STATUS_READY
+            await tasks[0].set_done(db)
+            assert await db.r.hget('tasks:a', 'status') == \
+                ImageTask.STATUS_DONE
+            assert 0 < await db.r.ttl('tasks:a') <= ImageTask.STATUS_TTL
+            assert not await pending(db, ImageTask.PRIORITY_THUMB)
+            assert not await db.r.xlen(tasks[0].stream)
+
+        run(test)
+
+    def test_enqueue_while_running(self):
+        async def test(db):
+            await ImageTask(action=THUMB, task_uuid='a').save(db)
+            first, = await ImageTask.take(db, 'c1', ImageTask.PRIORITIES)
+            await ImageTask(action=THUMB, task_uuid='a').save(db)
+            # The first run does not finish the task enqueued again
+            await first.set_done(db)
+            assert await db.r.hget('tasks:a', 'status') == \
+                ImageTask.STATUS_READY
+            second, = await ImageTask.take(db, 'c1', ImageTask.PRIORITIES)
+            assert second.message_id != first.message_id
+            await second.set_error(db, 'failed')
+            data = await db.r.hgetall('tasks:a')
+            assert data['status'] == ImageTask.STATUS_ERROR
+            assert data['error_message'] == 'failed'
+
+        run(test)
+
+    def test_take_pending(self):
+        async def test(db):
+            await ImageTask(action=THUMB, task_uuid='a').save(db)
+            await ImageTask(action=DEDUP, task_uuid='b').save(db)
+            taken = await ImageTask.take(db, 'c1', ImageTask.PRIORITIES)
+            assert len(taken) == 2
+            assert not await ImageTask.take_pending(db, 'c2')
+            tasks = await ImageTask.take_pending(db, 'c1')
+            assert sorted(it.task_uuid for it in tasks) == ['a', 'b']
+
+        run(test)
+
+    def test_reclaim(self, claim_timeout, monkeypatch):
+        monkeypatch.setattr(image_task, 'TASK_MAX_DELIVERIES', 3)
+
+        async def test(db):
+            await ImageTask(action=THUMB, task_uuid='a').save(db)
+            await ImageTask.take(db, 'c1', ImageTask.PRIORITIES)
+            # The deliveries 2 and 3 are claimed by other workers
+            for consumer in ('c2', 'c3'):
+                task, = await ImageTask.reclaim(db, consumer)
+                assert task.task_uuid == 'a'
+                info, = await pending(db, ImageTask.PRIORITY_THUMB)
+                assert info['consumer'] == consumer
+            # The delivery 4 finishes the task with the error
+            assert not await ImageTask.reclaim(db, 'c4')
+            assert await db.r.hget('tasks:a', 'status') == \
+                ImageTask.STATUS_ERROR
+            assert not await pending(db, ImageTask.PRIORITY_THUMB)
+
+        run(test)
+
+    def test_reclaim_timeout(self):
+        async def test(db):
+            await ImageTask(action=THUMB, task_uuid='a').save(db)
+            await ImageTask.take(db, 'c1', ImageTask.PRIORITIES)
+            assert not await ImageTask.reclaim(db, 'c2')
+
+        run(test)
+
+    def test_heartbeat(self):
+        async def test(db):
+            await ImageTask(action=THUMB, task_uuid='a').save(db)
+            tasks = await ImageTask.take(db, 'c1', ImageTask.PRIORITIES)
+            time.sleep(0.05)
+            info, = await pending(db, ImageTask.PRIORITY_THUMB)
+            assert info['time_since_delivered'] >= 50
+            await ImageTask.heartbeat(db, 'c1', tasks)
+            info, = await pending(db, ImageTask.PRIORITY_THUMB)
+            assert info['time_since_delivered'] < 50
+            # The heartbeat is not a delivery
+            assert info['times_delivered'] == 1
+            assert info['consumer'] == 'c1'
+
+        run(test)
@@ -0,0 +1,137 @@
+import asyncio
+import email.utils
+import os
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from libs import media_response as mr
+from libs.media_response import RangeNotSatisfiable, parse_ranges
+
+CONTENT = bytes(range(256)) * 4  # 1024 bytes
+
+
+def request(path, headers=None, sendfile=True):
+    async def handler(req):
+        return await mr.media_response(req, path, content_type='text/plain')
+
+    async def run():
+        app = web.Application()
+        app.router.add_get('/', handler)
+        async with TestClient(TestServer(app)) as client:
+            resp = await client.get('/', headers=headers or {})
+            return resp.status, resp.headers, await resp.read()
+
+    default, mr.SENDFILE = mr.SENDFILE, sendfile
+    try:
+        return asyncio.run(run())
+    finally:
+        mr.SENDFILE = default
+
+
+@pytest.fixture
+def path(tmp_path):
+    res = tmp_path / 'file.bin'
+    res.write_bytes(CONTENT)
+    return str(res)
+
+
+class TestParseRanges:
+
+    def test_simple(self):
+        assert parse_ranges('bytes=0-499', 1024) == [(0, 500)]
+        assert parse_ranges('bytes=1000-', 1024) == [(1000, 1024)]
+        assert parse_ranges('bytes=1000-5000', 1024) == [(1000, 1024)]
+
+    def test_suffix(self):
+        assert parse_ranges('bytes=-24', 1024) == [(1000, 1024)]
+        assert parse_ranges('bytes=-5000', 1024) == [(0, 1024)]
+
+    def test_overlapping(self):
+        assert parse_ranges('bytes=0-99, 50-149', 1024) == [(0, 100),
+                                                            (50, 150)]
+
+    def test_unsatisfiable(self):
+        with pytest.raises(RangeNotSatisfiable):
+            parse_ranges('bytes=1024-', 1024)
+        with pytest.raises(RangeNotSatisfiable):
+            parse_ranges('bytes=2000-3000, 1024-', 1024)
+        # The satisfiable ranges are kept
+        assert parse_ranges('bytes=0-1, 2000-', 1024) == [(0, 2)]
+
+    def test_ignored(self):
+        assert parse_ranges('items=0-1', 1024) is None
+        assert parse_ranges('bytes=abc', 1024) is None
+        assert parse_ranges('bytes=-', 1024) is None
+        assert parse_ranges('bytes=5-2', 1024) is None
+        many = ','.join(f'{it}-{it}' for it in range(mr.MAX_RANGES + 1))
+        assert parse_ranges(f'bytes={many}', 1024) is None
+
+
+class TestMediaResponse:
+
+    def test_full(self, path):
+        status, headers, body = request(path)
+        assert status == 200
+        assert body == CONTENT
+        assert headers['Accept-Ranges'] == 'bytes'
+        assert headers['ETag']
+
+    @pytest.mark.parametrize('sendfile', [True, False])
+    def test_range(self, path, sendfile):
+        status, headers, body = request(path, {'Range': 'bytes=-24'},
+                                        sendfile)
+        assert status == 206
+        assert headers['Content-Range'] == 'bytes 1000-1023/1024'
+        assert body == CONTENT[1000:]
+
+    @pytest.mark.parametrize('sendfile', [True, False])
+    def test_multipart(self, path, sendfile):
+        status, headers, body = request(
+            path, {'Range': 'bytes=0-9, 5-14'}, sendfile)
+        assert status == 206
+        assert headers['Content-Type'].startswith(
+            'multipart/byteranges; boundary=')
+        boundary = headers['Content-Type'].split('=', 1)[1].encode()
+        assert int(headers['Content-Length']) == len(body)
+        parts = body.split(b'--' + boundary)
+        assert parts[0] == b'' and parts[-1] == b'--\r\n'
+        assert b'Content-Range: bytes 0-9/1024\r\n\r\n' + CONTENT[:10] \
+            in parts[1]
+        assert b'Content-Range: bytes 5-14/1024\r\n\r\n' + CONTENT[5:15] \
+            in parts[2]
+
+    def test_not_satisfiable(self, path):
+        status, headers, _ = request(path, {'Range': 'bytes=2000-'})
+        assert status == 416
+        assert headers['Content-Range'] == 'bytes */1024'
+
+    def test_not_modified(self, path):
+        _, headers, _ = request(path)
+        status, _, body = request(path, {'If-None-Match': headers['ETag']})
+        assert status == 304
+        assert body == b''
+
+    def test_if_range_etag(self, path):
+        _, headers, _ = request(path)
+        etag = headers['ETag']
+        status, _, body = request(path, {'Range': 'bytes=0-9',
+                                         'If-Range': etag})
+        assert (status, body) == (206, CONTENT[:10])
+        # The other or weak ETag - the whole file is sent
+        for if_range in ('"other"', f'W/{etag}'):
+            status, _, body = request(path, {'Range': 'bytes=0-9',
+                                             'If-Range': if_range})
+            assert (status, body) == (200, CONTENT)
+
+    def test_if_range_date(self, path):
+        mtime = os.stat(path).st_mtime
+        status, _, body = request(path, {
+            'Range': 'bytes=0-9',
+            'If-Range': email.utils.formatdate(mtime + 10, usegmt=True)})
+        assert (status, body) == (206, CONTENT[:10])
+        status, _, body = request(path, {
+            'Range': 'bytes=0-9',
+            'If-Range': email.utils.formatdate(mtime - 3600, usegmt=True)})
+        assert (status, body) == (200, CONTENT)
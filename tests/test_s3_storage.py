@@ -0,0 +1,265 @@
+import asyncio
+import email.utils
+import hashlib
+import hmac
+import re
+from urllib.parse import quote
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from libs.download_stream import DownloadStream
+from libs.http_client import HttpClient
+from libs.storage import S3Storage, Storage, StorageException
+
+BUCKET = 'bucket'
+ACCESS_KEY = 'access'
+SECRET_KEY = 'secret'
+NS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+AUTH = re.compile(r'AWS4-HMAC-SHA256 Credential=(?P<key>[^/]+)/(?P<scope>'
+                  r'(?P<date>\d{8})/(?P<region>[^/]+)/s3/aws4_request), '
+                  r'SignedHeaders=(?P<headers>[^,]+), '
+                  r'Signature=(?P<signature>[0-9a-f]{64})$')
+
+
+class StubS3:
+    """
+    In-memory S3 (one bucket), it verifies AWS Signature V4 independently
+    of the driver.
+    """
+    PAGE = 2  # keys of one page of list
+
+    def __init__(self):
+        self.objects: dict[str, bytes] = {}
+        self.uploads: dict[str, dict[int, bytes]] = {}
+        self.requests = []
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route('*', '/{path:.*}', self.handle)
+        return app
+
+    @staticmethod
+    def verify(request: web.Request, body: bytes) -> bool:
+        if not (auth := AUTH.match(request.headers.get('Authorization', ''))):
+            return False
+        payload_hash = request.headers['x-amz-content-sha256']
+        if payload_hash != S3Storage.UNSIGNED_PAYLOAD and \
+                payload_hash != hashlib.sha256(body).hexdigest():
+            return False
+        signed = auth['headers'].split(';')
+        query = '&'.join(
+            f'{quote(k, safe="-_.~")}={quote(v, safe="-_.~")}'
+            for k, v in sorted(request.query.items()))
+        canonical_request = '\n'.join([
+            request.method,
+            request.raw_path.split('?')[0],
+            query,
+            ''.join(f'{it}:{request.headers[it].strip()}\n' for it in signed),
+            auth['headers'],
+            payload_hash
+        ])
+        string_to_sign = '\n'.join([
+            'AWS4-HMAC-SHA256',
+            request.headers['x-amz-date'],
+            auth['scope'],
+            hashlib.sha256(canonical_request.encode()).hexdigest()
+        ])
+        key = f'AWS4{SECRET_KEY}'.encode()
+        for it in (auth['date'], auth['region'], 's3', 'aws4_request'):
+            key = hmac.new(key, it.encode(), hashlib.sha256).digest()
+        signature = hmac.new(key, string_to_sign.encode(),
+                             hashlib.sha256).hexdigest()
+        return auth['key'] == ACCESS_KEY and \
+            {'host', 'x-amz-date', 'x-amz-content-sha256'} <= set(signed) and \
+            hmac.compare_digest(signature, auth['signature'])
+
+    async def handle(self, request: web.Request) -> web.Response:
+        body = await request.read()
+        self.requests.append((request.method, request.path_qs))
+        if not self.verify(request, body):
+            return web.Response(status=403, body=b'<Error><Code>'
+                                b'SignatureDoesNotMatch</Code></Error>')
+        bucket, _, key = request.match_info['path'].partition('/')
+        assert bucket == BUCKET
+        query = request.query
+        if not key:
+            return self.list(query)
+        if request.method == 'HEAD' or request.method == 'GET':
+            if key not in self.objects:
+                return web.Response(status=404)
+            data = self.objects[key]
+            headers = {'Last-Modified': email.utils.formatdate(usegmt=True)}
+            if request.method == 'HEAD':
+                headers['Content-Length'] = str(len(data))
+                return web.Response(headers=headers)
+            if match := re.match(r'bytes=(\d+)-(\d*)$',
+                                 request.headers.get('Range', '')):
+                stop = int(match[2]) + 1 if match[2] else len(data)
+                return web.Response(status=206, headers=headers,
+                                    body=data[int(match[1]):stop])
+            return web.Response(headers=headers, body=data)
+        if request.method == 'DELETE':
+            if 'uploadId' in query:
+                self.uploads.pop(query['uploadId'])
+            else:
+                self.objects.pop(key, None)
+            return web.Response(status=204)
+        if request.method == 'POST' and 'uploads' in query:
+            upload_id = f'upload-{len(self.uploads)}'
+            self.uploads[upload_id] = {}
+            return web.Response(text=(
+                f'<InitiateMultipartUploadResult xmlns="{NS}">'
+                f'<UploadId>{upload_id}</UploadId>'
+                f'</InitiateMultipartUploadResult>'))
+        if request.method == 'POST':
+            parts = self.uploads.pop(query['uploadId'])
+            etags = re.findall(r'<ETag>"(\d+)"</ETag>',
+                               body.decode())
+            self.objects[key] = b''.join(parts[int(it)] for it in etags)
+            return web.Response(text='<CompleteMultipartUploadResult/>')
+        if 'partNumber' in query:
+            self.uploads[query['uploadId']][int(query['partNumber'])] = body
+            return web.Response(headers={
+                'ETag': f'"{query["partNumber"]}"'})
+        if source := request.headers.get('x-amz-copy-source'):
+            self.objects[key] = self.objects[
+                source.removeprefix(f'/{BUCKET}/')]
+            return web.Response(text='<CopyObjectResult/>')
+        self.objects[key] = body
+        return web.Response()
+
+    def list(self, query) -> web.Response:
+        assert query['list-type'] == '2'
+        keys = sorted(it for it in self.objects
+                      if it.startswith(query.get('prefix', '')))
+        start = int(query.get('continuation-token', 0))
+        page = keys[start:start + self.PAGE]
+        truncated = start + self.PAGE < len(keys)
+        token = f'<NextContinuationToken>{start + self.PAGE}' \
+                f'</NextContinuationToken>' if truncated else ''
+        contents = ''.join(f'<Contents><Key>{it}</Key></Contents>'
+                           for it in page)
+        return web.Response(text=(
+            f'<ListBucketResult xmlns="{NS}">'
+            f'<IsTruncated>{str(truncated).lower()}</IsTruncated>'
+            f'{token}{contents}</ListBucketResult>'))
+
+
+def run(test, secret_key=SECRET_KEY):
+    """
+    Run the test coroutine test(storage, stub) with the stub server.
+    """
+    async def main():
+        stub = StubS3()
+        async with TestServer(stub.app()) as server:
+            storage = S3Storage(str(server.make_url('')), BUCKET,
+                                'eu-central-1', ACCESS_KEY, secret_key)
+            try:
+                return await test(storage, stub)
+            finally:
+                await HttpClient.get().disconnect()
+
+    if not HttpClient.get():
+        HttpClient()
+    return asyncio.run(main())
+
+
+@pytest.fixture
+def local_file(tmp_path):
+    def make(data: bytes) -> str:
+        path = tmp_path / 'upload.bin'
+        path.write_bytes(data)
+        return str(path)
+    return make
+
+
+class TestS3Storage:
+
+    def test_upload_read(self, local_file):
+        path = local_file(b'0123456789')
+
+        async def test(storage, stub):
+            await storage.upload('a/b c.png', path, move=False)
+            assert stub.objects['a/b c.png'] == b'0123456789'
+            assert (await storage.stat('a/b c.png')).st_size == 10
+            assert await storage.stat('a/missing.png') is None
+            assert await storage.read('a/b c.png') == b'0123456789'
+            assert b''.join([it async for it in storage.stream(
+                'a/b c.png', 2, 5)]) == b'234'
+            assert b''.join([it async for it in storage.stream(
+                'a/b c.png', 7)]) == b'789'
+            with pytest.raises(StorageException):
+                await storage.read('a/missing.png')
+
+        run(test)
+
+    def test_multipart_upload(self, local_file):
+        data = bytes(range(256)) * (S3Storage.MIN_PART_SIZE // 128)
+        path = local_file(data)
+
+        async def test(storage, stub):
+            await storage.upload('big.bin', path)
+            assert stub.objects['big.bin'] == data
+            assert not stub.uploads
+            assert [it for it in stub.requests
+                    if 'partNumber' in it[1]] and len(stub.requests) == 4
+
+        run(test)
+
+    def test_invalid_signature(self, local_file):
+        path = local_file(b'data')
+
+        async def test(storage, stub):
+            with pytest.raises(StorageException, match='403'):
+                await storage.upload('a.png', path, move=False)
+            assert not stub.objects
+
+        run(test, secret_key='other')
+
+    def test_list_paging(self):
+        async def test(storage, stub):
+            keys = [f'col/{it}.png' for it in range(5)]
+            stub.objects.update(dict.fromkeys([*keys, 'other/a.png'], b''))
+            assert [it async for it in storage.list('col/')] == keys
+            assert len([it for it in stub.requests
+                        if 'list-type' in it[1]]) == 3
+            assert len([it async for it in storage.list()]) == 6
+
+        run(test)
+
+    def test_link_rename_delete(self):
+        async def test(storage, stub):
+            stub.objects['a.png'] = b'data'
+            await storage.link('a.png', 'dir/b.png')
+            assert stub.objects['dir/b.png'] == b'data'
+            await storage.rename('dir/b.png', 'c.png')
+            assert set(stub.objects) == {'a.png', 'c.png'}
+            await storage.delete('a.png')
+            await storage.delete('a.png')  # the missing file is ignored
+            assert set(stub.objects) == {'c.png'}
+
+        run(test)
+
+    def test_late_reader_of_download(self, tmp_path):
+        path = str(tmp_path / 'a.png')
+
+        async def test(storage, stub):
+            Storage.instance = storage
+            flight = asyncio.get_running_loop().create_future()
+            stream = await DownloadStream.open('uuid', path,
+                                               storage_key='a.png')
+            assert await DownloadStream.wait('uuid', flight) is stream
+            await stream.write(b'data')
+            await stream.finish()
+            await storage.upload('a.png', path)
+            # The local file was removed, the reader gets the stored file
+            assert b''.join([it async for it in stream.iter_chunks(2)]) \
+                == b'data'
+
+        default = Storage.instance
+        try:
+            run(test)
+        finally:
+            Storage.instance = default
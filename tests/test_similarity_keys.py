@@ -0,0 +1,46 @@
+import asyncio
+
+import fakeredis
+
+from libs.redis_manager import RedisManager
+from modules.descriptor_index import DescriptorIndex
+from modules.descriptor_store import DescriptorStore
+from modules.perceptual_hash import PerceptualHash
+from modules.similarity_keys import SimilarityKeys
+
+HASHES = '0123456789abcdef' * 2 + 'ff' + '00' * 63
+
+
+def run(test):
+    """
+    Run the test coroutine test(db) with the empty fake Redis.
+    """
+    async def main():
+        db = RedisManager.get() or RedisManager('redis://', None)
+        db.r = fakeredis.FakeAsyncRedis(decode_responses=True)
+        return await test(db)
+
+    return asyncio.run(main())
+
+
+class TestSimilarityKeys:
+
+    def test_remove(self):
+        async def test(db):
+            for uuid in ('a', 'b'):
+                await DescriptorStore.add_image(db.r, uuid)
+                await DescriptorIndex.add(db, uuid)
+                await PerceptualHash.add(db, uuid, HASHES)
+            await SimilarityKeys.remove(db, 'a')
+            # The image without the hashes is removed too
+            await SimilarityKeys.remove(db, 'c')
+            assert await DescriptorStore.get_images(db) == ['b']
+            assert await db.r.zrange(SimilarityKeys.ANN_IMAGES, 0, -1) == \
+                ['b']
+            assert await PerceptualHash.get(db, 'a') is None
+            assert await PerceptualHash.find(db, 'c', HASHES) == \
+                ([('b', 0)], [])
+            for key in SimilarityKeys.phash_chunks(HASHES):
+                assert await db.r.smembers(key) == {'b'}
+
+        run(test)
@@ -0,0 +1,103 @@
+import asyncio
+import time
+from collections import Counter
+
+import fakeredis
+
+from libs.redis_manager import RedisManager
+from modules.image_task import ImageTask
+from modules.task_scheduler import TaskScheduler
+
+ACTIONS = {
+    ImageTask.PRIORITY_THUMB: {'cmd': 'resize', 'thumb': True},
+    ImageTask.PRIORITY_RESIZE: {'cmd': 'resize'},
+    ImageTask.PRIORITY_DEDUP: {'cmd': 'find_same_images'},
+    ImageTask.PRIORITY_COLLECTION: {'cmd': 'make_gif_from_images',
+                                    'collection': 'a'}
+}
+
+
+def run(test):
+    """
+    Run the test coroutine test(db) with the empty fake Redis.
+    """
+    async def main():
+        db = RedisManager.get() or RedisManager('redis://', None)
+        db.r = fakeredis.FakeAsyncRedis(decode_responses=True)
+        await ImageTask.init(db)
+        return await test(db)
+
+    return asyncio.run(main())
+
+
+async def enqueue(db, priority: str, count: int):
+    for ix in range(count):
+        await ImageTask(action={**ACTIONS[priority], 'ix': ix}).save(db)
+
+
+class TestTaskScheduler:
+
+    def test_parse_weights(self):
+        assert TaskScheduler.parse_weights('thumb:3,dedup:0,other:5') == {
+            'thumb': 3, 'resize': 1, 'dedup': 1, 'collection': 1}
+
+    def test_choose_shares(self):
+        scheduler = TaskScheduler('c1', TaskScheduler.parse_weights(
+            'thumb:8,resize:4,dedup:2,collection:1'))
+        picks = Counter(scheduler.choose(list(ImageTask.PRIORITIES))
+                        for _ in range(150))
+        assert picks == {'thumb': 80, 'resize': 40, 'dedup': 20,
+                         'collection': 10}
+        # The classes without tasks do not collect the credit
+        picks = Counter(scheduler.choose(['resize', 'collection'])
+                        for _ in range(50))
+        assert picks == {'resize': 40, 'collection': 10}
+        assert scheduler.choose(['thumb', 'resize']) == 'thumb'
+
+    def test_take_by_shares(self):
+        async def test(db):
+            for priority in ImageTask.PRIORITIES:
+                await enqueue(db, priority, 20)
+            scheduler = TaskScheduler('c1', TaskScheduler.parse_weights(
+                'thumb:2,resize:1,dedup:1,collection:1'))
+            picks = Counter()
+            for _ in range(10):
+                task = await scheduler.take(db)
+                picks[task.priority] += 1
+                await task.set_done(db)
+            return picks
+
+        assert run(test) == {'thumb': 4, 'resize': 2, 'dedup': 2,
+                             'collection': 2}
+
+    def test_no_hoarding(self):
+        async def test(db):
+            for priority in ImageTask.PRIORITIES:
+                await enqueue(db, priority, 2)
+            task = await TaskScheduler('c1').take(db)
+            assert task.priority == ImageTask.PRIORITY_THUMB
+            # Only the returned task was delivered to the worker
+            for priority in ImageTask.PRIORITIES:
+                info = await db.r.xpending(ImageTask.get_stream(priority),
+                                           ImageTask.GROUP)
+                assert info['pending'] == (priority == task.priority)
+            # The other worker gets the rest
+            other = TaskScheduler('c2')
+            tasks = [await other.take(db) for _ in range(7)]
+            assert all(tasks) and not await other.take(db)
+
+        run(test)
+
+    def test_take_blocks(self):
+        async def test(db):
+            scheduler = TaskScheduler('c1')
+            start = time.monotonic()
+            assert await scheduler.take(db, block=100) is None
+            assert time.monotonic() - start >= 0.1
+            waiting = asyncio.create_task(scheduler.take(db, block=5000))
+            await asyncio.sleep(0.05)
+            await enqueue(db, ImageTask.PRIORITY_DEDUP, 1)
+            task = await asyncio.wait_for(waiting, 1)
+            assert task.priority == ImageTask.PRIORITY_DEDUP
+
+        run(test)
@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+
+from libs.worker_pool import WorkerPool
+
+
+def run(test, limits=None):
+    """
+    Run the test coroutine test(pool) with the pool of one process.
+    """
+    async def main():
+        pool = WorkerPool(1, limits=limits)
+        try:
+            return await test(pool)
+        finally:
+            await pool.close()
+            WorkerPool.instance = None
+
+    return asyncio.run(main())
+
+
+class TestWorkerPool:
+
+    def test_parse_limits(self):
+        assert WorkerPool.parse_limits('video:1, image.find_same_images:2') \
+            == {'video': 1, 'image.find_same_images': 2}
+        assert WorkerPool.parse_limits('') == {}
+
+    @pytest.mark.parametrize('value, processes', [
+        (0, 0), ('3', 3), ('-1', 0), (None, 0)])
+    def test_get_processes(self, value, processes):
+        assert WorkerPool.get_processes(value) == processes
+
+    def test_run(self):
+        async def test(pool):
+            return await pool.run('image.resize', abs, -3)
+
+        assert run(test) == 3
+
+    def test_slot_is_released_while_waiting(self):
+        async def test(pool):
+            slot = asyncio.Semaphore(1)
+            await slot.acquire()
+            limit = pool.limits['video']
+            await limit.acquire()
+            task = asyncio.create_task(pool.run('video.resize', abs, -3,
+                                                slot=slot))
+            await asyncio.sleep(0.1)
+            # The other kinds can take the slot
+            assert not slot.locked() and not task.done()
+            limit.release()
+            assert await task == 3
+            # The slot is held again by the finished action
+            assert slot.locked()
+            # The other kinds do not wait for the limit of video
+            assert await pool.run('image.resize', abs, -2, slot=slot) == 2
+
+        run(test, {'video': 1})